@@ -1,45 +1,305 @@
 import os
 import logging
+import importlib
 from flask import Flask
+from flask.cli import AppGroup, ScriptInfo
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+import db_routing
 
-# Initialize Flask app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "crime_management_system_secret")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+# Configure logging. DEBUG logging is expensive under load, so it is opt-in.
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
-# Database configuration
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-
-# Initialize extensions
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
+# Extensions are bound to the app in create_app
+db = SQLAlchemy(session_options={"class_": db_routing.RoutingSession})
+login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
-# Import models and routes after initializing the app
-from models import User, load_user
-from routes import *
-
-# Create all database tables
-with app.app_context():
-    db.create_all()
-    
-    # Create default admin user if none exists
-    if not User.query.filter_by(role='admin').first():
-        admin = User(username='admin', email='admin@example.com', role='admin')
-        admin.set_password('password')
-        db.session.add(admin)
-        db.session.commit()
-        logging.info("Created default admin user: admin/password")
\ No newline at end of file
+# Modules that only provide CLI commands, by command name. They are imported
+# (and their init_app run) when one of their commands is invoked, so web
+# workers never load them.
+CLI_MODULES = {
+    'init-db': 'bootstrap',
+    'migrations': 'migrations',
+    'ingest': 'ingest',
+    'bench-seed': 'benchmark',
+    'bench-run': 'benchmark',
+    'bench-compare': 'benchmark',
+    'bench-startup': 'benchmark',
+}
+
+
+class LazyCommandGroup(AppGroup):
+    """``app.cli`` that imports the modules in CLI_MODULES on first use."""
+
+    def get_command(self, ctx, name):
+        if name not in self.commands and name in CLI_MODULES:
+            importlib.import_module(CLI_MODULES[name]).init_app(ctx.ensure_object(ScriptInfo).load_app())
+        return super().get_command(ctx, name)
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(CLI_MODULES))
+
+
+def create_app(config=None):
+    """Build and configure the application.
+
+    Does no database I/O; run ``flask init-db`` to create or migrate the
+    schema and add the default admin user.
+    """
+    app = Flask(__name__)
+    app.cli = LazyCommandGroup(app.name)
+    app.secret_key = os.environ.get("SESSION_SECRET", "crime_management_system_secret")
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+
+    # Database configuration
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    # Connection pools (see db_routing.py); the replica pools default to the
+    # primary's sizes. Views marked read_replica send their SELECTs to one of
+    # DATABASE_REPLICA_URLS, except for REPLICA_STICKY_SECONDS after the
+    # browser's last commit; a replica that fails to connect is skipped for
+    # REPLICA_RETRY_SECONDS.
+    app.config["DB_POOL_SIZE"] = int(os.environ.get("DB_POOL_SIZE", 10))
+    app.config["DB_MAX_OVERFLOW"] = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+    app.config["DB_POOL_TIMEOUT"] = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+    app.config["DB_POOL_RECYCLE"] = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    app.config["DB_POOL_PRE_PING"] = os.environ.get("DB_POOL_PRE_PING", "0") == "1"
+    app.config["DB_REPLICA_POOL_SIZE"] = int(os.environ.get("DB_REPLICA_POOL_SIZE", 0)) or None
+    app.config["DB_REPLICA_MAX_OVERFLOW"] = int(os.environ.get("DB_REPLICA_MAX_OVERFLOW", 0)) or None
+    app.config["DATABASE_REPLICA_URLS"] = [url for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+                                           if url.strip()]
+    app.config["REPLICA_STICKY_SECONDS"] = int(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+    app.config["REPLICA_RETRY_SECONDS"] = int(os.environ.get("REPLICA_RETRY_SECONDS", 30))
+
+    # Identity cache used by the login user_loader (see user_cache.py), kept in
+    # a SQLite file shared by the workers on the host (USER_CACHE_PATH, default
+    # instance/user_cache.sqlite) so a role, password or deactivation change
+    # reaches every worker on commit. USER_CACHE_PATH="" keeps a per-process
+    # cache, which is only safe with a single worker.
+    app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 1024))
+    app.config["USER_CACHE_TTL"] = int(os.environ.get("USER_CACHE_TTL", 30))
+    app.config["USER_CACHE_PATH"] = os.environ.get("USER_CACHE_PATH")
+
+    # Password hashing runs in a bounded process pool (see passwords.py). Stored
+    # hashes are upgraded on the next successful login when the method changes.
+    app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+    app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+    app.config["PASSWORD_HASH_PER_IP"] = int(os.environ.get("PASSWORD_HASH_PER_IP", 2))
+
+    # Sign-in rate limits (see rate_limits.py): token buckets per client address
+    # and per username, refilled at *_PER_MINUTE, and a lockout after
+    # LOGIN_LOCKOUT_AFTER consecutive failures that doubles with each further
+    # failure up to LOGIN_LOCKOUT_MAX seconds. Lockouts are per address and per
+    # address and username, never per username alone, and browsers that have
+    # signed in as a user within LOGIN_KNOWN_CLIENT_DAYS skip that user's
+    # bucket. The limits are shared by the workers on the host through a SQLite
+    # file (RATE_LIMIT_PATH, default instance/rate_limits.sqlite);
+    # RATE_LIMIT_PATH="" keeps them per process.
+    app.config["LOGIN_RATE_LIMIT"] = os.environ.get("LOGIN_RATE_LIMIT", "1") != "0"
+    app.config["LOGIN_IP_BURST"] = int(os.environ.get("LOGIN_IP_BURST", 20))
+    app.config["LOGIN_IP_PER_MINUTE"] = float(os.environ.get("LOGIN_IP_PER_MINUTE", 20))
+    app.config["LOGIN_USER_BURST"] = int(os.environ.get("LOGIN_USER_BURST", 10))
+    app.config["LOGIN_USER_PER_MINUTE"] = float(os.environ.get("LOGIN_USER_PER_MINUTE", 2))
+    app.config["LOGIN_LOCKOUT_AFTER"] = int(os.environ.get("LOGIN_LOCKOUT_AFTER", 5))
+    app.config["LOGIN_LOCKOUT_SECONDS"] = int(os.environ.get("LOGIN_LOCKOUT_SECONDS", 30))
+    app.config["LOGIN_LOCKOUT_MAX"] = int(os.environ.get("LOGIN_LOCKOUT_MAX", 3600))
+    app.config["LOGIN_KNOWN_CLIENT_DAYS"] = int(os.environ.get("LOGIN_KNOWN_CLIENT_DAYS", 30))
+    app.config["RATE_LIMIT_PATH"] = os.environ.get("RATE_LIMIT_PATH")
+
+    # Request instrumentation (see instrumentation.py). Statements slower than
+    # SLOW_QUERY_MS are logged; requests slower than PROFILE_THRESHOLD_MS have
+    # their sampled stacks written to PROFILE_DIR. Both are off when unset.
+    app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", 0)) or None
+    app.config["PROFILE_THRESHOLD_MS"] = float(os.environ.get("PROFILE_THRESHOLD_MS", 0)) or None
+    app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", "profiles")
+
+    # In-memory copies of tables (the name index, case queues) catch up by
+    # re-reading rows stamped up to CATCH_UP_MARGIN seconds before the newest
+    # they have seen, so a transaction committed late is not missed; keep it
+    # above the longest write transaction plus clock skew between hosts.
+    app.config["CATCH_UP_MARGIN"] = int(os.environ.get("CATCH_UP_MARGIN", 60))
+
+    # Fuzzy criminal name search (see name_search.py). Without PostgreSQL an
+    # in-process trigram index is used; NAME_INDEX_PATH holds its snapshot,
+    # NAME_INDEX_REFRESH is how often (seconds) it picks up rows changed
+    # elsewhere and NAME_INDEX_RECONCILE how often it drops rows deleted
+    # elsewhere. With NAME_INDEX_PRELOAD a background thread per worker loads
+    # and refreshes it from the first request on; NAME_INDEX_PRELOAD=0 loads
+    # it on the first search instead.
+    app.config["NAME_INDEX_PATH"] = os.environ.get("NAME_INDEX_PATH")
+    app.config["NAME_INDEX_REFRESH"] = int(os.environ.get("NAME_INDEX_REFRESH", 30))
+    app.config["NAME_INDEX_RECONCILE"] = int(os.environ.get("NAME_INDEX_RECONCILE", 300))
+    app.config["NAME_INDEX_PRELOAD"] = os.environ.get("NAME_INDEX_PRELOAD", "1") != "0"
+
+    # Session storage (see sessions.py): "sql" keeps sessions in the database,
+    # "memory" in the process (single worker only), "cookie" is Flask's signed
+    # cookie. Server-side sessions slide their expiry at most once per
+    # SESSION_REFRESH_INTERVAL seconds; expired rows are swept in batches.
+    app.config["SESSION_BACKEND"] = os.environ.get("SESSION_BACKEND", "sql")
+    app.config["SESSION_REFRESH_INTERVAL"] = int(os.environ.get("SESSION_REFRESH_INTERVAL", 300))
+    app.config["SESSION_SWEEP_INTERVAL"] = int(os.environ.get("SESSION_SWEEP_INTERVAL", 300))
+
+    # Replit OAuth tokens are cached per process (see oauth_tokens.py) and
+    # expired ones are purged every OAUTH_TOKEN_SWEEP_INTERVAL seconds. A
+    # refresh or delete in one worker reaches the others at once through
+    # write counters in a SQLite file shared on the host (OAUTH_TOKEN_CACHE_PATH,
+    # default instance/oauth_tokens.sqlite; the tokens themselves are not
+    # stored there). OAUTH_TOKEN_CACHE_PATH="" is only safe with a single worker.
+    app.config["OAUTH_TOKEN_CACHE_SIZE"] = int(os.environ.get("OAUTH_TOKEN_CACHE_SIZE", 1024))
+    app.config["OAUTH_TOKEN_CACHE_TTL"] = int(os.environ.get("OAUTH_TOKEN_CACHE_TTL", 300))
+    app.config["OAUTH_TOKEN_CACHE_PATH"] = os.environ.get("OAUTH_TOKEN_CACHE_PATH")
+    app.config["OAUTH_TOKEN_SWEEP_INTERVAL"] = int(os.environ.get("OAUTH_TOKEN_SWEEP_INTERVAL", 600))
+
+    # Dashboard summaries are cached for DASHBOARD_CACHE_TTL seconds per role
+    # (per user for officers); see counters.py.
+    app.config["DASHBOARD_CACHE_TTL"] = int(os.environ.get("DASHBOARD_CACHE_TTL", 15))
+
+    # Export files are written by `flask export-worker` to EXPORT_DIR and
+    # removed EXPORT_RETENTION_HOURS after they finish (see exports.py).
+    app.config["EXPORT_DIR"] = os.environ.get("EXPORT_DIR")
+    app.config["EXPORT_RETENTION_HOURS"] = int(os.environ.get("EXPORT_RETENTION_HOURS", 72))
+
+    # The co-offender graph (see co_offenders.py) picks up new links every
+    # CO_OFFENDER_REFRESH seconds and is rebuilt every CO_OFFENDER_REBUILD.
+    app.config["CO_OFFENDER_REFRESH"] = int(os.environ.get("CO_OFFENDER_REFRESH", 30))
+    app.config["CO_OFFENDER_REBUILD"] = int(os.environ.get("CO_OFFENDER_REBUILD", 3600))
+
+    # Hotspot analyses (see hotspots.py) run over an in-memory copy of the
+    # geocoded crimes, refreshed every HOTSPOT_REFRESH seconds and rebuilt
+    # every HOTSPOT_REBUILD; results are cached for HOTSPOT_CACHE_TTL. With
+    # HOTSPOT_PRELOAD a background thread per worker keeps the copy current
+    # from the first request on; HOTSPOT_PRELOAD=0 loads it on use instead.
+    app.config["HOTSPOT_REFRESH"] = int(os.environ.get("HOTSPOT_REFRESH", 30))
+    app.config["HOTSPOT_REBUILD"] = int(os.environ.get("HOTSPOT_REBUILD", 3600))
+    app.config["HOTSPOT_CACHE_TTL"] = int(os.environ.get("HOTSPOT_CACHE_TTL", 300))
+    app.config["HOTSPOT_PRELOAD"] = os.environ.get("HOTSPOT_PRELOAD", "1") != "0"
+
+    # Crimes get the nearest station (see stations.py) from an in-memory index
+    # that checks for station changes made elsewhere every STATION_INDEX_REFRESH
+    # seconds; `flask stations backfill` covers bulk-loaded crimes.
+    app.config["STATION_INDEX_REFRESH"] = int(os.environ.get("STATION_INDEX_REFRESH", 60))
+
+    # Rendered fragments and pages (see fragments.py) are cached for
+    # FRAGMENT_CACHE_TTL seconds (0 disables caching) in FRAGMENT_CACHE_SIZE_MB
+    # per process and in a FRAGMENT_CACHE_SHARED_SIZE_MB SQLite tier shared by
+    # the workers on the host (FRAGMENT_CACHE_PATH, default
+    # instance/fragment_cache.sqlite), which also holds the tag versions so
+    # invalidations reach every worker at once. FRAGMENT_CACHE_PATH="" keeps
+    # everything per process, which is only safe with a single worker.
+    app.config["FRAGMENT_CACHE_TTL"] = int(os.environ.get("FRAGMENT_CACHE_TTL", 300))
+    app.config["FRAGMENT_CACHE_SIZE_MB"] = int(os.environ.get("FRAGMENT_CACHE_SIZE_MB", 32))
+    app.config["FRAGMENT_CACHE_PATH"] = os.environ.get("FRAGMENT_CACHE_PATH")
+    app.config["FRAGMENT_CACHE_SHARED_SIZE_MB"] = int(os.environ.get("FRAGMENT_CACHE_SHARED_SIZE_MB", 256))
+
+    # Live incident feed (see live_feed.py). Commits of crimes, cases and
+    # evidence append to feed_events; `flask live-feed serve` streams them as
+    # Server-Sent Events from FEED_HOST:FEED_PORT, polling every
+    # FEED_POLL_INTERVAL seconds or as soon as a worker's commit pings it
+    # over UDP on the same port. Browsers connect to FEED_PUBLIC_URL (the
+    # reverse proxy should route it to the feed server); rows are kept
+    # FEED_RETENTION_HOURS for clients resuming after a disconnect.
+    app.config["FEED_ENABLED"] = os.environ.get("FEED_ENABLED", "1") != "0"
+    app.config["FEED_HOST"] = os.environ.get("FEED_HOST", "127.0.0.1")
+    app.config["FEED_PORT"] = int(os.environ.get("FEED_PORT", 8001))
+    app.config["FEED_PUBLIC_URL"] = os.environ.get("FEED_PUBLIC_URL", "/live/events")
+    app.config["FEED_POLL_INTERVAL"] = float(os.environ.get("FEED_POLL_INTERVAL", 0.5))
+    app.config["FEED_QUEUE_SIZE"] = int(os.environ.get("FEED_QUEUE_SIZE", 1000))
+    app.config["FEED_RETENTION_HOURS"] = int(os.environ.get("FEED_RETENTION_HOURS", 24))
+    app.config["FEED_TOKEN_MAX_AGE"] = int(os.environ.get("FEED_TOKEN_MAX_AGE", 43200))
+
+    # Evidence files (see evidence_store.py) are stored once per SHA-256
+    # under EVIDENCE_STORE_DIR, streamed to disk as they upload. Photos get
+    # EVIDENCE_THUMBNAIL_SIZE px thumbnails from EVIDENCE_THUMBNAIL_WORKERS
+    # background threads (0 disables them); resumable uploads left untouched
+    # for EVIDENCE_UPLOAD_TTL_HOURS are removed by `flask evidence-store gc`.
+    app.config["EVIDENCE_STORE_DIR"] = os.environ.get("EVIDENCE_STORE_DIR")
+    app.config["EVIDENCE_MAX_FILE_SIZE"] = int(os.environ.get("EVIDENCE_MAX_FILE_SIZE", 20 << 30))
+    app.config["EVIDENCE_THUMBNAIL_SIZE"] = int(os.environ.get("EVIDENCE_THUMBNAIL_SIZE", 256))
+    app.config["EVIDENCE_THUMBNAIL_WORKERS"] = int(os.environ.get("EVIDENCE_THUMBNAIL_WORKERS", 2))
+    app.config["EVIDENCE_UPLOAD_TTL_HOURS"] = int(os.environ.get("EVIDENCE_UPLOAD_TTL_HOURS", 24))
+
+    # Case queues and officer workloads (see case_queues.py) are held in
+    # memory, pick up cases changed by other workers every CASE_QUEUE_REFRESH
+    # seconds and are rebuilt every CASE_QUEUE_REBUILD.
+    app.config["CASE_QUEUE_REFRESH"] = int(os.environ.get("CASE_QUEUE_REFRESH", 15))
+    app.config["CASE_QUEUE_REBUILD"] = int(os.environ.get("CASE_QUEUE_REBUILD", 3600))
+
+    # Audit trail (see audit.py). AUDIT_MODE "sync" writes events in the
+    # committing transaction; "async" batches them (AUDIT_BATCH_SIZE events or
+    # every AUDIT_FLUSH_INTERVAL seconds) from a background thread; "log" also
+    # fsyncs them to segment files in AUDIT_LOG_DIR first, so a crash loses
+    # nothing; "off" disables auditing.
+    app.config["AUDIT_MODE"] = os.environ.get("AUDIT_MODE", "async")
+    app.config["AUDIT_BATCH_SIZE"] = int(os.environ.get("AUDIT_BATCH_SIZE", 500))
+    app.config["AUDIT_FLUSH_INTERVAL"] = float(os.environ.get("AUDIT_FLUSH_INTERVAL", 0.5))
+    app.config["AUDIT_LOG_DIR"] = os.environ.get("AUDIT_LOG_DIR")
+    app.config["AUDIT_PARTITION_ROWS"] = int(os.environ.get("AUDIT_PARTITION_ROWS", 10000000))
+
+    if config:
+        app.config.update(config)
+
+    db_routing.configure(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    # Import models and routes once the extensions exist
+    import models
+    import routes
+    import search
+    import rollups
+    import geo
+    import user_cache
+    import passwords
+    import dossier
+    import instrumentation
+    import name_search
+    import sessions
+    import oauth_tokens
+    import counters
+    import exports
+    import co_offenders
+    import hotspots
+    import audit
+    import rate_limits
+    import case_queues
+    import stations
+    import evidence_store
+    import fragments
+    import live_feed
+
+    instrumentation.init_app(app)
+    db_routing.init_app(app)
+    routes.init_app(app)
+    user_cache.init_app(app)
+    passwords.init_app(app)
+    rate_limits.init_app(app)
+    search.init_app(app)
+    rollups.init_app(app)
+    geo.init_app(app)
+    dossier.init_app(app)
+    name_search.init_app(app)
+    sessions.init_app(app)
+    oauth_tokens.init_app(app)
+    counters.init_app(app)
+    exports.init_app(app)
+    co_offenders.init_app(app)
+    hotspots.init_app(app)
+    audit.init_app(app)
+    case_queues.init_app(app)
+    stations.init_app(app)
+    evidence_store.init_app(app)
+    fragments.init_app(app)
+    live_feed.init_app(app)
+
+    # Replit sign-in pulls in flask_dance and oauthlib; only load it when configured
+    if os.environ.get("REPL_ID"):
+        import r_auth
+        r_auth.init_app(app)
+
+    return app
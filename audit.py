@@ -0,0 +1,434 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+
+import click
+from flask import current_app, g, has_request_context
+from flask.cli import with_appcontext
+from sqlalchemy import DDL, event, inspect, insert, select, text
+from sqlalchemy.exc import NoInspectionAvailable
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateTable
+
+from app import db
+from models import (User, Criminal, Crime, CriminalCrime, Case, CaseNote, Victim, Witness, Evidence,
+                    EvidenceFile, AuditEvent)
+from change_tracking import track_previous
+
+# Models whose inserts, updates and deletes are recorded
+AUDITED = (User, Criminal, Crime, CriminalCrime, Case, CaseNote, Victim, Witness, Evidence, EvidenceFile)
+
+# Columns never recorded: timestamps the event carries anyway, derived
+# values and secrets
+EXCLUDED = {'created_at', 'updated_at', 'geohash', 'password_hash'}
+
+# Ids per PostgreSQL partition of audit_events
+DEFAULT_PARTITION_ROWS = 10000000
+
+logger = logging.getLogger(__name__)
+
+_audited_types = {model: model.__tablename__ for model in AUDITED}
+_pending_key = 'audit_events'
+
+
+# An update records what it replaced, even for attributes expired by a commit
+for _model in AUDITED:
+    track_previous(*(getattr(_model, column.key) for column in _model.__table__.columns
+                     if column.key not in EXCLUDED))
+
+# PostgreSQL: PARTITION BY from the table's info. The postgresql_partition_by
+# table option would do the same, but declaring it imports the whole dialect
+# package when models.py loads.
+@compiles(CreateTable, 'postgresql')
+def _create_partitioned_table(element, compiler, **kw):
+    statement = compiler.visit_create_table(element, **kw)
+    partition_by = element.element.info.get('partition_by')
+    return f"{statement.rstrip()} PARTITION BY {partition_by}\n\n" if partition_by else statement
+
+
+# PostgreSQL: the first partition, a default partition so inserts never
+# fail, and a trigger that rejects updates and deletes
+for _ddl in (
+    f"CREATE TABLE IF NOT EXISTS audit_events_p0 PARTITION OF audit_events "
+    f"FOR VALUES FROM (0) TO ({DEFAULT_PARTITION_ROWS})",
+    "CREATE TABLE IF NOT EXISTS audit_events_default PARTITION OF audit_events DEFAULT",
+    "CREATE OR REPLACE FUNCTION audit_events_append_only() RETURNS trigger AS $$ "
+    "BEGIN RAISE EXCEPTION 'audit_events is append-only'; END $$ LANGUAGE plpgsql",
+    "CREATE TRIGGER audit_events_append_only BEFORE UPDATE OR DELETE ON audit_events "
+    "FOR EACH ROW EXECUTE FUNCTION audit_events_append_only()",
+):
+    event.listen(AuditEvent.__table__, 'after_create', DDL(_ddl).execute_if(dialect='postgresql'))
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def _changes(state, action):
+    changes = {}
+    for column in state.mapper.column_attrs:
+        key = column.key
+        if key in EXCLUDED:
+            continue
+        if action == 'update':
+            history = state.attrs[key].history
+            if not history.has_changes():
+                continue
+            old = history.deleted[0] if history.deleted else None
+            new = history.added[0] if history.added else None
+            if old != new:
+                changes[key] = [_jsonable(old), _jsonable(new)]
+        else:
+            value = state.dict.get(key)
+            if value is not None:
+                changes[key] = [None, _jsonable(value)] if action == 'insert' else [_jsonable(value), None]
+    return changes
+
+
+def _actor():
+    # The user Flask-Login already loaded for this request; never triggers a query
+    user = g.get('_login_user') if has_request_context() else None
+    try:
+        identity = inspect(user).identity if user is not None else None
+    except NoInspectionAvailable:
+        return None
+    return identity[0] if identity else None
+
+
+def _collect(session):
+    now = datetime.utcnow()
+    user_id = _actor()
+    events = []
+    for objects, action in ((session.new, 'insert'), (session.dirty, 'update'), (session.deleted, 'delete')):
+        for obj in objects:
+            entity_type = _audited_types.get(type(obj))
+            if entity_type is None or (action == 'update' and not session.is_modified(obj)):
+                continue
+            state = inspect(obj)
+            changes = _changes(state, action)
+            if changes:
+                # New rows get their identity key only after the flush
+                entity_id = state.mapper.primary_key_from_instance(obj)[0]
+                events.append({'entity_type': entity_type, 'entity_id': entity_id, 'action': action,
+                               'changes': changes, 'user_id': user_id, 'created_at': now})
+    return events
+
+
+class SegmentLog:
+    """Append-only JSON-lines files, fsynced before a commit's events are
+    queued. Each file is locked by the process writing it and deleted once
+    all its events are in the database; files left by a process that died
+    are replayed by the next one."""
+
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        # [path, handle, events written, events shipped], oldest first
+        self.segments = deque()
+        os.makedirs(directory, exist_ok=True)
+        self._open_segment()
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f'audit-{os.getpid()}-{time.time_ns()}.log')
+        handle = open(path, 'ab')
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.segments.append([path, handle, 0, 0])
+
+    def append(self, events):
+        segment = self.segments[-1]
+        handle = segment[1]
+        handle.write(b''.join(json.dumps(dict(event, created_at=event['created_at'].isoformat()),
+                                         separators=(',', ':')).encode() + b'\n' for event in events))
+        handle.flush()
+        os.fsync(handle.fileno())
+        segment[2] += len(events)
+        if handle.tell() >= self.segment_bytes:
+            self._open_segment()
+
+    def shipped(self, count):
+        """Mark the oldest ``count`` events as written to the database."""
+        while count and self.segments:
+            segment = self.segments[0]
+            done = min(count, segment[2] - segment[3])
+            segment[3] += done
+            count -= done
+            if segment[3] < segment[2] or len(self.segments) == 1:
+                break
+            self.segments.popleft()
+            segment[1].close()
+            os.remove(segment[0])
+
+    def close(self):
+        """Close the segments, deleting those whose events are all written."""
+        while self.segments:
+            path, handle, written, shipped = self.segments.popleft()
+            handle.close()
+            if shipped == written:
+                os.remove(path)
+
+    @staticmethod
+    def orphans(directory):
+        """Open handles of segments no live process holds, oldest first,
+        each with its lock held."""
+        if not os.path.isdir(directory):
+            return []
+        found = []
+        for name in sorted(os.listdir(directory), key=lambda name: name.rsplit('-', 1)[-1]):
+            if not name.startswith('audit-'):
+                continue
+            handle = open(os.path.join(directory, name), 'rb')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue
+            found.append(handle)
+        return found
+
+
+class AuditWriter:
+    """Buffers committed audit events and writes them in batches.
+
+    ``mode`` picks the durability:
+
+    - ``sync``: one multi-row insert per flush, in the same transaction as
+      the change; nothing is ever lost, at the cost of that insert
+    - ``async``: events are written by a background thread every
+      ``interval`` seconds or ``batch_size`` events; a crash loses at most
+      the unwritten buffer
+    - ``log``: as ``async``, but each commit's events are first fsynced to
+      a segment file, which is replayed if the process dies
+    - ``off``: nothing is recorded
+    """
+
+    def __init__(self, mode='async', batch_size=500, interval=0.5, log_dir=None,
+                 segment_bytes=64 * 1024 * 1024):
+        self.mode = mode
+        self.batch_size = batch_size
+        self.interval = interval
+        self.log_dir = log_dir
+        self.segment_bytes = segment_bytes
+        self.written = 0
+        self._buffer = []
+        self._log = None
+        self._pid = None
+        self._app = None
+        self._ready = threading.Condition()
+        self._write_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Started on first use, and again after a fork
+        if self._pid == os.getpid():
+            return
+        with self._ready:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._app = current_app._get_current_object()
+            self._buffer = []
+            if self.mode == 'log':
+                self._log = SegmentLog(self.log_dir, self.segment_bytes)
+            threading.Thread(target=self._run, name='audit-writer', daemon=True).start()
+            atexit.register(self._flush_at_exit)
+
+    def submit(self, events):
+        """Queue committed events for writing."""
+        self._ensure_started()
+        with self._ready:
+            if self._log is not None:
+                self._log.append(events)
+            self._buffer.extend(events)
+            if len(self._buffer) >= self.batch_size:
+                self._ready.notify()
+
+    def write(self, connection, events):
+        connection.execute(insert(AuditEvent.__table__), events)
+
+    def flush(self):
+        """Write everything buffered now; returns the number of events written."""
+        with self._write_lock:
+            with self._ready:
+                batch, self._buffer = self._buffer, []
+            done = 0
+            try:
+                while done < len(batch):
+                    chunk = batch[done:done + self.batch_size]
+                    with db.engine.begin() as connection:
+                        self.write(connection, chunk)
+                    done += len(chunk)
+                    self.written += len(chunk)
+                    if self._log is not None:
+                        self._log.shipped(len(chunk))
+            except Exception:
+                # Keep what was not written, in order, for the next attempt
+                with self._ready:
+                    self._buffer[:0] = batch[done:]
+                raise
+            return done
+
+    def replay(self):
+        """Write events from segments left behind by dead processes."""
+        replayed = 0
+        for handle in SegmentLog.orphans(self.log_dir):
+            with handle:
+                events = [json.loads(line) for line in handle if line.strip()]
+                for event_ in events:
+                    event_['created_at'] = datetime.fromisoformat(event_['created_at'])
+                for start in range(0, len(events), self.batch_size):
+                    with db.engine.begin() as connection:
+                        self.write(connection, events[start:start + self.batch_size])
+                os.remove(handle.name)
+            replayed += len(events)
+        return replayed
+
+    def _run(self):
+        with self._app.app_context():
+            if self.mode == 'log':
+                try:
+                    replayed = self.replay()
+                    if replayed:
+                        logger.warning('Replayed %d audit events from %s', replayed, self.log_dir)
+                except Exception:
+                    logger.exception('Audit log replay failed')
+            while True:
+                with self._ready:
+                    if len(self._buffer) < self.batch_size:
+                        self._ready.wait(self.interval)
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Writing audit events failed; retrying')
+                    time.sleep(self.interval)
+
+    def _flush_at_exit(self):
+        if self._pid == os.getpid() and self._app is not None:
+            with self._app.app_context():
+                self.flush()
+            if self._log is not None:
+                self._log.close()
+
+
+# Replaced by init_app according to the application config
+writer = AuditWriter()
+
+
+@event.listens_for(db.session, 'after_flush')
+def _capture_changes(session, flush_context):
+    if writer.mode == 'off':
+        return
+    events = _collect(session)
+    if not events:
+        return
+    if writer.mode == 'sync':
+        writer.write(session.connection(), events)
+    else:
+        session.info.setdefault(_pending_key, []).extend(events)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _queue_changes(session):
+    events = session.info.pop(_pending_key, None)
+    if events:
+        writer.submit(events)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop(_pending_key, None)
+
+
+def history(entity_type, entity_id, limit=50, before_id=None):
+    """Audit events of one record, newest first, read from the entity index."""
+    if writer.mode != 'sync':
+        # Include this process's events that are still buffered
+        writer.flush()
+    query = select(AuditEvent).where(AuditEvent.entity_type == entity_type, AuditEvent.entity_id == entity_id)
+    if before_id is not None:
+        query = query.where(AuditEvent.id < before_id)
+    return db.session.scalars(query.order_by(AuditEvent.id.desc()).limit(limit)).all()
+
+
+def audited_types():
+    return set(_audited_types.values())
+
+
+@click.group('audit')
+def audit_cli():
+    """Audit trail maintenance."""
+
+
+@audit_cli.command('flush')
+@with_appcontext
+def flush_command():
+    """Replay orphaned log segments and write this process's buffer."""
+    replayed = writer.replay() if writer.log_dir else 0
+    click.echo(f'Replayed {replayed} logged events, wrote {writer.flush()} buffered events')
+
+
+@audit_cli.command('partitions')
+@click.option('--ahead', default=2, show_default=True, help='Empty partitions to keep ahead of the newest id.')
+@with_appcontext
+def partitions_command(ahead):
+    """Create the next id-range partitions of audit_events (PostgreSQL).
+
+    Run periodically: rows past the last partition go to the default one,
+    which then blocks creating a partition for their range.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException('audit_events is only partitioned on PostgreSQL')
+    size = current_app.config.get('AUDIT_PARTITION_ROWS', DEFAULT_PARTITION_ROWS)
+    newest = db.session.execute(select(db.func.coalesce(db.func.max(AuditEvent.id), 0))).scalar()
+    for number in range(newest // size + ahead + 1):
+        db.session.execute(text(
+            f'CREATE TABLE IF NOT EXISTS audit_events_p{number} PARTITION OF audit_events '
+            f'FOR VALUES FROM ({number * size}) TO ({(number + 1) * size})'))
+    db.session.commit()
+    click.echo(f'Partitions of {size} ids exist up to id {(newest // size + ahead + 1) * size}')
+
+
+@audit_cli.command('bench')
+@click.option('--updates', default=300, show_default=True, help='Committed updates per mode.')
+@with_appcontext
+def bench_command(updates):
+    """Commit latency of single-row updates with each audit mode."""
+    global writer
+    evidence = Evidence.query.first()
+    if evidence is None:
+        raise click.ClickException('Seed some evidence first (flask bench-seed)')
+    configured = writer
+    log_dir = os.path.join(current_app.instance_path, 'audit-bench')
+    try:
+        for mode in ('off', 'sync', 'async', 'log'):
+            writer = AuditWriter(mode=mode, batch_size=configured.batch_size, interval=configured.interval,
+                                 log_dir=log_dir)
+            started = time.perf_counter()
+            for index in range(updates):
+                evidence.custodian = f'Officer {mode} {index}'
+                db.session.commit()
+            elapsed = time.perf_counter() - started
+            writer.flush()
+            click.echo(f'{mode:<6} {elapsed / updates * 1000:7.3f} ms/commit')
+    finally:
+        writer = configured
+
+
+def init_app(app):
+    global writer
+    writer = AuditWriter(
+        mode=app.config.get('AUDIT_MODE', 'async'),
+        batch_size=app.config.get('AUDIT_BATCH_SIZE', 500),
+        interval=app.config.get('AUDIT_FLUSH_INTERVAL', 0.5),
+        log_dir=app.config.get('AUDIT_LOG_DIR') or os.path.join(app.instance_path, 'audit-log'),
+        segment_bytes=app.config.get('AUDIT_SEGMENT_BYTES', 64 * 1024 * 1024),
+    )
+    app.cli.add_command(audit_cli)
@@ -1,59 +0,0 @@
-from flask import Flask, render_template, redirect, url_for, flash, request
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
-
-# Initialize extensions
-db = SQLAlchemy()
-login_manager = LoginManager()
-
-# User model
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(64), unique=True, nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(256), nullable=False)
-    role = db.Column(db.String(20), default='user')  # 'admin', 'user', etc.
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    
-    def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
-        
-    def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
-    
-    def is_admin(self):
-        return self.role == 'admin'
-    
-    def __repr__(self):
-        return f'<User {self.username}>'
-
-
-def init_app(app):
-    """Initialize the authentication components with the Flask app"""
-    # Initialize extensions
-    db.init_app(app)
-    login_manager.init_app(app)
-    login_manager.login_view = 'login'
-    
-    # Set up user loader
-    @login_manager.user_loader
-    def load_user(user_id):
-        return User.query.get(int(user_id))
-    
-    # Create database tables (if they don't exist)
-    with app.app_context():
-        db.create_all()
-        
-        # Create an admin user if none exists
-        if not User.query.filter_by(role='admin').first():
-            admin = User(
-                username='admin',
-                email='admin@example.com',
-                role='admin'
-            )
-            admin.set_password('admin123')  # Set a default password
-            db.session.add(admin)
-            db.session.commit()
-            print("Created default admin user: admin/admin123")
\ No newline at end of file
@@ -0,0 +1,332 @@
+import sys
+import json
+import time
+import random
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash
+
+from app import db
+from models import (User, PoliceStation, PoliceOfficer, Criminal, Crime, CriminalCrime,
+                    Case, CaseNote, Victim, Witness, Evidence)
+from geo import geohash_encode
+from instrumentation import count_queries
+from rollups import rebuild_map_cells, rebuild_rollups
+from counters import rebuild_counters
+import rate_limits
+
+# Rows seeded per unit of --scale
+SCALE = {
+    'users': 20, 'stations': 5, 'officers': 50, 'criminals': 1000, 'crimes': 5000,
+    'links': 4000, 'victims': 4000, 'witnesses': 3000, 'evidence': 3000,
+    'cases': 1000, 'notes': 3000,
+}
+
+# Password of every seeded user
+BENCH_PASSWORD = 'benchmark-password'
+
+CRIME_TYPES = ['Theft', 'Burglary', 'Assault', 'Fraud', 'Vandalism', 'Robbery', 'Arson', 'Homicide']
+CRIME_STATUSES = ['reported', 'investigating', 'solved', 'closed']
+CASE_STATUSES = ['open', 'investigating', 'closed']
+PRIORITIES = ['low', 'medium', 'high']
+
+
+def _insert(model, rows, batch_size=5000):
+    table = model.__table__
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[start:start + batch_size])
+
+
+def _max_id(model):
+    return db.session.query(db.func.coalesce(db.func.max(model.id), 0)).scalar()
+
+
+def seed(scale, seed_value=0):
+    """Insert a synthetic dataset of ``scale`` units; returns row counts."""
+    rng = random.Random(seed_value)
+    counts = {name: max(1, int(per_unit * scale)) for name, per_unit in SCALE.items()}
+    now = datetime.utcnow()
+    stamp = {'created_at': now, 'updated_at': now}
+    pwhash = generate_password_hash(BENCH_PASSWORD, 'pbkdf2:sha256:1000')
+
+    first_user = _max_id(User) + 1
+    roles = ['officer', 'analyst', 'admin']
+    _insert(User, [dict(username=f'bench{first_user + i}', email=f'bench{first_user + i}@example.com',
+                        password_hash=pwhash, role=roles[i % 3] if i else 'admin', active=True, **stamp)
+                   for i in range(counts['users'])])
+    user_ids = list(range(first_user, first_user + counts['users']))
+
+    first_station = _max_id(PoliceStation) + 1
+    _insert(PoliceStation, [dict(name=f'Station {i}', address=f'{i} Precinct Road', contact='555-0100',
+                                 latitude=40.6 + rng.random() * 0.3, longitude=-74.1 + rng.random() * 0.3, **stamp)
+                            for i in range(counts['stations'])])
+    first_officer = _max_id(PoliceOfficer) + 1
+    _insert(PoliceOfficer, [dict(name=f'Officer {i}', rank='Constable', badge_number=f'B{first_officer + i}',
+                                 user_id=str(rng.choice(user_ids)),
+                                 station_id=first_station + rng.randrange(counts['stations']), **stamp)
+                            for i in range(counts['officers'])])
+
+    first_criminal = _max_id(Criminal) + 1
+    _insert(Criminal, [dict(name=f'Criminal {first_criminal + i}', alias=f'alias{i}', gender=rng.choice(['male', 'female']),
+                            date_of_birth=date(1950, 1, 1) + timedelta(days=rng.randrange(18000)), **stamp)
+                       for i in range(counts['criminals'])])
+
+    first_crime = _max_id(Crime) + 1
+    crimes = []
+    for i in range(counts['crimes']):
+        lat, lng = 40.5 + rng.random() * 0.4, -74.2 + rng.random() * 0.4
+        crimes.append(dict(type=rng.choice(CRIME_TYPES), description=f'Synthetic incident {i}',
+                           date=date(2015, 1, 1) + timedelta(days=rng.randrange(3650)),
+                           location=f'District {rng.randrange(40)}', latitude=lat, longitude=lng,
+                           geohash=geohash_encode(lat, lng), status=rng.choice(CRIME_STATUSES), **stamp))
+    _insert(Crime, crimes)
+    crime_ids = range(first_crime, first_crime + counts['crimes'])
+
+    _insert(CriminalCrime, [dict(criminal_id=first_criminal + rng.randrange(counts['criminals']),
+                                 crime_id=rng.choice(crime_ids), role='suspect', created_at=now)
+                            for _ in range(counts['links'])])
+    for model, key in ((Victim, 'victims'), (Witness, 'witnesses')):
+        _insert(model, [dict(name=f'Person {i}', crime_id=rng.choice(crime_ids), **stamp)
+                        for i in range(counts[key])])
+    _insert(Evidence, [dict(name=f'Item {i}', type='physical', crime_id=rng.choice(crime_ids), **stamp)
+                       for i in range(counts['evidence'])])
+
+    first_case = _max_id(Case) + 1
+    _insert(Case, [dict(title=f'Case {first_case + i}', status=rng.choice(CASE_STATUSES),
+                        priority=rng.choice(PRIORITIES), crime_id=rng.choice(crime_ids),
+                        officer_id=str(rng.choice(user_ids)), **stamp)
+                   for i in range(counts['cases'])])
+    _insert(CaseNote, [dict(case_id=first_case + rng.randrange(counts['cases']), user_id=str(rng.choice(user_ids)),
+                            content=f'Progress note {i}', **stamp)
+                       for i in range(counts['notes'])])
+    db.session.commit()
+    rebuild_rollups()
+    rebuild_map_cells()
+    rebuild_counters()
+    return counts
+
+
+def _routes(rng):
+    """Scenario name -> (method, URL factory, needs login)."""
+    crime_max, case_max = _max_id(Crime), _max_id(Case)
+    return {
+        'index': ('GET', lambda: '/', False),
+        'login': ('POST', lambda: '/login', False),
+        'dashboard': ('GET', lambda: '/dashboard', True),
+        'register': ('GET', lambda: '/register', True),
+        'crime_list': ('GET', lambda: f'/crimes?crime_type={rng.choice(CRIME_TYPES)}', True),
+        'crime_search': ('GET', lambda: '/crimes?search_term=incident', True),
+        'view_crime': ('GET', lambda: f'/crimes/{rng.randint(1, crime_max)}', True),
+        'view_case': ('GET', lambda: f'/cases/{rng.randint(1, case_max)}', True),
+        'crime_statistics': ('GET', lambda: '/reports/statistics?start_date=2015-01-01&end_date=2024-12-31', True),
+        'crime_map_clusters': ('GET', lambda: '/api/crime_data?bbox=-74.3,40.4,-73.7,41.0&zoom=10', True),
+        'crime_map_points': ('GET', lambda: '/api/crime_data?bbox=-74.01,40.70,-73.99,40.72&zoom=16', True),
+    }
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(requests_per_route, selected=None, warmup=5, seed_value=0):
+    """Drive each route through the WSGI test client; returns per-route results."""
+    app = current_app._get_current_object()
+    app.config['WTF_CSRF_ENABLED'] = False
+    rng = random.Random(seed_value)
+    admin = User.query.filter_by(role='admin').order_by(User.id.desc()).first()
+    routes = {name: route for name, route in _routes(rng).items() if not selected or name in selected}
+    engine = db.engine
+    # Requests made while an app context is active reuse it, sharing g and
+    # the session identity map between requests. Measure from a thread with
+    # no context so every request is as cold as it would be in production.
+    # The login scenario signs in hundreds of times from one address; the
+    # limiter's own cost is timed by `flask rate-limit bench`
+    configured, rate_limits.limiter = rate_limits.limiter, None
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(_measure, app, engine, routes, admin.id, admin.username,
+                                   requests_per_route, warmup).result()
+    finally:
+        rate_limits.limiter = configured
+
+
+def _measure(app, engine, routes, admin_id, admin_username, requests_per_route, warmup):
+    results = {}
+    for name, (method, url, needs_login) in routes.items():
+        client = app.test_client()
+        if needs_login:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(admin_id)
+                session['_fresh'] = True
+        login_form = {'username': admin_username, 'password': BENCH_PASSWORD}
+        timings, queries, statuses = [], 0, {}
+        for iteration in range(warmup + requests_per_route):
+            if method == 'POST':
+                client = app.test_client()
+            with count_queries(engine) as counter:
+                started = time.perf_counter()
+                response = client.open(url(), method=method, data=login_form if method == 'POST' else None)
+                response.get_data()
+                elapsed = time.perf_counter() - started
+            response.close()
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            if not 200 <= response.status_code < 400:
+                # Timing error pages would only describe the error handler
+                break
+            if iteration < warmup:
+                continue
+            timings.append(elapsed)
+            queries += counter[0]
+        if len(timings) < requests_per_route:
+            results[name] = {'failed': True, 'statuses': statuses}
+            continue
+        timings.sort()
+        total = sum(timings)
+        results[name] = {
+            'requests': len(timings),
+            'statuses': statuses,
+            'p50_ms': round(_percentile(timings, 0.50) * 1000, 3),
+            'p95_ms': round(_percentile(timings, 0.95) * 1000, 3),
+            'p99_ms': round(_percentile(timings, 0.99) * 1000, 3),
+            'mean_ms': round(total / len(timings) * 1000, 3),
+            'throughput_rps': round(len(timings) / total, 1) if total else 0.0,
+            'queries_per_request': round(queries / len(timings), 2),
+        }
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command('bench-seed')
+@click.option('--scale', default=1.0, show_default=True,
+              help='Dataset size multiplier; 1.0 is 5,000 crimes and 1,000 cases.')
+@click.option('--seed', 'seed_value', default=0, show_default=True)
+@with_appcontext
+def bench_seed_command(scale, seed_value):
+    """Seed a synthetic dataset for benchmarking."""
+    started = time.perf_counter()
+    counts = seed(scale, seed_value)
+    summary = ', '.join(f'{count} {name}' for name, count in counts.items())
+    click.echo(f'Seeded {summary} in {time.perf_counter() - started:.1f}s')
+
+
+@click.command('bench-run')
+@click.option('--requests', 'requests_per_route', default=200, show_default=True)
+@click.option('--route', 'routes', multiple=True, help='Limit to these scenarios (repeatable).')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write results as JSON to this file.')
+@with_appcontext
+def bench_run_command(requests_per_route, routes, output):
+    """Measure latency, throughput and queries per request for core routes."""
+    results = run(requests_per_route, selected=set(routes))
+    click.echo(f'{"route":<20} {"p50":>8} {"p95":>8} {"p99":>8} {"req/s":>8} {"q/req":>6}  statuses')
+    failed = [name for name, result in results.items() if result.get('failed')]
+    for name, result in results.items():
+        if result.get('failed'):
+            click.echo(f'{name:<20} {"FAILED":>8} {"":>8} {"":>8} {"":>8} {"":>6}  {result["statuses"]}')
+            continue
+        click.echo(f'{name:<20} {result["p50_ms"]:>8.2f} {result["p95_ms"]:>8.2f} {result["p99_ms"]:>8.2f} '
+                   f'{result["throughput_rps"]:>8.1f} {result["queries_per_request"]:>6.1f}  {result["statuses"]}')
+    if failed:
+        # A report with error pages in it is not a baseline anyone should compare against
+        click.echo(f'Non-2xx/3xx responses from {", ".join(failed)}; no report written', err=True)
+        raise SystemExit(1)
+    if output:
+        report = {
+            'revision': _git_revision(),
+            'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+            'database': db.engine.dialect.name,
+            'rows': {'crimes': _max_id(Crime), 'cases': _max_id(Case), 'users': _max_id(User)},
+            'routes': results,
+        }
+        with open(output, 'w') as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+        click.echo(f'Wrote {output}')
+
+
+@click.command('bench-compare')
+@click.argument('baseline', type=click.File())
+@click.argument('candidate', type=click.File())
+@click.option('--threshold', default=10.0, show_default=True, help='Regression threshold in percent.')
+def bench_compare_command(baseline, candidate, threshold):
+    """Diff two bench-run JSON reports; exits non-zero on regressions."""
+    before, after = json.load(baseline), json.load(candidate)
+    regressions = 0
+    click.echo(f'{before.get("revision")} -> {after.get("revision")}')
+    for name, new in after['routes'].items():
+        old = before['routes'].get(name)
+        if old is None:
+            click.echo(f'{name:<20} new route')
+            continue
+        parts = []
+        for metric in ('p50_ms', 'p95_ms', 'queries_per_request'):
+            change = (new[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0.0
+            flag = ''
+            if change > threshold:
+                flag = ' !'
+                regressions += 1
+            parts.append(f'{metric} {old[metric]:g} -> {new[metric]:g} ({change:+.1f}%){flag}')
+        click.echo(f'{name:<20} ' + ', '.join(parts))
+    if regressions:
+        raise SystemExit(1)
+
+
+# Run in a fresh interpreter: time to import the framework, to a ready app
+# (framework included), and to the first response
+_STARTUP_PROBE = """
+import time
+started = time.perf_counter()
+import flask, flask_sqlalchemy, flask_login, flask_wtf
+framework = time.perf_counter() - started
+from app import create_app
+app = create_app()
+ready = time.perf_counter() - started
+started = time.perf_counter()
+status = app.test_client().get('/login').status_code
+print(framework, ready, time.perf_counter() - started, status)
+"""
+
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+
+@click.command('bench-startup')
+@click.option('--runs', default=5, show_default=True)
+@click.option('--budget-ms', default=300.0, show_default=True,
+              help='Fail when the median time to a ready app exceeds this.')
+@with_appcontext
+def bench_startup_command(runs, budget_ms):
+    """Time a cold worker start (imports and create_app) in fresh interpreters."""
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _STARTUP_PROBE], cwd=current_app.root_path,
+                                capture_output=True, text=True, check=True).stdout
+        *timings, status = output.split()[-4:]
+        samples.append([float(value) * 1000 for value in timings])
+    framework, ready, first = (_median(column) for column in zip(*samples))
+    click.echo(f'framework imports: {framework:.0f} ms')
+    click.echo(f'ready:             {ready:.0f} ms (app code {ready - framework:.0f} ms, budget {budget_ms:.0f} ms)')
+    click.echo(f'first request:     {first:.0f} ms (GET /login -> {status})')
+    if ready > budget_ms:
+        raise SystemExit(1)
+
+
+def init_app(app):
+    app.cli.add_command(bench_seed_command)
+    app.cli.add_command(bench_run_command)
+    app.cli.add_command(bench_compare_command)
+    app.cli.add_command(bench_startup_command)
@@ -0,0 +1,48 @@
+import logging
+
+import click
+from flask.cli import with_appcontext
+
+from app import db
+from models import User
+import migrations
+
+
+def create_schema():
+    """Create the schema, or apply pending migrations to an existing one."""
+    return migrations.upgrade()
+
+
+def ensure_admin(username='admin', password='password', email='admin@example.com'):
+    """Create an admin user unless one exists; returns the new user or None."""
+    if User.query.filter_by(role='admin').first():
+        return None
+    admin = User(username=username, email=email, role='admin')
+    admin.set_password(password)
+    db.session.add(admin)
+    db.session.commit()
+    logging.info("Created default admin user: %s", username)
+    return admin
+
+
+@click.command('init-db')
+@click.option('--admin-username', default='admin', show_default=True)
+@click.option('--admin-password', default='password', show_default=True,
+              help='Only used when no admin exists yet; change it after first login.')
+@click.option('--admin-email', default='admin@example.com', show_default=True)
+@click.option('--no-admin', is_flag=True, help='Create the schema only.')
+@with_appcontext
+def init_db_command(admin_username, admin_password, admin_email, no_admin):
+    """Create or migrate the database schema and add the default admin user.
+
+    An existing admin user is left alone.
+    """
+    applied = create_schema()
+    if applied:
+        click.echo(f'Applied schema migrations: {", ".join(applied)}')
+    if not no_admin and ensure_admin(admin_username, admin_password, admin_email):
+        click.echo(f'Created admin user {admin_username!r}')
+
+
+def init_app(app):
+    app.cli.add_command(init_db_command)
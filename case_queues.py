@@ -0,0 +1,433 @@
+import time
+import heapq
+import random
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, select
+
+from app import db
+from models import User, PoliceOfficer, Case
+from counters import OPEN_CASE_STATUSES
+from change_tracking import CATCH_UP_MARGIN, catch_up_since
+
+# Queue order: higher priority first, then older cases
+PRIORITY_RANK = {'high': 0, 'medium': 1, 'low': 2}
+
+# Cases tried by one auto-assignment before giving up on stale entries
+ASSIGN_ATTEMPTS = 5
+
+
+def case_rank(case_id, priority, created_at):
+    created = created_at.timestamp() if created_at else 0.0
+    return PRIORITY_RANK.get(priority or 'medium', 1), created, case_id
+
+
+class CaseQueues:
+    """Open cases and officer workloads in memory.
+
+    Every queue is a binary heap: unassigned cases, the cases of each
+    officer, the cases held by each station's officers, and officers by
+    open-case count (overall and per station). Heaps are never searched;
+    a change pushes a fresh entry and stale ones are dropped when they
+    reach the top, so peeking and updating are O(log n) amortized. Heaps
+    are rebuilt once stale entries outnumber live ones.
+
+    Only officers (``role == 'officer'``, active) are offered for
+    assignment; their station comes from ``police_officers.user_id``.
+    """
+
+    def __init__(self, cases=(), officers=()):
+        self._lock = threading.RLock()
+        self.watermark = None
+        self.refreshed = self.built = 0.0
+        self.officers_stale = False
+        # case id -> (rank, officer id or None), open cases only
+        self._cases = {}
+        # officer id -> open cases, for every user holding one
+        self._load = defaultdict(int)
+        # officer id -> station id (or None), assignable officers only
+        self._station = {}
+        self._pushes = 0
+        for case_id, priority, created_at, officer_id in cases:
+            rank = case_rank(case_id, priority, created_at)
+            self._cases[case_id] = (rank, officer_id)
+            if officer_id is not None:
+                self._load[officer_id] += 1
+        self.set_officers(officers)
+
+    def __len__(self):
+        return len(self._cases)
+
+    def _rebuild_heaps(self):
+        self._unassigned = []
+        self._by_officer = defaultdict(list)
+        self._by_station = defaultdict(list)
+        for case_id, (rank, officer_id) in self._cases.items():
+            if officer_id is None:
+                self._unassigned.append((rank, case_id))
+            else:
+                self._by_officer[officer_id].append((rank, case_id))
+                if officer_id in self._station:
+                    self._by_station[self._station[officer_id]].append((rank, case_id))
+        # Key None holds every assignable officer
+        self._least_loaded = defaultdict(list)
+        for officer_id, station_id in self._station.items():
+            entry = (self._load.get(officer_id, 0), officer_id)
+            self._least_loaded[None].append(entry)
+            if station_id is not None:
+                self._least_loaded[station_id].append(entry)
+        for heap in (self._unassigned, *self._by_officer.values(), *self._by_station.values(),
+                     *self._least_loaded.values()):
+            heapq.heapify(heap)
+        self._pushes = 0
+
+    def set_officers(self, officers):
+        """Replace the assignable officers with ``(officer id, station id)`` pairs."""
+        with self._lock:
+            self._station = dict(officers)
+            self.officers_stale = False
+            self._rebuild_heaps()
+
+    def _push(self, heap, entry):
+        heapq.heappush(heap, entry)
+        self._pushes += 1
+        if self._pushes > len(self._cases) + 2 * len(self._station) + 1024:
+            self._rebuild_heaps()
+
+    def _push_load(self, officer_id):
+        if officer_id in self._station:
+            entry = (self._load.get(officer_id, 0), officer_id)
+            self._push(self._least_loaded[None], entry)
+            if self._station[officer_id] is not None:
+                self._push(self._least_loaded[self._station[officer_id]], entry)
+
+    def update(self, case_id, status, priority, created_at, officer_id):
+        """Apply a case as it now is; pass ``status=None`` for a deleted case."""
+        with self._lock:
+            old = self._cases.get(case_id)
+            new = None
+            if status in OPEN_CASE_STATUSES:
+                new = (case_rank(case_id, priority, created_at), officer_id)
+            if old == new:
+                return
+            if old is not None:
+                del self._cases[case_id]
+                if old[1] is not None:
+                    self._load[old[1]] -= 1
+                    if not self._load[old[1]]:
+                        del self._load[old[1]]
+                    self._push_load(old[1])
+            if new is None:
+                return
+            self._cases[case_id] = new
+            rank = new[0]
+            if officer_id is None:
+                self._push(self._unassigned, (rank, case_id))
+                return
+            self._load[officer_id] += 1
+            self._push(self._by_officer[officer_id], (rank, case_id))
+            if officer_id in self._station:
+                self._push(self._by_station[self._station[officer_id]], (rank, case_id))
+            self._push_load(officer_id)
+
+    def _top(self, heap, valid, limit):
+        # Pop until ``limit`` distinct live entries are found, then put those back
+        found, seen = [], set()
+        while heap and len(found) < limit:
+            entry = heapq.heappop(heap)
+            if entry not in seen and valid(entry):
+                seen.add(entry)
+                found.append(entry)
+        for entry in found:
+            heapq.heappush(heap, entry)
+        return found
+
+    def unassigned(self, limit=1):
+        """Ids of the highest-priority, oldest unassigned cases."""
+        with self._lock:
+            return [case_id for _, case_id in self._top(
+                self._unassigned, lambda entry: self._cases.get(entry[1]) == (entry[0], None), limit)]
+
+    def officer_queue(self, officer_id, limit=1):
+        """Ids of an officer's open cases, next first."""
+        with self._lock:
+            heap = self._by_officer.get(officer_id)
+            if not heap:
+                return []
+            return [case_id for _, case_id in self._top(
+                heap, lambda entry: self._cases.get(entry[1]) == (entry[0], officer_id), limit)]
+
+    def station_queue(self, station_id, limit=1):
+        """Ids of the open cases held by a station's officers, next first."""
+        def valid(entry):
+            current = self._cases.get(entry[1])
+            return (current is not None and current[0] == entry[0] and current[1] in self._station
+                    and self._station[current[1]] == station_id)
+
+        with self._lock:
+            heap = self._by_station.get(station_id)
+            return [case_id for _, case_id in self._top(heap, valid, limit)] if heap else []
+
+    def least_loaded(self, station_id=None, limit=1):
+        """``(officer id, open cases)`` of the least loaded officers."""
+        def valid(entry):
+            load, officer_id = entry
+            return (officer_id in self._station and self._load.get(officer_id, 0) == load
+                    and (station_id is None or self._station[officer_id] == station_id))
+
+        with self._lock:
+            heap = self._least_loaded.get(station_id)
+            return [(officer_id, load) for load, officer_id in self._top(heap, valid, limit)] if heap else []
+
+    def load(self, officer_id):
+        return self._load.get(officer_id, 0)
+
+    def stats(self):
+        with self._lock:
+            unassigned = sum(1 for _, officer_id in self._cases.values() if officer_id is None)
+            return {
+                'open_cases': len(self._cases),
+                'unassigned': unassigned,
+                'officers': len(self._station),
+                'stations': len({station for station in self._station.values() if station is not None}),
+                'heap_entries': (len(self._unassigned) + sum(map(len, self._by_officer.values()))
+                                 + sum(map(len, self._by_station.values()))
+                                 + sum(map(len, self._least_loaded.values()))),
+            }
+
+
+_queues = None
+_queues_lock = threading.Lock()
+_pending_key = 'case_queue_changes'
+
+
+def _officer_id(value):
+    # cases.officer_id is a string column holding users.id
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _officer_rows():
+    stations = {_officer_id(user_id): station_id for user_id, station_id
+                in db.session.query(PoliceOfficer.user_id, PoliceOfficer.station_id)
+                .filter(PoliceOfficer.user_id.isnot(None))}
+    return [(user_id, stations.get(user_id)) for (user_id,) in db.session.query(User.id).filter(
+        User.role == 'officer', User.active.isnot(False))]
+
+
+def build_queues():
+    rows = db.session.execute(
+        select(Case.id, Case.priority, Case.created_at, Case.officer_id)
+        .where(Case.status.in_(OPEN_CASE_STATUSES)).execution_options(yield_per=10000))
+    queues = CaseQueues(((case_id, priority, created_at, _officer_id(officer_id))
+                         for case_id, priority, created_at, officer_id in rows), _officer_rows())
+    queues.watermark = db.session.query(func.max(Case.updated_at)).scalar()
+    queues.refreshed = queues.built = time.monotonic()
+    return queues
+
+
+def _catch_up(queues, margin=CATCH_UP_MARGIN):
+    """Apply cases changed by other processes since the watermark."""
+    query = select(Case.id, Case.status, Case.priority, Case.created_at, Case.officer_id, Case.updated_at)
+    since = catch_up_since(queues.watermark, margin)
+    if since is not None:
+        query = query.where(Case.updated_at >= since)
+    for case_id, status, priority, created_at, officer_id, updated_at in db.session.execute(query):
+        queues.update(case_id, status, priority, created_at, _officer_id(officer_id))
+        if updated_at is not None and (queues.watermark is None or updated_at > queues.watermark):
+            queues.watermark = updated_at
+    queues.refreshed = time.monotonic()
+
+
+def get_queues():
+    """The process-wide queues, built on first use and kept current.
+
+    Cases changed by other processes are picked up every
+    ``CASE_QUEUE_REFRESH`` seconds; the queues are rebuilt every
+    ``CASE_QUEUE_REBUILD`` seconds so cases deleted elsewhere drop out.
+    """
+    global _queues
+    config = current_app.config
+    with _queues_lock:
+        now = time.monotonic()
+        if _queues is None or now - _queues.built > config.get('CASE_QUEUE_REBUILD', 3600):
+            _queues = build_queues()
+        else:
+            if now - _queues.refreshed > config.get('CASE_QUEUE_REFRESH', 15):
+                _catch_up(_queues, config.get('CATCH_UP_MARGIN', CATCH_UP_MARGIN))
+            if _queues.officers_stale:
+                _queues.set_officers(_officer_rows())
+        return _queues
+
+
+def case_summaries(ids):
+    """Cases as dicts, in the order of ``ids``."""
+    cases = {case.id: case for case in Case.query.filter(Case.id.in_(ids))} if ids else {}
+    return [{'id': case.id, 'title': case.title, 'status': case.status, 'priority': case.priority,
+             'officer_id': _officer_id(case.officer_id), 'crime_id': case.crime_id,
+             'created_at': case.created_at.isoformat() if case.created_at else None}
+            for case in (cases.get(case_id) for case_id in ids) if case is not None]
+
+
+def queued_cases(officer_id=None, station_id=None, limit=10):
+    """Open cases next in line: an officer's, a station's, or else the unassigned ones."""
+    queues = get_queues()
+    if officer_id is not None:
+        ids = queues.officer_queue(officer_id, limit)
+    elif station_id is not None:
+        ids = queues.station_queue(station_id, limit)
+    else:
+        ids = queues.unassigned(limit)
+    return case_summaries(ids)
+
+
+def officer_workloads(station_id=None, limit=10):
+    """The least loaded officers as ``{'id', 'username', 'station_id', 'open_cases'}`` dicts."""
+    queues = get_queues()
+    found = queues.least_loaded(station_id, limit=limit)
+    names = dict(db.session.query(User.id, User.username).filter(User.id.in_([o for o, _ in found])))
+    return [{'id': officer_id, 'username': names.get(officer_id), 'station_id': queues._station.get(officer_id),
+             'open_cases': load} for officer_id, load in found]
+
+
+def auto_assign(case_id=None, station_id=None):
+    """Give a case to the least loaded officer (of ``station_id``, if set).
+
+    Without ``case_id`` the next unassigned case is taken. Returns
+    ``(case, officer id)``, or None when there is no case or no officer.
+    The case row is locked and re-checked, since another process may have
+    assigned it since these queues last caught up.
+    """
+    queues = get_queues()
+    for _ in range(ASSIGN_ATTEMPTS):
+        candidate = case_id if case_id is not None else next(iter(queues.unassigned(1)), None)
+        officers = queues.least_loaded(station_id, limit=1)
+        if candidate is None or not officers:
+            return None
+        case = db.session.get(Case, candidate, with_for_update=True, populate_existing=True)
+        if case is None or case.status not in OPEN_CASE_STATUSES or case.officer_id is not None:
+            if case_id is not None:
+                db.session.rollback()
+                return None
+            if case is None:
+                queues.update(candidate, None, None, None, None)
+            else:
+                queues.update(candidate, case.status, case.priority, case.created_at, _officer_id(case.officer_id))
+            db.session.rollback()
+            continue
+        officer_id = officers[0][0]
+        case.officer_id = str(officer_id)
+        db.session.commit()
+        return case, officer_id
+    return None
+
+
+@event.listens_for(db.session, 'after_flush')
+def _capture_case_changes(session, flush_context):
+    if _queues is None:
+        return
+    pending = session.info.setdefault(_pending_key, {'cases': {}, 'officers': False})
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Case):
+            pending['cases'][obj.id] = (obj.status, obj.priority, obj.created_at, _officer_id(obj.officer_id))
+        elif isinstance(obj, (User, PoliceOfficer)):
+            pending['officers'] = True
+    for obj in session.deleted:
+        if isinstance(obj, Case):
+            pending['cases'][obj.id] = (None, None, None, None)
+        elif isinstance(obj, (User, PoliceOfficer)):
+            pending['officers'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_case_changes(session):
+    pending = session.info.pop(_pending_key, None)
+    if pending and _queues is not None:
+        for case_id, values in pending['cases'].items():
+            _queues.update(case_id, *values)
+        if pending['officers']:
+            # Reloaded by the next get_queues; no SQL may run here
+            _queues.officers_stale = True
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_case_changes(session, previous_transaction):
+    session.info.pop(_pending_key, None)
+
+
+@click.group('case-queue')
+def case_queue_cli():
+    """In-memory case queues and officer workloads."""
+
+
+@case_queue_cli.command('bench')
+@click.option('--cases', default=100000, show_default=True, help='Open cases to generate.')
+@click.option('--officers', default=5000, show_default=True)
+@click.option('--stations', default=100, show_default=True)
+@click.option('--operations', default=20000, show_default=True, help='Timed calls per operation.')
+@click.option('--seed', 'seed_value', default=0, show_default=True)
+def bench_command(cases, officers, stations, operations, seed_value):
+    """Time the queue operations on synthetic data (no database needed)."""
+    rng = random.Random(seed_value)
+    now = datetime.utcnow().timestamp()
+    priorities = list(PRIORITY_RANK)
+    officer_rows = [(officer_id, rng.randrange(1, stations + 1)) for officer_id in range(1, officers + 1)]
+    case_rows = [(case_id, rng.choice(priorities), datetime.fromtimestamp(now - rng.random() * 1e8),
+                  rng.randrange(1, officers + 1) if rng.random() < 0.7 else None)
+                 for case_id in range(1, cases + 1)]
+
+    started = time.perf_counter()
+    queues = CaseQueues(case_rows, officer_rows)
+    click.echo(f'build            {(time.perf_counter() - started) * 1000:8.1f} ms   {queues.stats()}')
+
+    def timed(label, call):
+        started = time.perf_counter()
+        for index in range(operations):
+            call(index)
+        click.echo(f'{label:<16} {(time.perf_counter() - started) / operations * 1e6:8.1f} us')
+
+    timed('next unassigned', lambda i: queues.unassigned(1))
+    timed('officer next', lambda i: queues.officer_queue(rng.randrange(1, officers + 1), 1))
+    timed('station next', lambda i: queues.station_queue(rng.randrange(1, stations + 1), 1))
+    timed('least loaded', lambda i: queues.least_loaded(None, 1))
+    timed('least in station', lambda i: queues.least_loaded(rng.randrange(1, stations + 1), 1))
+
+    def assign(index):
+        # What auto_assign does once the database agrees
+        case_id = next(iter(queues.unassigned(1)), None)
+        officer_id = queues.least_loaded(None, 1)[0][0]
+        if case_id is not None:
+            _, priority, created_at, _ = case_rows[case_id - 1]
+            queues.update(case_id, 'open', priority, created_at, officer_id)
+
+    def churn(index):
+        # A new case, a reprioritised one and a closed one
+        case_id = cases + index + 1
+        queues.update(case_id, 'open', rng.choice(priorities), datetime.utcnow(), None)
+        other, priority, created_at, officer_id = case_rows[rng.randrange(cases)]
+        queues.update(other, 'investigating', rng.choice(priorities), created_at, officer_id)
+        queues.update(rng.randrange(1, cases + 1), 'closed', None, None, None)
+
+    timed('auto-assign', assign)
+    timed('churn x3', churn)
+    click.echo(f'after churn      {queues.stats()}')
+
+
+@case_queue_cli.command('stats')
+@with_appcontext
+def stats_command():
+    """Build the queues from the database and summarise them."""
+    started = time.perf_counter()
+    queues = get_queues()
+    click.echo(f'{queues.stats()}; {time.perf_counter() - started:.2f}s')
+
+
+def init_app(app):
+    app.cli.add_command(case_queue_cli)
@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from sqlalchemy import event
+
+# Default seconds a catch-up reads behind its watermark (see catch_up_since)
+CATCH_UP_MARGIN = 60
+
+
+def _keep_value(target, value, oldvalue, initiator):
+    return value
+
+
+def track_previous(*attrs):
+    """Load the current value of each attribute before it is overwritten.
+
+    Without active history, assigning to an attribute expired by a commit
+    records no previous value, so a flush cannot tell what it replaced.
+    Safe to call for the same attribute from several modules.
+    """
+    for attr in attrs:
+        if not event.contains(attr, 'set', _keep_value):
+            event.listen(attr, 'set', _keep_value, active_history=True, retval=True)
+
+
+def previous_value(state, attr):
+    """The value ``attr`` had when ``state`` was loaded (see ``track_previous``)."""
+    history = state.attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return state.attrs[attr].value
+
+
+def catch_up_since(watermark, margin):
+    """Lower bound for re-reading rows changed since ``watermark``.
+
+    ``updated_at`` is stamped at flush, not at commit, so a transaction that
+    commits after a catch-up can carry an older stamp than rows already
+    seen. Reading ``margin`` seconds (the longest transaction, plus clock
+    skew between hosts) behind the newest stamp picks those rows up; the
+    callers apply rows idempotently, so re-reading is harmless.
+    """
+    if watermark is None:
+        return None
+    return watermark - timedelta(seconds=margin)
+
+
+def upsert_for(dialect_name):
+    """The dialect's INSERT with ON CONFLICT support, or None.
+
+    Imported on demand; the PostgreSQL dialect alone adds tens of
+    milliseconds to every worker start.
+    """
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert
+
+
+def add_deltas(connection, table, keys, sums, rows):
+    """Add the ``sums`` columns of ``rows`` to the rows of ``table`` with the
+    same ``keys`` columns, inserting rows that do not exist yet.
+
+    Each key may appear once in ``rows``; other columns are only written on
+    insert.
+    """
+    if not rows:
+        return
+    upsert = upsert_for(connection.dialect.name)
+    if upsert is not None:
+        statement = upsert(table)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={name: table.c[name] + statement.excluded[name] for name in sums},
+        ), rows)
+        return
+    for row in rows:
+        updated = connection.execute(
+            table.update()
+            .where(*(table.c[name] == row[name] for name in keys))
+            .values({name: table.c[name] + row[name] for name in sums})
+        )
+        if updated.rowcount == 0:
+            connection.execute(table.insert().values(**row))
@@ -0,0 +1,446 @@
+import time
+import random
+import threading
+from array import array
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, inspect, select
+
+from app import db
+from models import Criminal, Crime, CriminalCrime
+from change_tracking import previous_value, track_previous
+
+# Most hops an associates query may walk
+MAX_HOPS = 4
+
+# Pending link changes held beside the arrays before they are folded in
+COMPACT_THRESHOLD = 50000
+
+
+def _csr(pairs, size):
+    """Compressed sparse rows: the neighbours of node ``n`` are
+    ``indices[indptr[n]:indptr[n + 1]]``. Nodes are database ids, so ``indptr``
+    is indexed directly by id and needs no lookup table."""
+    indptr = array('q', bytes(8 * (size + 2)))
+    for node, _ in pairs:
+        indptr[node + 1] += 1
+    for node in range(1, size + 2):
+        indptr[node] += indptr[node - 1]
+    indices = array('q', bytes(8 * len(pairs)))
+    fill = array('q', indptr)
+    for node, neighbour in pairs:
+        indices[fill[node]] = neighbour
+        fill[node] += 1
+    return indptr, indices
+
+
+class CoOffenderGraph:
+    """The bipartite criminal-crime graph of ``criminal_crime`` in memory.
+
+    Two criminals are associates when they are linked to the same crime, so
+    one associate hop is two steps: criminal -> crime -> criminal. Both
+    directions are stored as CSR arrays; links added or removed since the
+    last build are held in small overlay sets until ``COMPACT_THRESHOLD``
+    of them accumulate, then folded into fresh arrays.
+    """
+
+    def __init__(self, pairs=()):
+        self._lock = threading.RLock()
+        self.watermark = 0
+        self.refreshed = self.built = 0.0
+        self._build(set(pairs))
+
+    def _build(self, pairs):
+        pairs = list(pairs)
+        self.edges = len(pairs)
+        max_criminal = max((criminal for criminal, _ in pairs), default=0)
+        max_crime = max((crime for _, crime in pairs), default=0)
+        self._crimes_ptr, self._crimes = _csr(pairs, max_criminal)
+        self._criminals_ptr, self._criminals = _csr([(crime, criminal) for criminal, crime in pairs],
+                                                    max_crime)
+        self._added = set()
+        self._removed = set()
+        self._added_crimes = defaultdict(set)
+        self._added_criminals = defaultdict(set)
+        self._components = None
+        self._component_index = None
+
+    def __len__(self):
+        return self.edges
+
+    def _row(self, ptr, indices, node):
+        if 0 <= node < len(ptr) - 1:
+            return indices[ptr[node]:ptr[node + 1]]
+        return ()
+
+    def crimes_of(self, criminal_id):
+        crimes = self._row(self._crimes_ptr, self._crimes, criminal_id)
+        if not (self._added or self._removed):
+            return crimes
+        crimes = {crime for crime in crimes if (criminal_id, crime) not in self._removed}
+        return crimes | self._added_crimes.get(criminal_id, set())
+
+    def criminals_of(self, crime_id):
+        criminals = self._row(self._criminals_ptr, self._criminals, crime_id)
+        if not (self._added or self._removed):
+            return criminals
+        criminals = {criminal for criminal in criminals if (criminal, crime_id) not in self._removed}
+        return criminals | self._added_criminals.get(crime_id, set())
+
+    def _has_base_edge(self, criminal_id, crime_id):
+        return crime_id in self._row(self._crimes_ptr, self._crimes, criminal_id)
+
+    def update(self, added=(), removed=()):
+        """Apply added and removed ``(criminal_id, crime_id)`` links."""
+        with self._lock:
+            changed = False
+            for pair in removed:
+                if pair in self._added:
+                    self._added.discard(pair)
+                    self._added_crimes[pair[0]].discard(pair[1])
+                    self._added_criminals[pair[1]].discard(pair[0])
+                elif self._has_base_edge(*pair) and pair not in self._removed:
+                    self._removed.add(pair)
+                else:
+                    continue
+                self.edges -= 1
+                changed = True
+            for pair in added:
+                if pair in self._removed:
+                    self._removed.discard(pair)
+                elif pair not in self._added and not self._has_base_edge(*pair):
+                    self._added.add(pair)
+                    self._added_crimes[pair[0]].add(pair[1])
+                    self._added_criminals[pair[1]].add(pair[0])
+                else:
+                    continue
+                self.edges += 1
+                changed = True
+            # Re-applying links the graph already has (a catch-up overlapping
+            # a commit) leaves the cached groups valid
+            if changed:
+                self._components = self._component_index = None
+            if len(self._added) + len(self._removed) > COMPACT_THRESHOLD:
+                self.compact()
+
+    def pairs(self):
+        base = ((criminal, self._crimes[position])
+                for criminal in range(len(self._crimes_ptr) - 1)
+                for position in range(self._crimes_ptr[criminal], self._crimes_ptr[criminal + 1]))
+        return {pair for pair in base if pair not in self._removed} | self._added
+
+    def compact(self):
+        """Fold the overlay into new arrays."""
+        with self._lock:
+            self._build(self.pairs())
+
+    def _associates(self, criminal_id):
+        for crime in self.crimes_of(criminal_id):
+            for other in self.criminals_of(crime):
+                if other != criminal_id:
+                    yield other, crime
+
+    def associates(self, criminal_id, hops=1, limit=None):
+        """Criminals within ``hops`` associate hops, nearest first.
+
+        Returns ``[(criminal_id, distance, shared_crimes)]``; ``shared_crimes``
+        counts crimes shared with ``criminal_id`` itself (0 beyond one hop).
+        """
+        with self._lock:
+            shared = defaultdict(int)
+            for other, _ in self._associates(criminal_id):
+                shared[other] += 1
+            distance = {criminal_id: 0}
+            frontier = [criminal_id]
+            for depth in range(1, hops + 1):
+                following = []
+                for node in frontier:
+                    for other, _ in self._associates(node):
+                        if other not in distance:
+                            distance[other] = depth
+                            following.append(other)
+                if not following or (limit is not None and len(distance) > limit):
+                    break
+                frontier = following
+        del distance[criminal_id]
+        found = sorted(distance.items(), key=lambda item: (item[1], -shared.get(item[0], 0), item[0]))
+        return [(other, depth, shared.get(other, 0)) for other, depth in found[:limit]]
+
+    def shortest_path(self, source, target, max_hops=6):
+        """Shortest chain of shared crimes from ``source`` to ``target``.
+
+        Returns ``[source, crime, criminal, crime, ..., target]`` or None.
+        Searches from both ends, expanding the smaller frontier each round.
+        """
+        if source == target:
+            return [source]
+        with self._lock:
+            parents = ({source: None}, {target: None})
+            frontiers = ([source], [target])
+            for _ in range(max_hops):
+                side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+                seen, other_seen = parents[side], parents[1 - side]
+                following = []
+                for node in frontiers[side]:
+                    for neighbour, crime in self._associates(node):
+                        if neighbour in seen:
+                            continue
+                        seen[neighbour] = (node, crime)
+                        if neighbour in other_seen:
+                            return self._join(parents, neighbour)
+                        following.append(neighbour)
+                if not following:
+                    return None
+                frontiers = (following, frontiers[1]) if side == 0 else (frontiers[0], following)
+        return None
+
+    def _join(self, parents, meeting):
+        path = [meeting]
+        node = meeting
+        while parents[0][node] is not None:
+            node, crime = parents[0][node]
+            path[:0] = [node, crime]
+        node = meeting
+        while parents[1][node] is not None:
+            node, crime = parents[1][node]
+            path += [crime, node]
+        return path
+
+    def components(self):
+        """Connected groups of two or more criminals, largest first (cached)."""
+        with self._lock:
+            if self._components is None:
+                size = max(len(self._crimes_ptr) - 1, max(self._added_crimes, default=0) + 1)
+                parent = list(range(size))
+
+                def find(node):
+                    root = node
+                    while parent[root] != root:
+                        root = parent[root]
+                    while parent[node] != root:
+                        parent[node], node = root, parent[node]
+                    return root
+
+                for crime in set(range(len(self._criminals_ptr) - 1)) | set(self._added_criminals):
+                    criminals = self.criminals_of(crime)
+                    if len(criminals) < 2:
+                        continue
+                    criminals = iter(criminals)
+                    root = find(next(criminals))
+                    for criminal in criminals:
+                        other = find(criminal)
+                        if other != root:
+                            parent[other] = root
+                groups = defaultdict(list)
+                for node in range(size):
+                    root = find(node)
+                    if root != node:
+                        groups[root].append(node)
+                for root, members in groups.items():
+                    members.append(root)
+                    members.sort()
+                self._components = sorted(groups.values(), key=lambda group: (-len(group), group[0]))
+                self._component_index = {member: group for group in self._components for member in group}
+            return self._components
+
+    def component_of(self, criminal_id):
+        """Every criminal connected to ``criminal_id``, sorted, from the cached groups."""
+        with self._lock:
+            self.components()
+            return list(self._component_index.get(criminal_id, [criminal_id]))
+
+
+_graph = None
+_graph_lock = threading.Lock()
+_pending_key = 'criminal_crime_changes'
+
+
+def _link_rows(after_id=0):
+    return db.session.execute(
+        select(CriminalCrime.id, CriminalCrime.criminal_id, CriminalCrime.crime_id)
+        .where(CriminalCrime.id > after_id).execution_options(yield_per=10000))
+
+
+def build_graph():
+    pairs, watermark = set(), 0
+    for link_id, criminal_id, crime_id in _link_rows():
+        pairs.add((criminal_id, crime_id))
+        watermark = max(watermark, link_id)
+    graph = CoOffenderGraph(pairs)
+    graph.watermark = watermark
+    graph.refreshed = graph.built = time.monotonic()
+    return graph
+
+
+def _catch_up(graph):
+    """Add links inserted without the ORM since the watermark, e.g. by bulk ingest."""
+    added = []
+    for link_id, criminal_id, crime_id in _link_rows(graph.watermark):
+        added.append((criminal_id, crime_id))
+        graph.watermark = max(graph.watermark, link_id)
+    graph.update(added)
+    graph.refreshed = time.monotonic()
+
+
+def get_graph():
+    """The process-wide graph, built on first use and kept current.
+
+    New links are picked up every ``CO_OFFENDER_REFRESH`` seconds; the graph
+    is rebuilt from scratch every ``CO_OFFENDER_REBUILD`` seconds so links
+    deleted by other processes eventually drop out.
+    """
+    global _graph
+    config = current_app.config
+    with _graph_lock:
+        now = time.monotonic()
+        if _graph is None or now - _graph.built > config.get('CO_OFFENDER_REBUILD', 3600):
+            _graph = build_graph()
+        elif now - _graph.refreshed > config.get('CO_OFFENDER_REFRESH', 30):
+            _catch_up(_graph)
+        return _graph
+
+
+def _criminals(ids):
+    rows = db.session.query(Criminal.id, Criminal.name, Criminal.alias).filter(Criminal.id.in_(ids))
+    return {cid: {'id': cid, 'name': name, 'alias': alias} for cid, name, alias in rows}
+
+
+def find_associates(criminal_id, hops=1, limit=100):
+    """Associates of a criminal as ``{'id', 'name', 'alias', 'hops', 'shared_crimes'}`` dicts."""
+    found = get_graph().associates(criminal_id, hops=min(hops, MAX_HOPS), limit=limit)
+    names = _criminals([other for other, _, _ in found])
+    return [dict(names[other], hops=depth, shared_crimes=shared)
+            for other, depth, shared in found if other in names]
+
+
+def find_path(source, target, max_hops=6):
+    """The shortest chain of shared crimes linking two criminals, or None."""
+    path = get_graph().shortest_path(source, target, max_hops=max_hops)
+    if path is None:
+        return None
+    names = _criminals(path[0::2])
+    crimes = {cid: {'id': cid, 'type': crime_type, 'date': day.isoformat() if day else None}
+              for cid, crime_type, day in db.session.query(Crime.id, Crime.type, Crime.date)
+              .filter(Crime.id.in_(path[1::2]))}
+    return [dict(names.get(node, {'id': node}), kind='criminal') if position % 2 == 0
+            else dict(crimes.get(node, {'id': node}), kind='crime')
+            for position, node in enumerate(path)]
+
+
+def find_groups(min_size=3, limit=20):
+    """The largest connected groups of criminals, as ``{'size', 'members'}`` dicts."""
+    groups = [group for group in get_graph().components() if len(group) >= min_size][:limit]
+    names = _criminals([member for group in groups for member in group[:50]])
+    return [{'size': len(group), 'members': [names[member] for member in group[:50] if member in names]}
+            for group in groups]
+
+
+def find_group(criminal_id):
+    """Ids of every criminal connected to ``criminal_id`` through shared crimes."""
+    return get_graph().component_of(criminal_id)
+
+
+# Keep the previous ids of a re-pointed link even when they were expired
+track_previous(CriminalCrime.criminal_id, CriminalCrime.crime_id)
+
+
+def _still_linked(session, pair):
+    # A pair stays linked while another row still links it
+    return session.connection().execute(select(CriminalCrime.id).where(
+        CriminalCrime.criminal_id == pair[0], CriminalCrime.crime_id == pair[1]).limit(1)).first() is not None
+
+
+@event.listens_for(db.session, 'after_flush')
+def _capture_link_changes(session, flush_context):
+    if _graph is None:
+        return
+    pending = session.info.setdefault(_pending_key, {'added': set(), 'removed': set()})
+    for obj in session.new:
+        if isinstance(obj, CriminalCrime):
+            pending['added'].add((obj.criminal_id, obj.crime_id))
+    for obj in session.dirty:
+        if isinstance(obj, CriminalCrime):
+            state = inspect(obj)
+            old = (previous_value(state, 'criminal_id'), previous_value(state, 'crime_id'))
+            new = (obj.criminal_id, obj.crime_id)
+            if old != new:
+                pending['added'].add(new)
+                pending['removed'].discard(new)
+                if not _still_linked(session, old):
+                    pending['removed'].add(old)
+    for obj in session.deleted:
+        if isinstance(obj, CriminalCrime):
+            state = inspect(obj)
+            pair = (previous_value(state, 'criminal_id'), previous_value(state, 'crime_id'))
+            if not _still_linked(session, pair):
+                pending['removed'].add(pair)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_link_changes(session):
+    pending = session.info.pop(_pending_key, None)
+    if pending and _graph is not None:
+        _graph.update(pending['added'], pending['removed'])
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_link_changes(session, previous_transaction):
+    session.info.pop(_pending_key, None)
+
+
+@click.group('co-offenders')
+def co_offenders_cli():
+    """Co-offender network built from criminal_crime links."""
+
+
+@co_offenders_cli.command('bench')
+@click.option('--edges', default=1000000, show_default=True, help='Criminal-crime links to generate.')
+@click.option('--criminals', default=400000, show_default=True)
+@click.option('--queries', default=200, show_default=True)
+@click.option('--seed', 'seed_value', default=0, show_default=True)
+def bench_command(edges, criminals, queries, seed_value):
+    """Time building and querying a synthetic graph (no database needed)."""
+    rng = random.Random(seed_value)
+    crimes = edges // 2
+    pairs = set()
+    while len(pairs) < edges:
+        pairs.add((rng.randrange(1, criminals + 1), rng.randrange(1, crimes + 1)))
+
+    started = time.perf_counter()
+    graph = CoOffenderGraph(pairs)
+    click.echo(f'build          {time.perf_counter() - started:8.2f} s    {len(graph)} links')
+    sample = [rng.randrange(1, criminals + 1) for _ in range(queries)]
+
+    def timed(label, call, count):
+        started = time.perf_counter()
+        for index in range(count):
+            call(index)
+        click.echo(f'{label:<14} {(time.perf_counter() - started) / count * 1000:8.2f} ms')
+
+    timed('associates k=1', lambda i: graph.associates(sample[i], hops=1), queries)
+    timed('associates k=2', lambda i: graph.associates(sample[i], hops=2), queries)
+    timed('associates k=3', lambda i: graph.associates(sample[i], hops=3, limit=500), queries)
+    timed('shortest path', lambda i: graph.shortest_path(sample[i], sample[-i - 1]), queries)
+    graph.update(added=[(criminals + i, 1) for i in range(1, 1001)])
+    timed('update x1000', lambda i: graph.update(added=[(sample[i], crimes + i + 1)]), queries)
+    timed('components', lambda i: graph.components(), 1)
+    groups = graph.components()
+    click.echo(f'{len(groups)} groups, largest {len(groups[0]) if groups else 0} criminals')
+
+
+@co_offenders_cli.command('stats')
+@with_appcontext
+def stats_command():
+    """Build the graph from the database and summarise its groups."""
+    started = time.perf_counter()
+    graph = get_graph()
+    groups = graph.components()
+    click.echo(f'{len(graph)} links, {len(groups)} groups of two or more, '
+               f'largest {len(groups[0]) if groups else 0}; {time.perf_counter() - started:.2f}s')
+
+
+def init_app(app):
+    app.cli.add_command(co_offenders_cli)
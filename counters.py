@@ -0,0 +1,183 @@
+import json
+import hashlib
+from collections import Counter, defaultdict
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, inspect
+
+from app import db
+from models import Crime, Case, CaseNote, DashboardCounter
+from utils import TTLCache
+from change_tracking import add_deltas, previous_value, track_previous
+
+# Case statuses that count as open on the dashboard
+OPEN_CASE_STATUSES = ('open', 'investigating')
+
+# Recent case notes listed in a summary
+RECENT_NOTES = 5
+
+
+def crime_counter_keys(status):
+    return [('crimes_by_status', status or 'reported')]
+
+
+def case_counter_keys(status, priority, officer_id):
+    if (status or 'open') not in OPEN_CASE_STATUSES:
+        return []
+    keys = [('open_cases_by_priority', priority or 'medium')]
+    if officer_id:
+        keys.append(('open_cases_by_officer', str(officer_id)))
+    return keys
+
+
+_TRACKED = {
+    Crime: (('status',), crime_counter_keys),
+    Case: (('status', 'priority', 'officer_id'), case_counter_keys),
+}
+
+
+# The flush decrements the counters of the values a row had before
+for _model, (_attrs, _) in _TRACKED.items():
+    track_previous(*(getattr(_model, attr) for attr in _attrs))
+
+
+def _collect_deltas(session):
+    deltas = Counter()
+    for obj in session.new:
+        if type(obj) in _TRACKED:
+            attrs, keys = _TRACKED[type(obj)]
+            deltas.update(keys(*(getattr(obj, attr) for attr in attrs)))
+    for obj in session.deleted:
+        if type(obj) in _TRACKED:
+            attrs, keys = _TRACKED[type(obj)]
+            state = inspect(obj)
+            deltas.subtract(keys(*(previous_value(state, attr) for attr in attrs)))
+    for obj in session.dirty:
+        if type(obj) in _TRACKED and session.is_modified(obj):
+            attrs, keys = _TRACKED[type(obj)]
+            state = inspect(obj)
+            deltas.subtract(keys(*(previous_value(state, attr) for attr in attrs)))
+            deltas.update(keys(*(getattr(obj, attr) for attr in attrs)))
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def apply_counter_deltas(connection, deltas):
+    """Add ``{(name, key): delta}`` to the dashboard counters."""
+    add_deltas(connection, DashboardCounter.__table__, ('name', 'key'), ('count',),
+               [dict(name=name, key=key, count=delta) for (name, key), delta in deltas.items()])
+
+
+@event.listens_for(db.session, 'before_flush')
+def _capture_counter_changes(session, flush_context, instances):
+    deltas = _collect_deltas(session)
+    if deltas:
+        session.info.setdefault('dashboard_counter_deltas', Counter()).update(deltas)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _write_counters(session, flush_context):
+    deltas = session.info.pop('dashboard_counter_deltas', None)
+    if deltas:
+        apply_counter_deltas(session.connection(), deltas)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_counters(session, previous_transaction):
+    session.info.pop('dashboard_counter_deltas', None)
+
+
+def rebuild_counters():
+    """Recompute every counter with COUNT(*) queries; returns the row count."""
+    db.session.query(DashboardCounter).delete()
+    deltas = Counter()
+    for status, count in db.session.query(Crime.status, func.count(Crime.id)).group_by(Crime.status):
+        for key in crime_counter_keys(status):
+            deltas[key] += count
+    for status, priority, officer_id, count in (
+            db.session.query(Case.status, Case.priority, Case.officer_id, func.count(Case.id))
+            .group_by(Case.status, Case.priority, Case.officer_id)):
+        for key in case_counter_keys(status, priority, officer_id):
+            deltas[key] += count
+    apply_counter_deltas(db.session.connection(), deltas)
+    db.session.commit()
+    return len(deltas)
+
+
+def _counters(*names):
+    values = defaultdict(dict)
+    rows = db.session.query(DashboardCounter.name, DashboardCounter.key, DashboardCounter.count).filter(
+        DashboardCounter.name.in_(names), DashboardCounter.count != 0)
+    for name, key, count in rows:
+        values[name][key] = count
+    return values
+
+
+def _recent_notes(officer_id=None):
+    query = (db.session.query(CaseNote.id, CaseNote.case_id, Case.title, CaseNote.content, CaseNote.created_at)
+             .join(Case, Case.id == CaseNote.case_id))
+    if officer_id is not None:
+        query = query.filter(Case.officer_id == str(officer_id))
+    return [{'id': note_id, 'case_id': case_id, 'case_title': title, 'content': content[:200],
+             'created_at': created_at.isoformat() if created_at else None}
+            for note_id, case_id, title, content, created_at
+            in query.order_by(CaseNote.created_at.desc(), CaseNote.id.desc()).limit(RECENT_NOTES)]
+
+
+def build_summary(user):
+    """Dashboard figures for ``user``; officers see their own caseload and notes."""
+    officer_view = user.role == 'officer'
+    counters = _counters('crimes_by_status', 'open_cases_by_priority', 'open_cases_by_officer')
+    return {
+        'role': user.role,
+        'crimes_by_status': counters['crimes_by_status'],
+        'open_cases_by_priority': counters['open_cases_by_priority'],
+        'open_cases': sum(counters['open_cases_by_priority'].values()),
+        # Only officers get a summary of their own; other roles share one
+        'assigned_cases': counters['open_cases_by_officer'].get(str(user.id), 0) if officer_view else None,
+        'recent_notes': _recent_notes(user.id if officer_view else None),
+    }
+
+
+class SummaryCache:
+    """Short-lived rendered summaries: one per role, or per officer.
+
+    Entries hold the JSON body and its ETag, so a poll that hits the cache
+    costs neither queries nor serialization.
+    """
+
+    def __init__(self, ttl=15, max_size=4096):
+        self.ttl = ttl
+        self._entries = TTLCache(max_size=max_size, ttl=ttl)
+
+    def get(self, user):
+        key = ('user', user.id) if user.role == 'officer' else ('role', user.role)
+        entry = self._entries.get(key)
+        if entry is None:
+            summary = build_summary(user)
+            body = json.dumps(summary, sort_keys=True, separators=(',', ':'))
+            entry = (summary, body, hashlib.sha1(body.encode()).hexdigest()[:20])
+            self._entries.set(key, entry)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+
+# Replaced by init_app according to the application config
+summaries = SummaryCache()
+
+
+@click.command('counters-rebuild')
+@with_appcontext
+def counters_rebuild_command():
+    """Recompute the dashboard counters from scratch."""
+    rows = rebuild_counters()
+    summaries.clear()
+    click.echo(f'Rebuilt dashboard counters: {rows} rows')
+
+
+def init_app(app):
+    global summaries
+    summaries = SummaryCache(ttl=app.config.get('DASHBOARD_CACHE_TTL', 15))
+    app.cli.add_command(counters_rebuild_command)
@@ -0,0 +1,203 @@
+import time
+import random
+import logging
+import threading
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+# Cookie telling later requests from the same browser to read from the
+# primary until replicas have caught up with its last write
+STICKY_COOKIE = 'db_primary_until'
+
+# Bind keys of the replicas are REPLICA_PREFIX + index
+REPLICA_PREFIX = 'replica_'
+
+logger = logging.getLogger(__name__)
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that also records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+
+def engine_options(url, pool_size=10, max_overflow=20, timeout=10, recycle=1800, pre_ping=False):
+    """Engine options for one bind.
+
+    Pre-ping costs a round trip on every checkout; it is off by default and
+    stale connections are instead recycled before servers drop them, with
+    LIFO checkout so idle connections age out rather than being kept warm.
+    """
+    options = {'pool_recycle': recycle, 'pool_pre_ping': pre_ping}
+    # SQLite gets its pool from Flask-SQLAlchemy's driver defaults
+    if url and not url.startswith('sqlite'):
+        options.update(poolclass=TimedQueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                       pool_timeout=timeout, pool_use_lifo=True)
+    return options
+
+
+def configure(app):
+    """Fill the SQLAlchemy engine options and replica binds from the DB_* settings."""
+    config = app.config
+    primary = dict(pool_size=config['DB_POOL_SIZE'], max_overflow=config['DB_MAX_OVERFLOW'],
+                   timeout=config['DB_POOL_TIMEOUT'], recycle=config['DB_POOL_RECYCLE'],
+                   pre_ping=config['DB_POOL_PRE_PING'])
+    replica = dict(primary, pool_size=config.get('DB_REPLICA_POOL_SIZE') or primary['pool_size'],
+                   max_overflow=config.get('DB_REPLICA_MAX_OVERFLOW') or primary['max_overflow'])
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(config['SQLALCHEMY_DATABASE_URI'], **primary)
+    binds = config.setdefault('SQLALCHEMY_BINDS', {})
+    for index, url in enumerate(config.get('DATABASE_REPLICA_URLS') or ()):
+        binds[f'{REPLICA_PREFIX}{index}'] = dict(engine_options(url, **replica), url=url)
+
+
+def replica_keys(app=None):
+    binds = (app or current_app).config.get('SQLALCHEMY_BINDS') or {}
+    return [key for key in binds if key.startswith(REPLICA_PREFIX)]
+
+
+# Replicas that failed to connect are skipped until the given monotonic time
+_down = {}
+
+
+def read_replica(view):
+    """Let a read-only view's SELECTs go to a replica."""
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        g._db_read_replica = True
+        return view(*args, **kwargs)
+    return decorated_view
+
+
+def _sticky():
+    if g.get('_db_wrote'):
+        return True
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def _replica_key():
+    key = g.get('_db_replica')
+    if key is None:
+        # One replica per request, so its reads see a single snapshot
+        now = time.monotonic()
+        healthy = [key for key in replica_keys() if _down.get(key, 0) <= now]
+        key = g._db_replica = random.choice(healthy) if healthy else ''
+    return key
+
+
+class RoutingSession(Session):
+    """Sends SELECTs issued by ``read_replica`` views to a replica.
+
+    Everything else uses the primary: flushes, ``session.connection()``,
+    non-SELECT statements, transactions that already wrote, and requests
+    made within ``REPLICA_STICKY_SECONDS`` of the browser's last commit.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and getattr(clause, 'is_select', False)
+                and has_request_context() and g.get('_db_read_replica')
+                and not self.info.get('db_wrote') and not _sticky()):
+            key = _replica_key()
+            if key:
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_write(session, flush_context):
+    session.info['db_wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _remember_write(session):
+    if session.info.pop('db_wrote', False) and has_request_context():
+        g._db_wrote = True
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _forget_write(session, previous_transaction):
+    session.info.pop('db_wrote', None)
+
+
+def _set_sticky_cookie(response):
+    if g.get('_db_wrote') and replica_keys():
+        seconds = current_app.config.get('REPLICA_STICKY_SECONDS', 5)
+        response.set_cookie(STICKY_COOKIE, f'{time.time() + seconds:.3f}', max_age=seconds,
+                            httponly=True, samesite='Lax', secure=request.is_secure)
+    return response
+
+
+def _watch_replica(key, engine, retry):
+    @event.listens_for(engine, 'handle_error')
+    def _replica_failed(context):
+        if context.is_disconnect or context.connection is None:
+            logger.warning('Replica %s unavailable, reading from the primary for %ss', key, retry)
+            _down[key] = time.monotonic() + retry
+
+
+def pool_stats():
+    """Pool figures per bind (``primary`` or the replica bind key)."""
+    db = current_app.extensions['sqlalchemy']
+    stats = {}
+    for key, engine in db.engines.items():
+        pool = engine.pool
+        entry = {'class': type(pool).__name__}
+        for name in ('size', 'checkedout', 'checkedin', 'overflow'):
+            if hasattr(pool, name):
+                entry[name] = getattr(pool, name)()
+        if isinstance(pool, TimedQueuePool):
+            entry.update(checkouts=pool.checkouts, wait_seconds_total=round(pool.wait_time, 6),
+                         max_wait_seconds=round(pool.max_wait, 6), timeouts=pool.timeouts)
+        if key in _down:
+            entry['down'] = _down[key] > time.monotonic()
+        stats[key or 'primary'] = entry
+    return stats
+
+
+def pool_gauges():
+    """``pool_stats`` flattened into (name, value) pairs for /metrics."""
+    gauges = []
+    for bind, entry in pool_stats().items():
+        for name, value in entry.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges.append((name, bind, value))
+    # Samples of one metric must be listed together
+    return [(f'db_pool_{name}{{bind="{bind}"}}', value) for name, bind, value in sorted(gauges)]
+
+
+def init_app(app):
+    app.after_request(_set_sticky_cookie)
+    keys = replica_keys(app)
+    if keys:
+        with app.app_context():
+            engines = app.extensions['sqlalchemy'].engines
+            for key in keys:
+                _watch_replica(key, engines[key], app.config.get('REPLICA_RETRY_SECONDS', 30))
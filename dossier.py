@@ -0,0 +1,139 @@
+from collections import defaultdict
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.orm import joinedload
+
+from app import db
+from models import Crime, CriminalCrime, Victim, Witness, Evidence, Case, CaseNote
+from instrumentation import count_queries
+
+# Queries needed for any number of crime dossiers: crimes plus one per child table
+CRIME_DOSSIER_QUERIES = 6
+
+# Queries needed for one case dossier: case (with officer and crime), notes,
+# and the crime's criminals, victims, witnesses and evidence
+CASE_DOSSIER_QUERIES = 6
+
+
+class CrimeDossier:
+    """A crime with every related record preloaded into plain lists.
+
+    The relationships on ``Crime`` are dynamic, so reading them from a
+    template runs one query each. Templates should read these lists instead.
+    """
+
+    def __init__(self, crime):
+        self.crime = crime
+        self.criminal_links = []
+        self.victims = []
+        self.witnesses = []
+        self.evidence = []
+        self.cases = []
+
+    @property
+    def criminals(self):
+        return [link.criminal for link in self.criminal_links]
+
+
+class CaseDossier:
+    def __init__(self, case, crime_dossier, notes):
+        self.case = case
+        self.crime_dossier = crime_dossier
+        self.notes = notes
+
+    @property
+    def crime(self):
+        return self.crime_dossier.crime if self.crime_dossier else None
+
+    @property
+    def officer(self):
+        return self.case.assigned_officer
+
+
+def _by_crime(query, crime_ids):
+    grouped = defaultdict(list)
+    model = query.column_descriptions[0]['entity']
+    for row in query.filter(model.crime_id.in_(crime_ids)).order_by(model.id):
+        grouped[row.crime_id].append(row)
+    return grouped
+
+
+def _attach_children(dossiers, include_cases=True):
+    crime_ids = list(dossiers)
+    children = {
+        'criminal_links': _by_crime(CriminalCrime.query.options(joinedload(CriminalCrime.criminal)), crime_ids),
+        'victims': _by_crime(Victim.query, crime_ids),
+        'witnesses': _by_crime(Witness.query, crime_ids),
+        'evidence': _by_crime(Evidence.query, crime_ids),
+    }
+    if include_cases:
+        children['cases'] = _by_crime(Case.query.options(joinedload(Case.assigned_officer)), crime_ids)
+    for crime_id, dossier in dossiers.items():
+        for name, grouped in children.items():
+            setattr(dossier, name, grouped.get(crime_id, []))
+
+
+def load_crime_dossiers(crime_ids):
+    """Load dossiers for many crimes at once in ``CRIME_DOSSIER_QUERIES`` queries.
+
+    Returns a dict keyed by crime id; unknown ids are left out.
+    """
+    crime_ids = list(dict.fromkeys(crime_ids))
+    if not crime_ids:
+        return {}
+    dossiers = {crime.id: CrimeDossier(crime) for crime in Crime.query.filter(Crime.id.in_(crime_ids))}
+    if dossiers:
+        _attach_children(dossiers)
+    return dossiers
+
+
+def load_crime_dossier(crime_id):
+    return load_crime_dossiers([crime_id]).get(crime_id)
+
+
+def load_case_dossier(case_id):
+    """Load a case with its officer, notes and crime in ``CASE_DOSSIER_QUERIES`` queries."""
+    case = (Case.query
+            .options(joinedload(Case.assigned_officer), joinedload(Case.crime))
+            .filter(Case.id == case_id).first())
+    if case is None:
+        return None
+    notes = (CaseNote.query.options(joinedload(CaseNote.user))
+             .filter(CaseNote.case_id == case.id).order_by(CaseNote.created_at.desc()).all())
+    crime_dossier = None
+    if case.crime is not None:
+        crime_dossier = CrimeDossier(case.crime)
+        _attach_children({case.crime.id: crime_dossier}, include_cases=False)
+    return CaseDossier(case, crime_dossier, notes)
+
+
+@click.command('dossier-check')
+@click.option('--sample', default=50, show_default=True, help='Crimes and cases to load.')
+@with_appcontext
+def dossier_check_command(sample):
+    """Fail if loading dossiers takes more queries than the fixed budget."""
+    crime_ids = [row[0] for row in db.session.query(Crime.id).order_by(Crime.id.desc()).limit(sample)]
+    case_ids = [row[0] for row in db.session.query(Case.id).order_by(Case.id.desc()).limit(sample)]
+    db.session.expunge_all()
+
+    failures = 0
+    with count_queries() as counter:
+        load_crime_dossiers(crime_ids)
+    click.echo(f'{len(crime_ids)} crime dossiers: {counter[0]} queries (budget {CRIME_DOSSIER_QUERIES})')
+    failures += counter[0] > CRIME_DOSSIER_QUERIES
+
+    for case_id in case_ids:
+        db.session.expunge_all()
+        with count_queries() as counter:
+            load_case_dossier(case_id)
+        if counter[0] > CASE_DOSSIER_QUERIES:
+            click.echo(f'case {case_id}: {counter[0]} queries (budget {CASE_DOSSIER_QUERIES})')
+            failures += 1
+    click.echo(f'{len(case_ids)} case dossiers checked')
+    if failures:
+        raise SystemExit(1)
+
+
+def init_app(app):
+    app.cli.add_command(dossier_check_command)
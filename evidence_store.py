@@ -0,0 +1,573 @@
+import os
+import time
+import fcntl
+import random
+import socket
+import shutil
+import hashlib
+import logging
+import secrets
+import tempfile
+import threading
+import unicodedata
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+import click
+from flask import Response, current_app, request
+from flask.cli import with_appcontext
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import wrap_file
+
+from app import db
+from models import Evidence, EvidenceBlob, EvidenceFile, EvidenceUpload
+
+# Bytes moved per read/write while receiving or serving a file
+CHUNK_SIZE = 1 << 20
+
+# Used when the app does not configure EVIDENCE_MAX_FILE_SIZE
+DEFAULT_MAX_FILE_SIZE = 20 << 30
+
+# Unreferenced blobs newer than this are left alone by gc, since an
+# upload of the same content may be attaching them right now
+GC_GRACE = timedelta(hours=1)
+
+logger = logging.getLogger(__name__)
+
+
+class EvidenceStoreError(Exception):
+    """Raised for uploads and downloads that cannot proceed; ``status`` is the HTTP code to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def store_dir():
+    return current_app.config.get('EVIDENCE_STORE_DIR') or os.path.join(current_app.instance_path, 'evidence')
+
+
+def max_file_size():
+    return current_app.config.get('EVIDENCE_MAX_FILE_SIZE', DEFAULT_MAX_FILE_SIZE)
+
+
+def thumbnail_size():
+    return current_app.config.get('EVIDENCE_THUMBNAIL_SIZE', 256)
+
+
+def blob_path(sha256, root=None):
+    return os.path.join(root or store_dir(), 'blobs', sha256[:2], sha256)
+
+
+def thumbnail_path(sha256, size, root=None):
+    return os.path.join(root or store_dir(), 'thumbs', sha256[:2], f'{sha256}-{size}.jpg')
+
+
+def _part_path(name, root=None):
+    return os.path.join(root or store_dir(), 'uploads', f'{name}.part')
+
+
+@contextmanager
+def _store_lock(exclusive=False, root=None):
+    # Uploads attach blobs under a shared lock; gc takes it exclusively, so
+    # it never deletes a file that an upload has just renamed into place
+    root = root or store_dir()
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _copy(stream, out, hasher, limit):
+    """Copy ``stream`` into ``out`` and ``hasher`` a chunk at a time; returns
+    the byte count. Fails before writing anything past ``limit``."""
+    copied = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if copied > limit:
+            raise EvidenceStoreError('Upload is larger than its declared size', 413)
+        out.write(chunk)
+        hasher.update(chunk)
+
+
+def _evidence_or_error(evidence_id):
+    if db.session.get(Evidence, evidence_id) is None:
+        raise EvidenceStoreError('Evidence not found', 404)
+
+
+def _check_upload(filename, size):
+    if not filename or len(filename) > 255 or '/' in filename or '\x00' in filename:
+        raise EvidenceStoreError('A file name of at most 255 characters, without slashes, is required')
+    if size is not None and (size < 0 or size > max_file_size()):
+        raise EvidenceStoreError(f'Files may be at most {max_file_size()} bytes', 413)
+
+
+def _link_blob(sha256, size, content_type):
+    """Make sure ``sha256`` has a blob row; True if this call created it."""
+    blob = db.session.get(EvidenceBlob, sha256)
+    if blob is not None:
+        blob.last_linked_at = datetime.utcnow()
+        return False
+    try:
+        with db.session.begin_nested():
+            db.session.add(EvidenceBlob(sha256=sha256, size=size, content_type=content_type))
+    except IntegrityError:
+        # The same content finished uploading elsewhere a moment ago
+        db.session.get(EvidenceBlob, sha256).last_linked_at = datetime.utcnow()
+        return False
+    return True
+
+
+def _attach(part, sha256, size, evidence_id, filename, content_type, user_id, upload=None):
+    # Renaming over an existing copy leaves one file per digest either way,
+    # and unlike discarding the part file cannot race with gc removing it
+    path = blob_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _store_lock():
+        os.replace(part, path)
+        created = _link_blob(sha256, size, content_type)
+        record = EvidenceFile(evidence_id=evidence_id, sha256=sha256, filename=filename,
+                              content_type=content_type, size=size, uploaded_by=user_id)
+        db.session.add(record)
+        if upload is not None:
+            db.session.delete(upload)
+        db.session.commit()
+    if created and (content_type or '').startswith('image/'):
+        schedule_thumbnail(sha256)
+    return record
+
+
+def store_stream(evidence_id, stream, filename, content_type, user_id, size=None):
+    """Receive a whole file from ``stream`` and attach it to an evidence item.
+
+    The body goes straight to a part file in the store, hashed on the way,
+    so memory use does not grow with the file. Returns the ``EvidenceFile``.
+    """
+    _evidence_or_error(evidence_id)
+    _check_upload(filename, size)
+    part = _part_path(secrets.token_hex(16))
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    hasher = hashlib.sha256()
+    try:
+        with open(part, 'wb') as out:
+            received = _copy(stream, out, hasher, max_file_size() if size is None else size)
+            out.flush()
+            os.fsync(out.fileno())
+        if size is not None and received != size:
+            raise EvidenceStoreError(f'Upload ended after {received} of {size} bytes')
+        return _attach(part, hasher.hexdigest(), received, evidence_id, filename, content_type, user_id)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+
+
+# Hash state of resumable uploads whose last chunk this process received,
+# so the next chunk does not have to re-read the part file
+_hashes = {}
+_hashes_lock = threading.Lock()
+_HASHES_KEPT = 256
+
+
+def _resume_hash(upload_id, file, offset):
+    with _hashes_lock:
+        cached = _hashes.pop(upload_id, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    # The previous chunk went to another worker (or this one restarted)
+    file.seek(0)
+    return hashlib.file_digest(file, 'sha256')
+
+
+def _keep_hash(upload_id, offset, hasher):
+    with _hashes_lock:
+        _hashes[upload_id] = (offset, hasher)
+        while len(_hashes) > _HASHES_KEPT:
+            del _hashes[next(iter(_hashes))]
+
+
+def start_upload(evidence_id, filename, content_type, size, user_id):
+    """Open a resumable upload of ``size`` bytes; returns the ``EvidenceUpload``."""
+    _evidence_or_error(evidence_id)
+    _check_upload(filename, size)
+    if size is None:
+        raise EvidenceStoreError('Resumable uploads need the total size up front')
+    upload = EvidenceUpload(id=secrets.token_hex(16), evidence_id=evidence_id, filename=filename,
+                            content_type=content_type, size=size, created_by=user_id)
+    part = _part_path(upload.id)
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    open(part, 'wb').close()
+    db.session.add(upload)
+    db.session.commit()
+    return upload
+
+
+def upload_offset(upload):
+    """Bytes of ``upload`` received so far, i.e. where the next chunk starts."""
+    try:
+        return os.path.getsize(_part_path(upload.id))
+    except FileNotFoundError:
+        raise EvidenceStoreError('Upload data is missing; start again', 410)
+
+
+def append_chunk(upload, start, stream):
+    """Write the next chunk of ``upload``, which must begin at ``start``.
+
+    Returns the ``EvidenceFile`` once the last byte has arrived, else None.
+    Chunks may land on any worker: the part file's length is the offset.
+    """
+    part = _part_path(upload.id)
+    try:
+        out = open(part, 'r+b')
+    except FileNotFoundError:
+        raise EvidenceStoreError('Upload data is missing; start again', 410)
+    with out:
+        try:
+            fcntl.flock(out, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise EvidenceStoreError('Another chunk of this upload is still being received', 409)
+        offset = os.fstat(out.fileno()).st_size
+        if start != offset:
+            raise EvidenceStoreError(f'Next chunk must start at byte {offset}', 409)
+        hasher = _resume_hash(upload.id, out, offset)
+        out.seek(offset)
+        try:
+            offset += _copy(stream, out, hasher, upload.size - offset)
+        except BaseException:
+            # Keep what arrived intact; the client asks for the offset and resumes
+            out.flush()
+            raise
+        out.flush()
+        os.fsync(out.fileno())
+        if offset < upload.size:
+            _keep_hash(upload.id, offset, hasher)
+            return None
+        # Still holding the lock, so a repeated final chunk cannot attach twice
+        return _attach(part, hasher.hexdigest(), offset, upload.evidence_id, upload.filename,
+                       upload.content_type, upload.created_by, upload=upload)
+
+
+def abort_upload(upload):
+    part = _part_path(upload.id)
+    db.session.delete(upload)
+    db.session.commit()
+    with _hashes_lock:
+        _hashes.pop(upload.id, None)
+    if os.path.exists(part):
+        os.remove(part)
+
+
+def files_for(evidence_id):
+    return db.session.scalars(select(EvidenceFile).where(EvidenceFile.evidence_id == evidence_id)
+                              .order_by(EvidenceFile.id)).all()
+
+
+def detach(record):
+    """Remove a file from its evidence item; the blob goes at the next gc."""
+    db.session.delete(record)
+    db.session.commit()
+
+
+class _FileRange:
+    """``length`` bytes of an open file from its current position.
+
+    Handed to the server's ``wsgi.file_wrapper``: gunicorn and uWSGI
+    sendfile() from ``fileno()`` at the current offset, bounded by
+    Content-Length, so the bytes never pass through Python; other servers
+    iterate ``read`` a chunk at a time.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def _disposition(filename, as_attachment):
+    try:
+        filename.encode('ascii')
+        names = {'filename': filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': "UTF-8''" + quote(filename, safe="!#$&+-.^_`|~")}
+    return 'attachment' if as_attachment else 'inline', names
+
+
+def file_response(record, as_attachment=True):
+    """Serve ``record``'s content, honouring a single-range Range header."""
+    try:
+        file = open(blob_path(record.sha256), 'rb')
+    except FileNotFoundError:
+        raise EvidenceStoreError('File content is missing from the store', 410)
+    response = Response(mimetype=record.content_type or 'application/octet-stream')
+    response.set_etag(record.sha256)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.cache_control.private = True
+    response.cache_control.max_age = 86400
+    disposition, names = _disposition(record.filename, as_attachment)
+    response.headers.set('Content-Disposition', disposition, **names)
+    if record.sha256 in request.if_none_match:
+        file.close()
+        response.status_code = 304
+        return response
+
+    start, length = 0, record.size
+    ranges = request.range
+    if_range = request.if_range
+    if ranges is not None and len(ranges.ranges) == 1 and if_range.date is None \
+            and if_range.etag in (None, record.sha256):
+        bounds = ranges.range_for_length(record.size)
+        if bounds is None:
+            file.close()
+            response.status_code = 416
+            response.content_range = ContentRange('bytes', None, None, record.size)
+            return response
+        start, stop = bounds
+        length = stop - start
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, record.size)
+    file.seek(start)
+    response.response = wrap_file(request.environ, _FileRange(file, length), CHUNK_SIZE)
+    response.direct_passthrough = True
+    response.content_length = length
+    return response
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pillow_warned = False
+
+
+def _thumbnail_pool(workers):
+    # Created lazily, and again after a fork, like the password hashing pool
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='evidence-thumbnails')
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def schedule_thumbnail(sha256):
+    """Queue a thumbnail for an image blob; returns the future, or None when disabled."""
+    workers = current_app.config.get('EVIDENCE_THUMBNAIL_WORKERS', 2)
+    if not workers:
+        return None
+    root, size = store_dir(), thumbnail_size()
+    return _thumbnail_pool(workers).submit(make_thumbnail, blob_path(sha256, root),
+                                           thumbnail_path(sha256, size, root), size)
+
+
+def make_thumbnail(source, target, size):
+    """Write a JPEG of at most ``size`` pixels a side; False if it could not."""
+    global _pillow_warned
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pillow_warned:
+            logger.warning('Evidence thumbnails need the Pillow package; skipping them')
+            _pillow_warned = True
+        return False
+    partial = f'{target}.{os.getpid()}.{threading.get_ident()}.part'
+    try:
+        with Image.open(source) as image:
+            # JPEG decoders can scale down while decoding, far cheaper than resizing after
+            image.draft('RGB', (size, size))
+            image.thumbnail((size, size))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            image.convert('RGB').save(partial, 'JPEG', quality=85)
+        os.replace(partial, target)
+        return True
+    except Exception:
+        logger.exception('Could not make a thumbnail of %s', source)
+        if os.path.exists(partial):
+            os.remove(partial)
+        return False
+
+
+def collect_garbage(upload_ttl):
+    """Delete abandoned uploads and blobs no evidence item refers to.
+
+    Returns ``(uploads, blobs)`` removed.
+    """
+    root = store_dir()
+    cutoff = datetime.utcnow() - upload_ttl
+    stale = db.session.scalars(select(EvidenceUpload).where(EvidenceUpload.created_at < cutoff)).all()
+    for upload in stale:
+        abort_upload(upload)
+    # Part files of single-request uploads whose worker died mid-transfer
+    uploads = os.path.join(root, 'uploads')
+    for name in os.listdir(uploads) if os.path.isdir(uploads) else ():
+        path = os.path.join(uploads, name)
+        if os.path.getmtime(path) < time.time() - upload_ttl.total_seconds():
+            os.remove(path)
+
+    with _store_lock(exclusive=True, root=root):
+        unused = select(EvidenceBlob.sha256).where(
+            ~select(EvidenceFile.id).where(EvidenceFile.sha256 == EvidenceBlob.sha256).exists(),
+            EvidenceBlob.last_linked_at < datetime.utcnow() - GC_GRACE)
+        digests = db.session.scalars(unused).all()
+        if digests:
+            db.session.execute(delete(EvidenceBlob).where(EvidenceBlob.sha256.in_(digests)))
+            db.session.commit()
+        for sha256 in digests:
+            for path in [blob_path(sha256, root)] + _thumbnails_of(sha256, root):
+                if os.path.exists(path):
+                    os.remove(path)
+    return len(stale), len(digests)
+
+
+def _thumbnails_of(sha256, root):
+    directory = os.path.dirname(thumbnail_path(sha256, 0, root))
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(sha256)]
+
+
+def init_app(app):
+    app.cli.add_command(evidence_store_cli)
+
+
+@click.group('evidence-store')
+def evidence_store_cli():
+    """Content-addressed storage for evidence files."""
+
+
+@evidence_store_cli.command('gc')
+@click.option('--upload-ttl-hours', type=int, default=None,
+              help='Abandon resumable uploads older than this (default EVIDENCE_UPLOAD_TTL_HOURS).')
+@with_appcontext
+def gc_command(upload_ttl_hours):
+    """Remove abandoned uploads and unreferenced blobs."""
+    if upload_ttl_hours is None:
+        upload_ttl_hours = current_app.config.get('EVIDENCE_UPLOAD_TTL_HOURS', 24)
+    uploads, blobs = collect_garbage(timedelta(hours=upload_ttl_hours))
+    click.echo(f'Removed {uploads} abandoned uploads and {blobs} unreferenced blobs')
+
+
+@evidence_store_cli.command('thumbnails')
+@with_appcontext
+def thumbnails_command():
+    """Make any missing thumbnails for image blobs."""
+    root, size = store_dir(), thumbnail_size()
+    made = 0
+    for sha256 in db.session.scalars(select(EvidenceBlob.sha256).where(EvidenceBlob.content_type.like('image/%'))):
+        if not os.path.exists(thumbnail_path(sha256, size, root)):
+            made += make_thumbnail(blob_path(sha256, root), thumbnail_path(sha256, size, root), size)
+    click.echo(f'Made {made} thumbnails')
+
+
+class _Pattern:
+    # A readable stream of ``size`` bytes of repeating random data
+    def __init__(self, size):
+        self.block = os.urandom(CHUNK_SIZE)
+        self.remaining = size
+
+    def read(self, size):
+        size = min(size, self.remaining, len(self.block))
+        self.remaining -= size
+        return self.block[:size] if size < len(self.block) else self.block
+
+
+def _drain(sock, total):
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    while total > 0:
+        received = sock.recv_into(view)
+        if not received:
+            return
+        total -= received
+
+
+def _send_timed(path, start, length, sendfile):
+    # Push a byte range into a socket pair drained by a thread, as a server would
+    sender, receiver = socket.socketpair()
+    drainer = threading.Thread(target=_drain, args=(receiver, length))
+    drainer.start()
+    started = time.perf_counter()
+    with open(path, 'rb') as file:
+        if sendfile:
+            sender.sendfile(file, start, length)
+        else:
+            wrapped = _FileRange(file, length)
+            file.seek(start)
+            for chunk in iter(lambda: wrapped.read(CHUNK_SIZE), b''):
+                sender.sendall(chunk)
+    drainer.join()
+    elapsed = time.perf_counter() - started
+    sender.close()
+    receiver.close()
+    return elapsed
+
+
+@evidence_store_cli.command('bench')
+@click.option('--size-mb', default=2048, show_default=True, help='Size of the test file.')
+@click.option('--ranges', default=200, show_default=True, help='Random 1 MiB range reads to time.')
+@with_appcontext
+def bench_command(size_mb, ranges):
+    """Measure upload, hashing and download throughput on the store's disk."""
+    size = size_mb << 20
+    scratch = tempfile.mkdtemp(prefix='bench-', dir=_ensure(store_dir()))
+    try:
+        part = os.path.join(scratch, 'upload.part')
+        started = time.perf_counter()
+        with open(part, 'wb') as out:
+            _copy(_Pattern(size), out, hashlib.sha256(), size)
+            out.flush()
+            os.fsync(out.fileno())
+        upload = time.perf_counter() - started
+        path = os.path.join(scratch, 'blob')
+        os.replace(part, path)
+
+        started = time.perf_counter()
+        with open(path, 'rb') as file:
+            hashlib.file_digest(file, 'sha256')
+        rehash = time.perf_counter() - started
+
+        copy = _send_timed(path, 0, size, sendfile=False)
+        zero_copy = _send_timed(path, 0, size, sendfile=True)
+        offsets = [random.randrange(0, max(1, size - CHUNK_SIZE)) for _ in range(ranges)]
+        range_copy = sum(_send_timed(path, offset, CHUNK_SIZE, sendfile=False) for offset in offsets)
+        range_zero = sum(_send_timed(path, offset, CHUNK_SIZE, sendfile=True) for offset in offsets)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    def rate(seconds):
+        return f'{size / seconds / (1 << 20):8.0f} MB/s'
+
+    click.echo(f'upload (hash + write + fsync) {rate(upload)}   {size_mb} MB in {upload:.1f}s')
+    click.echo(f'sha256 of stored file        {rate(rehash)}   (resuming on another worker)')
+    click.echo(f'download, read + send        {rate(copy)}')
+    click.echo(f'download, sendfile           {rate(zero_copy)}')
+    click.echo(f'1 MiB ranges, read + send    {range_copy / ranges * 1000:8.2f} ms each')
+    click.echo(f'1 MiB ranges, sendfile       {range_zero / ranges * 1000:8.2f} ms each')
+
+
+def _ensure(directory):
+    os.makedirs(directory, exist_ok=True)
+    return directory
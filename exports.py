@@ -0,0 +1,299 @@
+import os
+import csv
+import gzip
+import time
+import socket
+import logging
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, Time, select, update
+
+from app import db
+from models import Crime, Case, Evidence, ExportJob
+from search import build_crime_query
+
+# Exportable record kinds
+KINDS = {'crimes': Crime, 'cases': Case, 'evidence': Evidence}
+
+# Output formats and the extension of the file each produces
+FORMATS = {'csv': '.csv.gz', 'xlsx': '.xlsx', 'parquet': '.parquet'}
+
+# Rows fetched from the cursor, and written, per batch
+DEFAULT_BATCH_SIZE = 10000
+
+# Most rows Excel accepts on one sheet, header included
+XLSX_MAX_ROWS = 1048576
+
+# Running jobs whose worker has not reported for this long are requeued
+STALE_AFTER = timedelta(minutes=10)
+
+# Filters accepted for crime exports; other kinds filter on created_at only
+CRIME_FILTERS = ('crime_type', 'status', 'date_from', 'date_to', 'location', 'search_term')
+
+logger = logging.getLogger(__name__)
+
+
+class ExportError(Exception):
+    pass
+
+
+def _parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except (TypeError, ValueError):
+        raise ExportError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+
+
+def validate_request(kind, file_format, filters):
+    """Check an export request; returns the cleaned filters."""
+    if kind not in KINDS:
+        raise ExportError(f'kind must be one of {", ".join(sorted(KINDS))}')
+    if file_format not in FORMATS:
+        raise ExportError(f'format must be one of {", ".join(sorted(FORMATS))}')
+    filters = {key: value for key, value in (filters or {}).items() if value not in (None, '')}
+    allowed = CRIME_FILTERS if kind == 'crimes' else ('date_from', 'date_to')
+    unknown = set(filters) - set(allowed)
+    if unknown:
+        raise ExportError(f'Unsupported filters for {kind}: {", ".join(sorted(unknown))}')
+    for key in ('date_from', 'date_to'):
+        _parse_day(filters.get(key))
+    return filters
+
+
+def export_statement(kind, filters):
+    """SELECT of every column of ``kind`` matching ``filters``, in primary key order."""
+    model = KINDS[kind]
+    date_from, date_to = _parse_day(filters.get('date_from')), _parse_day(filters.get('date_to'))
+    if kind == 'crimes':
+        query = build_crime_query(**dict(filters, date_from=date_from, date_to=date_to))
+    else:
+        query = model.query
+        if date_from:
+            query = query.filter(model.created_at >= date_from)
+        if date_to:
+            query = query.filter(model.created_at < date_to + timedelta(days=1))
+    columns = list(model.__table__.columns)
+    return query.with_entities(*columns).order_by(model.id).statement, columns
+
+
+class CsvWriter:
+    def __init__(self, path, columns):
+        self._file = gzip.open(path, 'wt', newline='', encoding='utf-8', compresslevel=6)
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([column.name for column in columns])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class XlsxWriter:
+    """Streams rows with openpyxl's write-only mode, spilling onto new sheets
+    when one is full."""
+
+    def __init__(self, path, columns):
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise ExportError('XLSX exports require the openpyxl package')
+        self.path = path
+        self.header = [column.name for column in columns]
+        self._book = Workbook(write_only=True)
+        self._sheet = None
+        self._rows = XLSX_MAX_ROWS
+
+    def write(self, rows):
+        for row in rows:
+            if self._rows >= XLSX_MAX_ROWS:
+                self._sheet = self._book.create_sheet(f'Sheet{len(self._book.worksheets) + 1}')
+                self._sheet.append(self.header)
+                self._rows = 1
+            self._sheet.append(list(row))
+            self._rows += 1
+
+    def close(self):
+        if self._sheet is None:
+            self._book.create_sheet('Sheet1').append(self.header)
+        self._book.save(self.path)
+
+
+class ParquetWriter:
+    """Writes one row group per batch with a schema taken from the table
+    definition, so batches of all-NULL values don't change column types."""
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError('Parquet exports require the pyarrow package')
+        self._pa = pyarrow
+        self.schema = pyarrow.schema([(column.name, self._arrow_type(column.type)) for column in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+
+    def _arrow_type(self, column_type):
+        pa = self._pa
+        for sql_type, arrow_type in ((Boolean, pa.bool_()), (Integer, pa.int64()), (Float, pa.float64()),
+                                     (DateTime, pa.timestamp('us')), (Date, pa.date32()),
+                                     (Time, pa.time64('us'))):
+            if isinstance(column_type, sql_type):
+                return arrow_type
+        return pa.string()
+
+    def write(self, rows):
+        arrays = list(zip(*rows))
+        self._writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(values, type=field.type) for values, field in zip(arrays, self.schema)],
+            schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {'csv': CsvWriter, 'xlsx': XlsxWriter, 'parquet': ParquetWriter}
+
+
+def export_dir():
+    return current_app.config.get('EXPORT_DIR') or os.path.join(current_app.instance_path, 'exports')
+
+
+def submit(kind, file_format, filters, user_id):
+    """Queue an export job; returns the ``ExportJob``."""
+    filters = validate_request(kind, file_format, filters)
+    job = ExportJob(kind=kind, format=file_format, filters=filters, status='queued', requested_by=user_id)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def _set(job_id, **values):
+    # Progress goes through its own short transaction; the export itself
+    # holds a server-side cursor open on a different connection
+    values['heartbeat_at'] = datetime.utcnow()
+    with db.engine.begin() as connection:
+        connection.execute(update(ExportJob.__table__).where(ExportJob.id == job_id).values(**values))
+
+
+def claim_job(worker):
+    """Atomically mark the oldest queued job as running by ``worker``; returns its id."""
+    table = ExportJob.__table__
+    with db.engine.begin() as connection:
+        stale = datetime.utcnow() - STALE_AFTER
+        connection.execute(update(table).where(table.c.status == 'running', table.c.heartbeat_at < stale)
+                           .values(status='queued', claimed_by=None))
+        while True:
+            job_id = connection.execute(select(table.c.id).where(table.c.status == 'queued')
+                                        .order_by(table.c.id).limit(1)).scalar()
+            if job_id is None:
+                return None
+            now = datetime.utcnow()
+            claimed = connection.execute(
+                update(table).where(table.c.id == job_id, table.c.status == 'queued')
+                .values(status='running', claimed_by=worker, started_at=now, heartbeat_at=now,
+                        rows_done=0, error=None)
+            ).rowcount
+            if claimed:
+                return job_id
+
+
+def _batches(connection, statement, model, batch_size):
+    """Yield lists of rows holding at most ``batch_size`` rows in memory."""
+    if connection.dialect.name != 'sqlite':
+        # A server-side cursor: one query, rows fetched as they are written
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(statement)
+        yield from result.partitions()
+        return
+    # SQLite can't commit progress from another connection while a read
+    # cursor is open, so page through the primary key in short queries
+    last_id = None
+    while True:
+        page = statement if last_id is None else statement.where(model.id > last_id)
+        rows = connection.execute(page.limit(batch_size)).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+        connection.rollback()
+
+
+def run_job(job_id, batch_size=DEFAULT_BATCH_SIZE):
+    """Stream one job's rows into its file, reporting progress per batch."""
+    job = db.session.get(ExportJob, job_id)
+    kind, file_format, filters = job.kind, job.format, dict(job.filters or {})
+    db.session.rollback()
+
+    directory = export_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{kind}-{job_id}{FORMATS[file_format]}')
+    partial = path + '.part'
+    try:
+        statement, columns = export_statement(kind, filters)
+        with db.engine.connect() as connection:
+            rows_total = connection.execute(select(db.func.count()).select_from(statement.subquery())).scalar()
+            _set(job_id, rows_total=rows_total)
+            writer = WRITERS[file_format](partial, columns)
+            rows_done = 0
+            for batch in _batches(connection, statement, KINDS[kind], batch_size):
+                writer.write(batch)
+                rows_done += len(batch)
+                _set(job_id, rows_done=rows_done)
+            writer.close()
+        os.replace(partial, path)
+    except Exception as exc:
+        if os.path.exists(partial):
+            os.remove(partial)
+        logger.exception('Export job %s failed', job_id)
+        message = str(exc) if isinstance(exc, ExportError) else f'{type(exc).__name__}: {exc}'
+        _set(job_id, status='failed', error=message[:500], finished_at=datetime.utcnow())
+        return False
+    _set(job_id, status='done', file_path=path, file_size=os.path.getsize(path),
+         finished_at=datetime.utcnow())
+    return True
+
+
+def purge_expired(retention):
+    """Delete finished jobs, and their files, older than ``retention``."""
+    cutoff = datetime.utcnow() - retention
+    expired = ExportJob.query.filter(ExportJob.status.in_(('done', 'failed')),
+                                     ExportJob.finished_at < cutoff).all()
+    for job in expired:
+        if job.file_path and os.path.exists(job.file_path):
+            os.remove(job.file_path)
+        db.session.delete(job)
+    db.session.commit()
+    return len(expired)
+
+
+@click.command('export-worker')
+@click.option('--once', is_flag=True, help='Process queued jobs, then exit.')
+@click.option('--poll', default=2.0, show_default=True, help='Seconds between queue checks when idle.')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+@with_appcontext
+def export_worker_command(once, poll, batch_size):
+    """Run queued export jobs; no broker needed, the queue is the export_jobs table."""
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    retention = timedelta(hours=current_app.config.get('EXPORT_RETENTION_HOURS', 72))
+    click.echo(f'Export worker {worker} writing to {export_dir()}')
+    last_purge = 0.0
+    while True:
+        if time.monotonic() - last_purge > 3600:
+            purge_expired(retention)
+            last_purge = time.monotonic()
+        job_id = claim_job(worker)
+        if job_id is None:
+            if once:
+                return
+            time.sleep(poll)
+            continue
+        started = time.perf_counter()
+        ok = run_job(job_id, batch_size)
+        click.echo(f'job {job_id}: {"done" if ok else "failed"} in {time.perf_counter() - started:.1f}s')
+
+
+def init_app(app):
+    app.cli.add_command(export_worker_command)
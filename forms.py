@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField
-from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Length
+from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField, DateField, TextAreaField
+from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Length, Optional
 
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
@@ -14,4 +14,19 @@ class RegisterForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired(), Length(min=8)])
     password2 = PasswordField('Confirm Password', validators=[DataRequired(), EqualTo('password')])
     role = SelectField('Role', choices=[('user', 'User'), ('admin', 'Administrator'), ('officer', 'Officer'), ('analyst', 'Analyst')])
-    submit = SubmitField('Register User')
\ No newline at end of file
+    submit = SubmitField('Register User')
+
+class CrimeSearchForm(FlaskForm):
+    class Meta:
+        csrf = False
+
+    search_term = StringField('Search', validators=[Optional()])
+    crime_type = StringField('Crime Type', validators=[Optional()])
+    status = SelectField('Status', choices=[('', 'All Statuses'), ('reported', 'Reported'), ('investigating', 'Investigating'), ('solved', 'Solved'), ('closed', 'Closed')], validators=[Optional()])
+    date_from = DateField('From Date', validators=[Optional()])
+    date_to = DateField('To Date', validators=[Optional()])
+    location = StringField('Location', validators=[Optional()])
+
+class CaseNoteForm(FlaskForm):
+    content = TextAreaField('Note', validators=[DataRequired()])
+    submit = SubmitField('Add Note')
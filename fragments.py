@@ -0,0 +1,402 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import wraps
+from itertools import chain
+
+import click
+from flask import Response, current_app, request, session
+from flask.cli import with_appcontext
+from flask_login import current_user
+from markupsafe import Markup
+from sqlalchemy import event
+
+from app import db
+
+# Used when the app does not configure FRAGMENT_CACHE_SIZE_MB / FRAGMENT_CACHE_SHARED_SIZE_MB
+DEFAULT_LOCAL_BYTES = 32 << 20
+DEFAULT_SHARED_BYTES = 256 << 20
+
+_pending_key = 'fragment_tags'
+
+
+class LocalFragmentCache:
+    """Per-process LRU of rendered HTML, bounded by total size, with a TTL.
+
+    Also holds the tag versions when there is no shared tier.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_LOCAL_BYTES, ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (expires, html, size, render seconds)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """``(html, size, render_seconds)`` for ``key``, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1:]
+
+    def set(self, key, html, size, seconds):
+        # A single huge page is not allowed to flush most of the cache
+        if size > self.max_bytes // 8:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, html, size, seconds)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self._entries.popitem(last=False)[1][2]
+
+    def _remove(self, key):
+        self.bytes -= self._entries.pop(key)[2]
+
+    def versions(self, tags):
+        with self._lock:
+            return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'entries': len(self), 'bytes': self.bytes, 'max_bytes': self.max_bytes, 'ttl': self.ttl}
+
+
+class SharedFragmentCache:
+    """Fragments and tag versions in a local SQLite file shared by every
+    worker on the host, so a commit in one worker invalidates the others'
+    copies at once and a fragment rendered by one is reused by all."""
+
+    def __init__(self, path, max_bytes=DEFAULT_SHARED_BYTES, ttl=300):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS fragments (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, '
+                     'size INTEGER NOT NULL, seconds REAL NOT NULL, html TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS fragment_tags (tag TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT expires_at, html, size, seconds FROM fragments WHERE key = ?', (key,)).fetchone()
+        if row is None or row[0] < time.time():
+            return None
+        return row[1:]
+
+    def set(self, key, html, size, seconds):
+        if size > self.max_bytes // 8:
+            return
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?, ?)',
+                     (key, time.time() + self.ttl, size, seconds, html))
+        # Keep the file bounded: drop expired rows, then the oldest beyond the byte budget
+        self._writes += 1
+        if self._writes % 256 == 0:
+            conn.execute('DELETE FROM fragments WHERE expires_at < ?', (time.time(),))
+            conn.execute('DELETE FROM fragments WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER '
+                         '(ORDER BY expires_at DESC) AS running FROM fragments) WHERE running > ?)',
+                         (self.max_bytes,))
+
+    def versions(self, tags):
+        found = dict(self._connect().execute(
+            f'SELECT tag, version FROM fragment_tags WHERE tag IN ({",".join("?" * len(tags))})', tags))
+        return [found.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        conn = self._connect()
+        for tag in tags:
+            conn.execute('INSERT INTO fragment_tags VALUES (?, 1) '
+                         'ON CONFLICT (tag) DO UPDATE SET version = version + 1', (tag,))
+
+    def clear(self):
+        self._connect().execute('DELETE FROM fragments')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM fragments').fetchone()[0]
+
+    def stats(self):
+        entries, size = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM fragments').fetchone()
+        return {'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes, 'ttl': self.ttl}
+
+
+class FragmentCache:
+    """Rendered fragments and pages: the per-process tier first, then the
+    shared one if configured.
+
+    Keys carry the current version of each tag the entry depends on; a
+    commit touching a tagged table bumps its version, which makes the old
+    entries unreachable until they age out. Hit counts, bytes and render
+    time saved are kept per fragment or page, per process.
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def _tags(self):
+        return self.shared if self.shared is not None else self.local
+
+    def key(self, name, parts, tags):
+        versions = self._tags().versions(list(tags)) if tags else []
+        return '|'.join(chain([name], map(str, parts), ['.'.join(map(str, versions))]))
+
+    def fetch(self, name, parts, tags, render):
+        """Cached HTML for ``name`` and ``parts``, or ``render()`` it and cache it."""
+        key = self.key(name, parts, tags)
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, *entry)
+        if entry is not None:
+            self._count(name, hit=True, size=entry[1], seconds=entry[2])
+            return entry[0]
+        started = time.perf_counter()
+        html = render()
+        seconds = time.perf_counter() - started
+        size = len(html.encode())
+        self.local.set(key, html, size, seconds)
+        if self.shared is not None:
+            self.shared.set(key, html, size, seconds)
+        self._count(name, hit=False)
+        return html
+
+    def _count(self, name, hit, size=0, seconds=0.0):
+        with self._lock:
+            counts = self._routes.setdefault(name, [0, 0, 0, 0.0])
+            counts[0 if hit else 1] += 1
+            counts[2] += size
+            counts[3] += seconds
+
+    def invalidate(self, tags):
+        self._tags().bump(sorted(tags))
+
+    def stats(self):
+        with self._lock:
+            routes = {name: {'hits': hits, 'misses': misses,
+                             'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                             'bytes_saved': saved, 'render_ms_saved': round(seconds * 1000, 1)}
+                      for name, (hits, misses, saved, seconds) in sorted(self._routes.items())}
+        return {'local': self.local.stats(),
+                'shared': self.shared.stats() if self.shared is not None else None,
+                'routes': routes}
+
+
+# Replaced by init_app according to the application config
+cache = FragmentCache(LocalFragmentCache())
+_enabled = False
+
+
+def _vary(vary):
+    if vary is None:
+        return ()
+    if not current_user.is_authenticated:
+        return ('anonymous',)
+    return (current_user.role,) if vary == 'role' else (f'user{current_user.id}',)
+
+
+def cached(name, *key, tags=(), vary='role', caller=None):
+    """Jinja helper caching the body of a call block::
+
+        {% call cached('crime-type-options', selected, tags=('crimes',)) %}...{% endcall %}
+
+    ``vary`` is 'role', 'user' or None; extra positional arguments become
+    part of the key. Tags are table names whose commits invalidate it.
+    """
+    if not _enabled:
+        return caller()
+    return Markup(cache.fetch(name, (*_vary(vary), *key), tags, lambda: str(caller())))
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+def cached_page(tags=(), vary='user'):
+    """Cache a view's whole HTML response per URL (and per user by default).
+
+    Only successful GETs are stored, and never while flashed messages are
+    waiting to be shown.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not _enabled or request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+            rendered = []
+
+            def render():
+                response = current_app.make_response(view(*args, **kwargs))
+                rendered.append(response)
+                if response.status_code != 200 or response.mimetype != 'text/html':
+                    raise _Uncacheable()
+                return response.get_data(as_text=True)
+
+            try:
+                html = cache.fetch(f'page:{request.endpoint}', (*_vary(vary), request.full_path), tags, render)
+            except _Uncacheable:
+                return rendered[0]
+            response = rendered[0] if rendered else Response(html, mimetype='text/html')
+            response.headers['X-Cache'] = 'miss' if rendered else 'hit'
+            return response
+        return wrapper
+    return decorator
+
+
+def mark_changed(session, *tags):
+    """Invalidate ``tags`` when ``session`` commits; for writes that bypass the ORM."""
+    session.info.setdefault(_pending_key, set()).update(tags)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_tags(session, flush_context):
+    tags = {obj.__tablename__ for obj in chain(session.new, session.deleted)
+            if hasattr(obj, '__tablename__')}
+    tags.update(obj.__tablename__ for obj in session.dirty
+                if hasattr(obj, '__tablename__') and session.is_modified(obj))
+    if tags:
+        mark_changed(session, *tags)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_tags(session):
+    tags = session.info.pop(_pending_key, None)
+    if tags:
+        cache.invalidate(tags)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_tags(session, previous_transaction):
+    session.info.pop(_pending_key, None)
+
+
+def fragment_stats():
+    return cache.stats()
+
+
+def init_app(app):
+    global cache, _enabled
+    ttl = app.config.get('FRAGMENT_CACHE_TTL', 300)
+    local = LocalFragmentCache(max_bytes=app.config.get('FRAGMENT_CACHE_SIZE_MB', 32) << 20, ttl=ttl)
+    shared = None
+    path = app.config.get('FRAGMENT_CACHE_PATH')
+    if path is None:
+        path = os.path.join(app.instance_path, 'fragment_cache.sqlite')
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        shared = SharedFragmentCache(path, max_bytes=app.config.get('FRAGMENT_CACHE_SHARED_SIZE_MB', 256) << 20,
+                                     ttl=ttl)
+    cache = FragmentCache(local, shared)
+    _enabled = ttl > 0
+    app.jinja_env.globals['cached'] = cached
+    app.cli.add_command(fragment_cache_cli)
+
+
+@click.group('fragment-cache')
+def fragment_cache_cli():
+    """Cached template fragments and pages."""
+
+
+@fragment_cache_cli.command('invalidate')
+@click.argument('tags', nargs=-1, required=True)
+@with_appcontext
+def invalidate_command(tags):
+    """Invalidate everything cached under TAGS (table names).
+
+    Reaches every worker through the shared tier; without one, each
+    worker's copies expire after FRAGMENT_CACHE_TTL.
+    """
+    cache.invalidate(tags)
+    click.echo(f'Invalidated {", ".join(tags)}' + ('' if cache.shared is not None else
+                                                   ' (local tier only; workers expire theirs by TTL)'))
+
+
+_BENCH_TEMPLATE = '''
+<select name="crime_type">{% for type in types %}<option value="{{ type }}"{% if type == selected %} selected{% endif %}>{{ type }}</option>{% endfor %}</select>
+<table>{% for row in rows %}<tr><td>{{ row.day }}</td><td>{{ row.type|title }}</td><td>{{ "{:,}".format(row.count) }}</td></tr>{% endfor %}</table>
+'''
+
+
+@fragment_cache_cli.command('bench')
+@click.option('--types', default=200, show_default=True, help='Options in the dropdown fragment.')
+@click.option('--rows', default=1000, show_default=True, help='Rows in the statistics fragment.')
+@click.option('--renders', default=2000, show_default=True)
+@with_appcontext
+def bench_command(types, rows, renders):
+    """Time a dropdown-plus-table fragment uncached, from each tier, and after invalidation."""
+    global cache, _enabled
+    context = {'types': [f'Type {i:04d}' for i in range(types)], 'selected': 'Type 0001',
+               'rows': [{'day': f'2024-01-{i % 28 + 1:02d}', 'type': f'type {i % types}', 'count': i * 37}
+                        for i in range(rows)]}
+    env = current_app.jinja_env
+    plain = env.from_string(_BENCH_TEMPLATE)
+    wrapped = env.from_string("{% call cached('bench', selected, tags=('bench',), vary=None) %}"
+                              + _BENCH_TEMPLATE + '{% endcall %}')
+    saved = cache, _enabled
+    scratch = tempfile.mkdtemp(prefix='fragment-bench-')
+    try:
+        with current_app.test_request_context('/'):
+            def timed(template, count):
+                started = time.perf_counter()
+                for _ in range(count):
+                    html = template.render(**context)
+                return (time.perf_counter() - started) / count, len(html.encode())
+
+            uncached, size = timed(plain, max(1, renders // 10))
+            _enabled = True
+            results = [('uncached render', uncached)]
+            for label, shared in (('local tier', None),
+                                  ('shared tier', SharedFragmentCache(os.path.join(scratch, 'bench.sqlite')))):
+                cache = FragmentCache(LocalFragmentCache(), shared)
+                timed(wrapped, 1)
+                results.append((f'{label} hit', timed(wrapped, renders)[0]))
+                if shared is not None:
+                    # Another worker's first request: empty local tier, warm shared tier
+                    cache = FragmentCache(LocalFragmentCache(), shared)
+                    results.append(('shared tier, cold local', timed(wrapped, 1)[0]))
+                cache.invalidate(['bench'])
+                results.append((f'{label} after invalidation', timed(wrapped, 1)[0]))
+    finally:
+        cache, _enabled = saved
+        for name in os.listdir(scratch):
+            os.remove(os.path.join(scratch, name))
+        os.rmdir(scratch)
+    click.echo(f'fragment: {types} options + {rows} table rows, {size:,} bytes')
+    for label, seconds in results:
+        click.echo(f'{label:<28} {seconds * 1e6:10.1f} us  {uncached / seconds:7.1f}x')
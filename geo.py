@@ -0,0 +1,228 @@
+import json
+import hashlib
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, or_
+
+from app import db
+from models import Crime, CrimeMapCell
+
+# Precision of the geohash stored on each crime (~5 m cells)
+GEOHASH_PRECISION = 9
+
+# Below this zoom level the map gets grid clusters instead of points
+CLUSTER_ZOOM = 13
+
+# Upper bound on individual points streamed for one viewport
+MAX_FEATURES = 50000
+
+# Rows fetched per round trip while streaming
+STREAM_BATCH = 2000
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Encode a coordinate as a base32 geohash string."""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(chars)
+
+
+def geohash_center(geohash):
+    """``(latitude, longitude)`` at the middle of a geohash cell."""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        bits = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            rng = lng_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if bits >> shift & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+def cluster_precision(zoom):
+    """Geohash prefix length giving roughly 50-100 px cluster cells at ``zoom``."""
+    return max(1, min(GEOHASH_PRECISION - 2, zoom // 2 + 1))
+
+
+@event.listens_for(Crime, 'before_insert')
+@event.listens_for(Crime, 'before_update')
+def _set_crime_geohash(mapper, connection, crime):
+    if crime.latitude is not None and crime.longitude is not None:
+        crime.geohash = geohash_encode(crime.latitude, crime.longitude)
+    else:
+        crime.geohash = None
+
+
+def parse_bbox(value):
+    """Parse ``west,south,east,north`` into a tuple of floats, or ``None``."""
+    try:
+        west, south, east, north = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        return None
+    return west, south, east, north
+
+
+def _bbox_filter(bbox, latitude=Crime.latitude, longitude=Crime.longitude):
+    west, south, east, north = bbox
+    lat = latitude.between(south, north)
+    if west <= east:
+        return lat & longitude.between(west, east)
+    # Viewport crosses the antimeridian
+    return lat & or_(longitude >= west, longitude <= east)
+
+
+def cell_size(precision):
+    """``(height, width)`` in degrees of a geohash cell at ``precision``."""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** (bits - bits // 2)
+
+
+def _cells_in(bbox, precision):
+    # Map cells are filed by their centre; widen the box by half a cell so
+    # cells straddling its edge are included
+    height, width = cell_size(precision)
+    west, south, east, north = bbox
+    if west <= east and east - west + width >= 360:
+        west, east = -180.0, 180.0
+    else:
+        west = (west - width / 2 + 180) % 360 - 180
+        east = (east + width / 2 + 180) % 360 - 180
+    widened = (west, max(-90.0, south - height / 2), east, min(90.0, north + height / 2))
+    return _bbox_filter(widened, CrimeMapCell.latitude, CrimeMapCell.longitude)
+
+
+def _filtered(query, bbox, crime_type=None, status=None):
+    query = query.filter(Crime.geohash.isnot(None), _bbox_filter(bbox))
+    if crime_type:
+        query = query.filter(Crime.type == crime_type)
+    if status:
+        query = query.filter(Crime.status == status)
+    return query
+
+
+def data_version():
+    """Cheap fingerprint of the crime table used to build map ETags.
+
+    Both aggregates are answered from indexes. Hard deletes of old rows are
+    not reflected until another crime is written.
+    """
+    latest_update, latest_id = db.session.query(func.max(Crime.updated_at), func.max(Crime.id)).one()
+    return f'{latest_update}:{latest_id}'
+
+
+def map_etag(args):
+    """ETag for a map request: the data version plus the normalised query."""
+    key = '|'.join(f'{name}={args.get(name, "")}' for name in ('bbox', 'zoom', 'type', 'status'))
+    digest = hashlib.sha1(f'{data_version()}|{key}'.encode()).hexdigest()
+    return digest[:32]
+
+
+def _feature(crime_id, latitude, longitude, crime_type, day, time, location, status):
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': {
+            'id': crime_id, 'type': crime_type, 'date': day.isoformat() if day else None,
+            'time': time.strftime('%H:%M') if time else None, 'location': location, 'status': status,
+        },
+    }
+
+
+def _cluster(cell, count, latitude, longitude):
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': {'cluster': True, 'cell': cell, 'count': count},
+    }
+
+
+def stream_crime_features(bbox, zoom, crime_type=None, status=None):
+    """Yield a GeoJSON FeatureCollection for the viewport in text chunks.
+
+    Low zoom levels read the per-cell counts kept in ``crime_map_cells``
+    (see rollups.py), so their cost depends on the cells in view rather than
+    the crimes; higher zooms stream individual points in batches so neither
+    the server nor the response buffer ever holds the full result.
+    """
+    if zoom < CLUSTER_ZOOM:
+        precision = cluster_precision(zoom)
+        count = func.sum(CrimeMapCell.count)
+        query = db.session.query(CrimeMapCell.cell, count, func.sum(CrimeMapCell.latitude_sum) / count,
+                                 func.sum(CrimeMapCell.longitude_sum) / count).filter(
+            CrimeMapCell.precision == precision, _cells_in(bbox, precision))
+        if crime_type:
+            query = query.filter(CrimeMapCell.type == crime_type)
+        if status:
+            query = query.filter(CrimeMapCell.status == status)
+        query = query.group_by(CrimeMapCell.cell).having(count > 0)
+        features = (_cluster(*row) for row in query.yield_per(STREAM_BATCH))
+    else:
+        query = _filtered(
+            db.session.query(Crime.id, Crime.latitude, Crime.longitude, Crime.type,
+                             Crime.date, Crime.time, Crime.location, Crime.status),
+            bbox, crime_type, status,
+        ).limit(MAX_FEATURES)
+        features = (_feature(*row) for row in query.yield_per(STREAM_BATCH))
+
+    yield '{"type":"FeatureCollection","features":['
+    separator = ''
+    for feature in features:
+        yield separator + json.dumps(feature, separators=(',', ':'))
+        separator = ','
+    yield ']}'
+
+
+def backfill_geohashes(batch_size=10000):
+    """Fill ``Crime.geohash`` for rows written without the ORM; returns the count."""
+    table = Crime.__table__
+    updated = 0
+    while True:
+        rows = db.session.execute(
+            db.select(table.c.id, table.c.latitude, table.c.longitude)
+            .where(table.c.geohash.is_(None), table.c.latitude.isnot(None), table.c.longitude.isnot(None))
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('crime_id')).values(geohash=db.bindparam('hash')),
+            [{'crime_id': row.id, 'hash': geohash_encode(row.latitude, row.longitude)} for row in rows],
+        )
+        db.session.commit()
+        updated += len(rows)
+    return updated
+
+
+@click.command('geohash-backfill')
+@with_appcontext
+def geohash_backfill_command():
+    """Compute geohashes for geocoded crimes that are missing one."""
+    click.echo(f'Backfilled {backfill_geohashes()} crime geohashes')
+
+
+def init_app(app):
+    app.cli.add_command(geohash_backfill_command)
@@ -0,0 +1,476 @@
+import os
+import math
+import json
+import time
+import hashlib
+import threading
+from datetime import date, timedelta
+from operator import itemgetter
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import case, cast, func, literal, select, Integer
+
+from app import db
+from models import Crime
+from utils import TTLCache
+
+# Grid cells along the longer side of the analysed area
+DEFAULT_RESOLUTION = 128
+MAX_RESOLUTION = 512
+
+# Kernel density bandwidth, in grid cells
+DEFAULT_BANDWIDTH = 2.0
+
+# Getis-Ord Gi*: neighbourhood radius in cells, and the z-score (p < 0.05)
+# a cell must reach to be reported as a hotspot
+GI_RADIUS = 1
+GI_THRESHOLD = 1.96
+
+# Space-time bins are DEFAULT_PERIOD days long, doubled until the cube has
+# at most MAX_CUBE_CELLS cells and at least MIN_CUBE_DENSITY points per
+# cell; on a sparser cube any two nearby crimes would look significant
+DEFAULT_PERIOD = 7
+MAX_CUBE_CELLS = 8000000
+MIN_CUBE_DENSITY = 0.05
+
+# Most hot cells / space-time bins returned
+MAX_HOTSPOTS = 500
+
+# Rows fetched per round trip while loading points
+LOAD_BATCH = 100000
+
+
+class HotspotError(Exception):
+    pass
+
+
+def _numpy():
+    # Imported on first use; numpy is not needed to start the app
+    try:
+        import numpy
+    except ImportError:
+        raise HotspotError('Hotspot analysis requires the numpy package')
+    return numpy
+
+
+class PointStore:
+    """Geocoded crimes held as column arrays: id, latitude, longitude, day
+    (proleptic ordinal) and crime type code, sorted by id.
+
+    Rows written since the ``updated_at`` watermark are merged in place;
+    ``version`` changes whenever the points do, so analyses keyed on it are
+    never served stale.
+    """
+
+    def __init__(self):
+        np = _numpy()
+        self.ids = np.empty(0, dtype=np.int64)
+        self.lat = np.empty(0, dtype=np.float32)
+        self.lng = np.empty(0, dtype=np.float32)
+        self.day = np.empty(0, dtype=np.int32)
+        self.type = np.empty(0, dtype=np.int16)
+        self.types = {}
+        self.watermark = None
+        self.version = 0
+        self.refreshed = self.built = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return int((self.day >= 0).sum())
+
+    def type_code(self, crime_type):
+        return self.types.setdefault(crime_type, len(self.types))
+
+    def _columns(self, rows):
+        # Rows come from _crime_rows with every column but the type numeric
+        # and non-null, so each one is read straight into an array
+        np = _numpy()
+        count = len(rows)
+        ids, lat, lng, day = (np.fromiter(map(itemgetter(index), rows), dtype=dtype, count=count)
+                              for index, dtype in enumerate((np.int64, np.float32, np.float32, np.int32)))
+        kinds = list(map(itemgetter(4), rows))
+        codes = {kind: self.type_code(kind) for kind in dict.fromkeys(kinds)}
+        kind = np.fromiter(map(codes.__getitem__, kinds), dtype=np.int16, count=count)
+        latest = max(filter(None, map(itemgetter(5), rows)), default=None)
+        if latest is not None and (self.watermark is None or latest > self.watermark):
+            self.watermark = latest
+        return ids, lat, lng, day, kind
+
+    def merge(self, rows):
+        """Insert or overwrite ``(id, lat, lng, day, type, updated_at)`` rows
+        as returned by ``_crime_rows``."""
+        np = _numpy()
+        with self._lock:
+            ids, lat, lng, day, kind = self._columns(rows)
+            if not len(ids):
+                return
+            position = np.searchsorted(self.ids, ids)
+            known = position < len(self.ids)
+            known[known] = self.ids[position[known]] == ids[known]
+            columns = ((self.lat, lat), (self.lng, lng), (self.day, day), (self.type, kind))
+            # The watermark filter is inclusive, so a refresh sees its newest
+            # rows again; only a real change may invalidate cached analyses
+            changed = np.zeros(len(ids), dtype=bool)
+            for column, values in columns:
+                changed[known] |= column[position[known]] != values[known]
+            fresh = ~known
+            if not changed.any() and not fresh.any():
+                return
+            for column, values in columns:
+                column[position[changed]] = values[changed]
+            if fresh.any():
+                order = np.argsort(np.concatenate([self.ids, ids[fresh]]), kind='stable')
+                self.ids = np.concatenate([self.ids, ids[fresh]])[order]
+                self.lat = np.concatenate([self.lat, lat[fresh]])[order]
+                self.lng = np.concatenate([self.lng, lng[fresh]])[order]
+                self.day = np.concatenate([self.day, day[fresh]])[order]
+                self.type = np.concatenate([self.type, kind[fresh]])[order]
+            self.version += 1
+
+    def select(self, date_from=None, date_to=None, crime_type=None, bbox=None):
+        """Latitudes, longitudes and days of the matching points."""
+        np = _numpy()
+        with self._lock:
+            mask = self.day >= (date_from.toordinal() if date_from else 0)
+            if date_to:
+                mask &= self.day <= date_to.toordinal()
+            if crime_type:
+                if crime_type not in self.types:
+                    mask[:] = False
+                else:
+                    mask &= self.type == self.types[crime_type]
+            if bbox:
+                west, south, east, north = bbox
+                mask &= (self.lat >= south) & (self.lat <= north) & (self.lng >= west) & (self.lng <= east)
+            return self.lat[mask], self.lng[mask], self.day[mask]
+
+
+def _day_ordinal(dialect):
+    """``Crime.date`` as a proleptic ordinal (``date.toordinal()``) computed by the database."""
+    if dialect == 'postgresql':
+        return Crime.date - literal(date(1, 1, 1)) + 1
+    if dialect == 'sqlite':
+        return cast(func.julianday(Crime.date) - 1721424.5, Integer)
+    if dialect in ('mysql', 'mariadb'):
+        return func.to_days(Crime.date) - 365
+    raise HotspotError(f'No day ordinal for the {dialect} dialect')
+
+
+def _crime_rows(since=None):
+    """``(id, lat, lng, day, type, updated_at)`` rows; crimes without
+    coordinates or a date come back at 0, 0 with day -1."""
+    geocoded = Crime.latitude.isnot(None) & Crime.longitude.isnot(None) & Crime.date.isnot(None)
+    query = select(Crime.id, func.coalesce(Crime.latitude, 0.0), func.coalesce(Crime.longitude, 0.0),
+                   case((geocoded, _day_ordinal(db.session.get_bind().dialect.name)), else_=-1),
+                   Crime.type, Crime.updated_at)
+    if since is not None:
+        query = query.where(Crime.updated_at >= since)
+    else:
+        query = query.where(geocoded)
+    return db.session.execute(query.order_by(Crime.id).execution_options(yield_per=LOAD_BATCH))
+
+
+def build_store():
+    store = PointStore()
+    for rows in _crime_rows().partitions():
+        store.merge(rows)
+    store.refreshed = store.built = time.monotonic()
+    return store
+
+
+def _grid(lat, lng, bbox, resolution):
+    """Bin points into a rows x cols grid of roughly square cells over ``bbox``."""
+    np = _numpy()
+    west, south, east, north = bbox
+    # A degree of longitude shrinks with latitude; keep cells square on the ground
+    aspect = (east - west) * math.cos(math.radians((south + north) / 2)) / max(north - south, 1e-9)
+    if aspect >= 1:
+        cols, rows = resolution, max(1, round(resolution / aspect))
+    else:
+        rows, cols = resolution, max(1, round(resolution * aspect))
+    row = ((lat - south) * (rows / max(north - south, 1e-9))).astype(np.int64)
+    col = ((lng - west) * (cols / max(east - west, 1e-9))).astype(np.int64)
+    np.clip(row, 0, rows - 1, out=row)
+    np.clip(col, 0, cols - 1, out=col)
+    return row, col, rows, cols
+
+
+def _gaussian_matrix(size, bandwidth):
+    np = _numpy()
+    offsets = np.arange(size)
+    distance = (offsets[:, None] - offsets[None, :]) / bandwidth
+    kernel = np.exp(-0.5 * distance ** 2)
+    kernel[np.abs(distance) > 3] = 0
+    return kernel
+
+
+def kernel_density(counts, bandwidth):
+    """Gaussian kernel density of a count grid. The kernel is separable, so
+    smoothing is two matrix products rather than a 2-D convolution."""
+    rows, cols = counts.shape
+    return _gaussian_matrix(rows, bandwidth) @ counts @ _gaussian_matrix(cols, bandwidth).T
+
+
+def _window_sums(values, radius):
+    """Sum of every cell's neighbourhood (``radius`` cells along each axis,
+    clipped at the edges). A box is separable, so this is one running-sum
+    difference per axis."""
+    np = _numpy()
+    for axis, size in enumerate(values.shape):
+        index = np.arange(size)
+        running = np.concatenate([np.zeros_like(values.take([0], axis=axis)), values.cumsum(axis=axis)], axis=axis)
+        values = (running.take(np.minimum(index + radius[axis] + 1, size), axis=axis)
+                  - running.take(np.maximum(index - radius[axis], 0), axis=axis))
+    return values
+
+
+def _window_sizes(shape, radius):
+    # Cells in each neighbourhood: the product of its clipped extent per axis
+    np = _numpy()
+    sizes = 1
+    for axis, size in enumerate(shape):
+        index = np.arange(size)
+        extent = np.minimum(index + radius[axis] + 1, size) - np.maximum(index - radius[axis], 0)
+        sizes = np.multiply.outer(sizes, extent) if axis else extent
+    return sizes
+
+
+def getis_ord(counts, radius):
+    """Getis-Ord Gi* z-scores of a count grid or cube with binary weights
+    over each cell's neighbourhood."""
+    np = _numpy()
+    counts = counts.astype(np.float64)
+    n = counts.size
+    mean = counts.mean()
+    spread = math.sqrt(max((counts ** 2).mean() - mean ** 2, 0.0))
+    if n < 2 or spread == 0:
+        return np.zeros_like(counts)
+    local = _window_sums(counts, radius)
+    weights = _window_sizes(counts.shape, radius)
+    denominator = spread * np.sqrt((n * weights - weights ** 2) / (n - 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (local - mean * weights) / denominator
+    return np.nan_to_num(z)
+
+
+def _top(z, counts, threshold, limit):
+    # Cells without a crime of their own can score high from their
+    # neighbours alone; only cells with crimes are reported
+    np = _numpy()
+    hot = np.flatnonzero((z.ravel() >= threshold) & (counts.ravel() > 0))
+    if len(hot) > limit:
+        hot = hot[np.argpartition(-z.ravel()[hot], limit)[:limit]]
+    return hot[np.argsort(-z.ravel()[hot], kind='stable')]
+
+
+def analyze(lat, lng, day, bbox=None, resolution=DEFAULT_RESOLUTION, bandwidth=DEFAULT_BANDWIDTH,
+            period=DEFAULT_PERIOD, threshold=GI_THRESHOLD, date_from=None, date_to=None):
+    """Kernel density, Gi* hotspots and space-time hotspots of the given points.
+
+    Everything is computed on whole arrays: points are binned with
+    ``bincount`` and neighbourhood sums come from summed-area tables.
+    """
+    np = _numpy()
+    if not len(lat):
+        return {'points': 0, 'bounds': bbox, 'rows': 0, 'cols': 0, 'max_density': 0,
+                'density': [], 'hotspots': [], 'space_time': []}
+    if bbox is None:
+        bbox = (float(lng.min()), float(lat.min()), float(lng.max()), float(lat.max()))
+    west, south, east, north = bbox
+    row, col, rows, cols = _grid(lat, lng, bbox, resolution)
+    cell = row * cols + col
+    counts = np.bincount(cell, minlength=rows * cols).reshape(rows, cols)
+
+    density = kernel_density(counts.astype(np.float64), bandwidth)
+    peak = float(density.max())
+    # Quantised to a byte per cell to keep the response small
+    scaled = np.rint(density * (255 / peak)).astype(np.uint8) if peak else np.zeros((rows, cols), np.uint8)
+
+    cell_lat, cell_lng = (north - south) / rows, (east - west) / cols
+
+    def centre(r, c):
+        return round(south + (r + 0.5) * cell_lat, 6), round(west + (c + 0.5) * cell_lng, 6)
+
+    z = getis_ord(counts, (GI_RADIUS, GI_RADIUS))
+    hotspots = []
+    for index in _top(z, counts, threshold, MAX_HOTSPOTS):
+        r, c = divmod(int(index), cols)
+        hotspots.append(dict(zip(('lat', 'lng'), centre(r, c)), row=r, col=c,
+                                 count=int(counts[r, c]), z=round(float(z[r, c]), 2)))
+
+    first = date_from.toordinal() if date_from else int(day.min())
+    last = date_to.toordinal() if date_to else int(day.max())
+    while period <= last - first:
+        cube_cells = rows * cols * ((last - first) // period + 1)
+        if cube_cells <= MAX_CUBE_CELLS and len(lat) >= MIN_CUBE_DENSITY * cube_cells:
+            break
+        period *= 2
+    slices = (last - first) // period + 1
+    step = np.clip((day - first) // period, 0, slices - 1)
+    cube = np.bincount(step * (rows * cols) + cell, minlength=slices * rows * cols).reshape(slices, rows, cols)
+    cube_z = getis_ord(cube, (1, GI_RADIUS, GI_RADIUS))
+    space_time = []
+    for index in _top(cube_z, cube, threshold, MAX_HOTSPOTS):
+        t, rest = divmod(int(index), rows * cols)
+        r, c = divmod(rest, cols)
+        start = date.fromordinal(first + t * period)
+        space_time.append(dict(zip(('lat', 'lng'), centre(r, c)), row=r, col=c,
+                               start=start.isoformat(),
+                               end=min(start + timedelta(days=period - 1), date.fromordinal(last)).isoformat(),
+                               count=int(cube[t, r, c]), z=round(float(cube_z[t, r, c]), 2)))
+
+    return {
+        'points': int(len(lat)), 'bounds': [west, south, east, north], 'rows': rows, 'cols': cols,
+        'period_days': period, 'max_density': round(peak, 3), 'density': scaled.ravel().tolist(),
+        'hotspots': hotspots, 'space_time': space_time,
+    }
+
+
+_store = None
+_store_lock = threading.Lock()
+_loader_lock = threading.Lock()
+_loader_pid = None
+
+
+def _refresh_store(config):
+    """Build the store if it is missing or due a rebuild, else merge the rows
+    changed since its watermark. A rebuild happens beside the current store,
+    which keeps answering until the new one replaces it."""
+    global _store
+    with _store_lock:
+        now = time.monotonic()
+        if _store is None or now - _store.built > config.get('HOTSPOT_REBUILD', 3600):
+            _store = build_store()
+        elif now - _store.refreshed > config.get('HOTSPOT_REFRESH', 30):
+            for rows in _crime_rows(_store.watermark).partitions():
+                _store.merge(rows)
+            _store.refreshed = now
+
+
+def _load_forever(app):
+    while True:
+        try:
+            with app.app_context():
+                _refresh_store(app.config)
+        except Exception:
+            app.logger.exception('Loading hotspot points failed')
+        time.sleep(app.config.get('HOTSPOT_REFRESH', 30))
+
+
+def start_loader(app=None):
+    """Start the background thread that builds and refreshes the point
+    store in this process; started again after a fork."""
+    global _loader_pid
+    if _loader_pid == os.getpid():
+        return
+    with _loader_lock:
+        if _loader_pid != os.getpid():
+            _loader_pid = os.getpid()
+            threading.Thread(target=_load_forever, args=(app or current_app._get_current_object(),),
+                             name='hotspot-loader', daemon=True).start()
+
+
+def get_store():
+    """The process-wide point store.
+
+    With ``HOTSPOT_PRELOAD`` a background thread (see ``start_loader``)
+    builds it when the worker starts serving, merges rows changed since its
+    watermark every ``HOTSPOT_REFRESH`` seconds and rebuilds it every
+    ``HOTSPOT_REBUILD`` seconds to drop deleted crimes, so requests never
+    load crimes themselves. Without it (CLI commands, tests) the same work
+    happens here on use.
+    """
+    config = current_app.config
+    if config.get('HOTSPOT_PRELOAD', True):
+        start_loader()
+        if _store is None:
+            raise HotspotError('Hotspot data is still loading; try again shortly')
+        return _store
+    _refresh_store(config)
+    return _store
+
+
+class HotspotCache:
+    """Analyses keyed by point-store version, filters and grid resolution,
+    kept as JSON body and ETag like the dashboard summaries."""
+
+    def __init__(self, ttl=300, max_size=256):
+        self.ttl = ttl
+        self._entries = TTLCache(max_size=max_size, ttl=ttl)
+
+    def get(self, date_from=None, date_to=None, crime_type=None, bbox=None,
+            resolution=DEFAULT_RESOLUTION, bandwidth=DEFAULT_BANDWIDTH):
+        store = get_store()
+        key = (store.built, store.version, date_from, date_to, crime_type, bbox, resolution, bandwidth)
+        entry = self._entries.get(key)
+        if entry is None:
+            lat, lng, day = store.select(date_from, date_to, crime_type, bbox)
+            result = analyze(lat, lng, day, bbox=bbox, resolution=resolution, bandwidth=bandwidth,
+                             date_from=date_from, date_to=date_to)
+            body = json.dumps(result, separators=(',', ':'))
+            entry = (body, hashlib.sha1(body.encode()).hexdigest()[:20])
+            self._entries.set(key, entry)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+
+# Replaced by init_app according to the application config
+analyses = HotspotCache()
+
+
+@click.group('hotspots')
+def hotspots_cli():
+    """Crime hotspot analysis."""
+
+
+@hotspots_cli.command('bench')
+@click.option('--points', default=5000000, show_default=True)
+@click.option('--resolution', default=DEFAULT_RESOLUTION, show_default=True)
+@click.option('--repeat', default=3, show_default=True)
+@click.option('--seed', 'seed_value', default=0, show_default=True)
+def bench_command(points, resolution, repeat, seed_value):
+    """Time one analysis over synthetic points (no database needed)."""
+    np = _numpy()
+    rng = np.random.default_rng(seed_value)
+    # A uniform background plus a few dense clusters
+    centres = rng.uniform((40.5, -74.2), (40.9, -73.8), size=(20, 2))
+    clustered = points // 5
+    pick = rng.integers(0, len(centres), clustered)
+    lat = np.concatenate([rng.uniform(40.5, 40.9, points - clustered),
+                          centres[pick, 0] + rng.normal(0, 0.004, clustered)]).astype(np.float32)
+    lng = np.concatenate([rng.uniform(-74.2, -73.8, points - clustered),
+                          centres[pick, 1] + rng.normal(0, 0.004, clustered)]).astype(np.float32)
+    first = date(2020, 1, 1).toordinal()
+    day = rng.integers(first, first + 365 * 3, points).astype(np.int32)
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = analyze(lat, lng, day, resolution=resolution)
+        timings.append(time.perf_counter() - started)
+    click.echo(f'{points} points, {result["rows"]}x{result["cols"]} grid, {result["period_days"]}-day bins: '
+               f'best {min(timings) * 1000:.0f} ms, {len(result["hotspots"])} hot cells, '
+               f'{len(result["space_time"])} space-time hotspots')
+
+
+@hotspots_cli.command('load')
+@with_appcontext
+def load_command():
+    """Time loading the geocoded crimes into memory."""
+    started = time.perf_counter()
+    store = build_store()
+    click.echo(f'Loaded {len(store)} points in {time.perf_counter() - started:.1f}s')
+
+
+def init_app(app):
+    global analyses
+    analyses = HotspotCache(ttl=app.config.get('HOTSPOT_CACHE_TTL', 300))
+    if app.config.get('HOTSPOT_PRELOAD', True):
+        # On the worker's first request of any kind, so the store is ready
+        # (or loading) before anyone asks for a hotspot analysis
+        app.before_request(start_loader)
+    app.cli.add_command(hotspots_cli)
@@ -0,0 +1,299 @@
+import io
+import os
+import csv
+import time
+import logging
+from collections import Counter, OrderedDict
+from datetime import date, datetime, time as time_of_day
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, Time
+
+from app import db
+from models import (Crime, Criminal, CriminalCrime, Victim, Witness, Evidence,
+                    IngestCheckpoint)
+from geo import geohash_encode
+from rollups import apply_deltas, apply_map_deltas, map_cell_deltas, rollup_key
+from counters import apply_counter_deltas, crime_counter_keys
+from fragments import mark_changed
+
+# Rows per transaction; also the unit of checkpointing
+DEFAULT_CHUNK_SIZE = 20000
+
+# Source-system references kept in memory per kind while resolving foreign keys
+LOOKUP_CACHE_SIZE = 500000
+
+# Importable kinds. ``refs`` maps a ``<kind>_ref`` column in the source file to
+# the foreign key it resolves to through ``external_id``.
+KINDS = {
+    'criminals': dict(model=Criminal, refs={}),
+    'crimes': dict(model=Crime, refs={}),
+    'criminal_crime': dict(model=CriminalCrime, refs={'criminal_ref': ('criminal_id', Criminal),
+                                                      'crime_ref': ('crime_id', Crime)}),
+    'victims': dict(model=Victim, refs={'crime_ref': ('crime_id', Crime)}),
+    'witnesses': dict(model=Witness, refs={'crime_ref': ('crime_id', Crime)}),
+    'evidence': dict(model=Evidence, refs={'crime_ref': ('crime_id', Crime)}),
+}
+
+# Columns filled by the importer rather than the source file
+_MANAGED_COLUMNS = {'id', 'created_at', 'updated_at', 'geohash'}
+
+
+class RowError(ValueError):
+    pass
+
+
+def _coerce(column, value):
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if not isinstance(value, str):
+        return value
+    value = value.strip()
+    column_type = column.type
+    try:
+        if isinstance(column_type, DateTime):
+            return datetime.fromisoformat(value)
+        if isinstance(column_type, Date):
+            return date.fromisoformat(value[:10])
+        if isinstance(column_type, Time):
+            return time_of_day.fromisoformat(value)
+        if isinstance(column_type, Float):
+            return float(value)
+        if isinstance(column_type, Integer):
+            return int(value)
+        if isinstance(column_type, Boolean):
+            return value.lower() in ('1', 'true', 't', 'yes', 'y')
+    except ValueError:
+        raise RowError(f'{column.name}: invalid value {value!r}')
+    length = getattr(column_type, 'length', None)
+    if length and len(value) > length:
+        raise RowError(f'{column.name}: longer than {length} characters')
+    return value
+
+
+class ForeignKeyResolver:
+    """Maps source-system references to primary keys, one query per chunk.
+
+    Resolved references are kept in a bounded LRU so repeated references
+    (a crime with many victims) don't hit the database again, while memory
+    stays constant however large the import is.
+    """
+
+    def __init__(self, model, max_size=LOOKUP_CACHE_SIZE):
+        self.model = model
+        self.max_size = max_size
+        self._ids = OrderedDict()
+
+    def prime(self, refs):
+        missing = {ref for ref in refs if ref and ref not in self._ids}
+        missing = list(missing)
+        for start in range(0, len(missing), 1000):
+            batch = missing[start:start + 1000]
+            rows = db.session.query(self.model.external_id, self.model.id).filter(
+                self.model.external_id.in_(batch))
+            for external_id, pk in rows:
+                self._ids[external_id] = pk
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def resolve(self, ref):
+        pk = self._ids.get(ref)
+        if pk is not None:
+            self._ids.move_to_end(ref)
+        return pk
+
+
+def read_csv(path, chunk_size, skip=0):
+    with open(path, newline='', encoding='utf-8') as handle:
+        reader = csv.DictReader(handle)
+        chunk = []
+        for index, row in enumerate(reader):
+            if index < skip:
+                continue
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def read_parquet(path, chunk_size, skip=0):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise click.ClickException('Reading Parquet files requires the pyarrow package')
+    seen = 0
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        rows = batch.to_pylist()
+        if seen + len(rows) <= skip:
+            seen += len(rows)
+            continue
+        rows = rows[max(0, skip - seen):]
+        seen += batch.num_rows
+        yield rows
+
+
+def _copy_rows(connection, table, columns, rows):
+    """Load rows with PostgreSQL COPY through the raw psycopg2 cursor."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if row[name] is None else _copy_value(row[name]) for name in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+
+def _copy_value(value):
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (date, datetime, time_of_day)):
+        return value.isoformat()
+    return value
+
+
+class Ingestor:
+    """Streams one source file of a given kind into its table."""
+
+    def __init__(self, kind, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        spec = KINDS[kind]
+        self.kind = kind
+        self.source = source
+        self.chunk_size = chunk_size
+        self.model = spec['model']
+        self.table = self.model.__table__
+        self.refs = spec['refs']
+        self.resolvers = {ref: ForeignKeyResolver(target) for ref, (_, target) in self.refs.items()}
+        self.columns = [c for c in self.table.columns if c.name not in _MANAGED_COLUMNS]
+        self.required = [c.name for c in self.columns
+                         if not c.nullable and c.default is None and c.server_default is None]
+        self.errors = Counter()
+
+    def _checkpoint(self):
+        checkpoint = IngestCheckpoint.query.filter_by(source=self.source, kind=self.kind).first()
+        if checkpoint is None:
+            checkpoint = IngestCheckpoint(source=self.source, kind=self.kind, rows_done=0, rows_rejected=0)
+            db.session.add(checkpoint)
+            db.session.flush()
+        return checkpoint
+
+    def transform(self, chunk):
+        """Validate and convert one chunk; returns ``(rows, rejected)``."""
+        for ref, resolver in self.resolvers.items():
+            resolver.prime(row.get(ref) for row in chunk)
+
+        now = datetime.utcnow()
+        rows, rejected = [], 0
+        for raw in chunk:
+            try:
+                row = {}
+                for column in self.columns:
+                    value = _coerce(column, raw.get(column.name))
+                    if value is None and column.default is not None and column.default.is_scalar:
+                        value = column.default.arg
+                    row[column.name] = value
+                for ref, (fk, _) in self.refs.items():
+                    if raw.get(ref):
+                        row[fk] = self.resolvers[ref].resolve(raw[ref])
+                        if row[fk] is None:
+                            raise RowError(f'{ref}: unknown reference {raw[ref]!r}')
+                for name in self.required:
+                    if row.get(name) is None:
+                        raise RowError(f'{name}: required')
+            except RowError as exc:
+                rejected += 1
+                self.errors[str(exc).split(':')[0]] += 1
+                if sum(self.errors.values()) <= 10:
+                    logging.warning('ingest %s: rejected row: %s', self.kind, exc)
+                continue
+            if 'created_at' in self.table.c:
+                row['created_at'] = now
+            if 'updated_at' in self.table.c:
+                row['updated_at'] = now
+            if self.model is Crime:
+                has_point = row['latitude'] is not None and row['longitude'] is not None
+                row['geohash'] = geohash_encode(row['latitude'], row['longitude']) if has_point else None
+            rows.append(row)
+        return rows, rejected
+
+    def write(self, rows):
+        connection = db.session.connection()
+        if connection.dialect.name == 'postgresql':
+            _copy_rows(connection, self.table, list(rows[0].keys()), rows)
+        else:
+            connection.execute(self.table.insert(), rows)
+        mark_changed(db.session, self.table.name)
+        if self.model is Crime:
+            # Core inserts bypass the ORM flush hooks, so keep the rollup and counters current here
+            deltas = Counter(rollup_key(r['date'], r['type'], r['status'], r['latitude'], r['longitude'])
+                             for r in rows)
+            apply_deltas(connection, deltas)
+            apply_map_deltas(connection, map_cell_deltas(
+                (1, r['type'], r['status'], r['latitude'], r['longitude']) for r in rows))
+            apply_counter_deltas(connection, Counter(key for r in rows for key in crime_counter_keys(r['status'])))
+
+    def run(self, reader, progress=None):
+        checkpoint = self._checkpoint()
+        db.session.commit()
+        skip = checkpoint.rows_done + checkpoint.rows_rejected
+        started = time.perf_counter()
+        loaded = rejected = 0
+        for chunk in reader(self.source, self.chunk_size, skip=skip):
+            rows, chunk_rejected = self.transform(chunk)
+            if rows:
+                self.write(rows)
+            checkpoint = self._checkpoint()
+            checkpoint.rows_done += len(rows)
+            checkpoint.rows_rejected += chunk_rejected
+            db.session.commit()
+            db.session.expunge_all()
+            loaded += len(rows)
+            rejected += chunk_rejected
+            if progress:
+                progress(loaded, rejected, time.perf_counter() - started)
+        return loaded, rejected, time.perf_counter() - started
+
+
+@click.command('ingest')
+@click.argument('kind', type=click.Choice(sorted(KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'parquet']),
+              help='Defaults to the file extension.')
+@click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE, show_default=True)
+@click.option('--restart', is_flag=True, help='Ignore any saved checkpoint and start from the first row.')
+@with_appcontext
+def ingest_command(kind, path, file_format, chunk_size, restart):
+    """Bulk-load historical records of KIND from a CSV or Parquet file.
+
+    Rows may reference previously imported criminals and crimes through
+    criminal_ref/crime_ref columns holding their external_id. Progress is
+    checkpointed per chunk, so re-running the same command resumes.
+    """
+    source = os.path.abspath(path)
+    if file_format is None:
+        file_format = 'parquet' if path.endswith('.parquet') else 'csv'
+    if restart:
+        IngestCheckpoint.query.filter_by(source=source, kind=kind).delete()
+        db.session.commit()
+
+    def progress(loaded, rejected, elapsed):
+        rate = loaded / elapsed if elapsed else 0
+        click.echo(f'{kind}: {loaded} rows loaded, {rejected} rejected, {rate:,.0f} rows/sec')
+
+    ingestor = Ingestor(kind, source, chunk_size=chunk_size)
+    reader = read_parquet if file_format == 'parquet' else read_csv
+    loaded, rejected, elapsed = ingestor.run(reader, progress=progress)
+    rate = loaded / elapsed if elapsed else 0
+    click.echo(f'Done: {loaded} rows in {elapsed:.1f}s ({rate:,.0f} rows/sec), {rejected} rejected')
+    for reason, count in ingestor.errors.most_common():
+        click.echo(f'  rejected {count} rows: {reason}')
+
+
+def init_app(app):
+    app.cli.add_command(ingest_command)
@@ -0,0 +1,304 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from flask import (g, request, has_request_context, template_rendered, before_render_template,
+                   Response, abort, jsonify)
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import db
+
+# Upper bounds (seconds) of the request duration histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMetrics:
+    """Process-wide aggregates per endpoint, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.duration = defaultdict(float)
+        self.buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.queries = Counter()
+        self.db_time = defaultdict(float)
+        self.template_time = defaultdict(float)
+        self.slowest = {}
+
+    def observe(self, endpoint, status, elapsed, stats):
+        with self._lock:
+            self.requests[(endpoint, status)] += 1
+            self.duration[endpoint] += elapsed
+            buckets = self.buckets[endpoint]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    buckets[index] += 1
+            self.queries[endpoint] += stats.queries
+            self.db_time[endpoint] += stats.db_time
+            self.template_time[endpoint] += stats.template_time
+            if stats.slowest is not None and stats.slowest_time > self.slowest.get(endpoint, (None, 0.0))[1]:
+                self.slowest[endpoint] = (' '.join(stats.slowest.split()), stats.slowest_time)
+
+    def slowest_statements(self):
+        with self._lock:
+            return {endpoint: {'statement': statement, 'ms': round(elapsed * 1000, 2)}
+                    for endpoint, (statement, elapsed) in self.slowest.items()}
+
+    def render(self, extra_gauges=()):
+        lines = []
+        with self._lock:
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for endpoint, buckets in sorted(self.buckets.items()):
+                total = sum(count for (name, _), count in self.requests.items() if name == endpoint)
+                for bound, count in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {total}')
+                lines.append(f'http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {self.duration[endpoint]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{endpoint="{endpoint}"}} {total}')
+            for name, values, kind in (('db_queries_total', self.queries, 'counter'),
+                                       ('db_time_seconds_total', self.db_time, 'counter'),
+                                       ('template_render_seconds_total', self.template_time, 'counter')):
+                lines.append(f'# TYPE {name} {kind}')
+                for endpoint, value in sorted(values.items()):
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {value:g}')
+        typed = set()
+        for name, value in extra_gauges:
+            family = name.split('{')[0]
+            if family not in typed:
+                typed.add(family)
+                lines.append(f'# TYPE {family} gauge')
+            lines.append(f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    __slots__ = ('started', 'queries', 'db_time', 'slowest', 'slowest_time',
+                 'template_time', 'template_started', 'samples')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = None
+        self.slowest_time = 0.0
+        self.template_time = 0.0
+        self.template_started = None
+        self.samples = None
+
+
+class StackSampler:
+    """Samples the stacks of in-flight request threads on a timer.
+
+    Collapsed stacks (``frame;frame;frame count``) are kept per request and
+    written out only for requests slower than the threshold, ready for
+    flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, interval, threshold, directory):
+        self.interval = interval
+        self.threshold = threshold
+        self.directory = directory
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_running(self):
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+
+    def start(self, stats):
+        self._ensure_running()
+        stats.samples = Counter()
+        with self._lock:
+            self._active[threading.get_ident()] = stats.samples
+
+    def stop(self):
+        with self._lock:
+            return self._active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, samples in active.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                if stack:
+                    samples[';'.join(reversed(stack))] += 1
+
+    def dump(self, endpoint, elapsed, samples):
+        if elapsed < self.threshold or not samples:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        name = f'{int(time.time() * 1000)}-{os.getpid()}-{endpoint}-{elapsed * 1000:.0f}ms.folded'
+        with open(os.path.join(self.directory, name), 'w') as handle:
+            for stack, count in samples.most_common():
+                handle.write(f'{stack} {count}\n')
+
+
+metrics = RequestMetrics()
+sampler = None
+slow_query_seconds = None
+
+
+def _stats():
+    if has_request_context():
+        return g.get('_request_stats')
+    return None
+
+
+# The start time lives on the statement's execution context, which is
+# discarded with it: a statement that raises never reaches
+# after_cursor_execute, and must not leave state on the pooled connection.
+# Statements SQLAlchemy runs without a context (dialect setup, pre-executed
+# sequences) are not timed.
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats = _stats()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+        if elapsed > stats.slowest_time:
+            # Only the SQL text is kept; bound parameter values are never recorded
+            stats.slowest, stats.slowest_time = statement, elapsed
+    if slow_query_seconds is not None and elapsed >= slow_query_seconds:
+        logger.warning('Slow query (%.1f ms): %s', elapsed * 1000, ' '.join(statement.split()))
+
+
+def _before_render(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats.template_started = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats.template_started is not None:
+        stats.template_time += time.perf_counter() - stats.template_started
+        stats.template_started = None
+
+
+def _start_request():
+    stats = g._request_stats = RequestStats()
+    if sampler is not None:
+        sampler.start(stats)
+
+
+def _finish_request(response):
+    stats = g.pop('_request_stats', None)
+    if stats is None:
+        return response
+    elapsed = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+    view_time = max(0.0, elapsed - stats.db_time - stats.template_time)
+    response.headers['Server-Timing'] = ', '.join([
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"',
+        f'db-slowest;dur={stats.slowest_time * 1000:.1f}',
+        f'tpl;dur={stats.template_time * 1000:.1f}',
+        f'view;dur={view_time * 1000:.1f}',
+        f'total;dur={elapsed * 1000:.1f}',
+    ])
+    metrics.observe(endpoint, response.status_code, elapsed, stats)
+    if sampler is not None:
+        samples = sampler.stop()
+        sampler.dump(endpoint, elapsed, samples)
+    return response
+
+
+@contextmanager
+def count_queries(engine=None):
+    """Count SQL statements executed inside the block; yields a one-item list.
+
+    ``engine`` defaults to the app's engine, which needs an app context.
+    """
+    counter = [0]
+
+    def before_cursor_execute(*args):
+        counter[0] += 1
+
+    engine = engine if engine is not None else db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def _check_metrics_access():
+    token = os.environ.get('METRICS_TOKEN')
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+    elif not (current_user.is_authenticated and current_user.is_admin()):
+        abort(403)
+
+
+def metrics_view():
+    _check_metrics_access()
+
+    from user_cache import cache_stats
+    from db_routing import pool_gauges
+    from rate_limits import limiter_gauges
+    cache = cache_stats()
+    gauges = [('user_cache_hits', cache['hits']), ('user_cache_misses', cache['misses']),
+              ('user_cache_size', cache['size'])] + pool_gauges() + limiter_gauges()
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+def slow_queries_view():
+    _check_metrics_access()
+    return jsonify(metrics.slowest_statements())
+
+
+def init_app(app):
+    global sampler, slow_query_seconds
+    slow_ms = app.config.get('SLOW_QUERY_MS')
+    slow_query_seconds = slow_ms / 1000 if slow_ms else None
+    threshold_ms = app.config.get('PROFILE_THRESHOLD_MS')
+    if threshold_ms:
+        sampler = StackSampler(
+            interval=app.config.get('PROFILE_INTERVAL_MS', 5) / 1000,
+            threshold=threshold_ms / 1000,
+            directory=app.config.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles')),
+        )
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    # Run first so hooks registered earlier are timed too
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    app.add_url_rule('/metrics/slow_queries', 'slow_queries', slow_queries_view)
@@ -0,0 +1,638 @@
+import json
+import math
+import time
+import random
+import socket
+import asyncio
+import logging
+import resource
+import itertools
+import contextlib
+from collections import defaultdict
+from http import HTTPStatus
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import delete, event, func, insert, select
+
+from app import db
+from models import Crime, Case, Evidence, FeedEvent
+from geo import parse_bbox
+
+# Rows read per poll of feed_events
+FETCH_LIMIT = 5000
+
+# Rows replayed to a reconnecting client before it is told to reload instead
+REPLAY_LIMIT = 10000
+
+# Ids that are allocated but not yet visible are waited for this long, then
+# given up as rolled back; PostgreSQL commits need not follow id order
+GAP_TIMEOUT = 5.0
+
+# Seconds between comment lines that keep idle streams open through proxies
+HEARTBEAT = 15.0
+
+KINDS = ('crime', 'case', 'evidence')
+
+# Viewport subscribers are indexed on a grid of cells this many degrees
+# across; a viewport covering more than MAX_CELLS of them (about a degree
+# square) is matched against every row instead
+CELL_SIZE = 0.05
+MAX_CELLS = 400
+
+_pending_key = 'feed_events_written'
+
+logger = logging.getLogger(__name__)
+
+
+def _crime_payload(crime):
+    return {
+        'id': crime.id, 'type': crime.type, 'status': crime.status,
+        'date': crime.date.isoformat() if crime.date else None,
+        'time': crime.time.strftime('%H:%M') if crime.time else None,
+        'location': crime.location, 'lat': crime.latitude, 'lng': crime.longitude,
+        'station_id': crime.station_id,
+    }
+
+
+def _case_payload(case):
+    return {'id': case.id, 'title': case.title, 'status': case.status, 'priority': case.priority,
+            'crime_id': case.crime_id, 'officer_id': case.officer_id}
+
+
+def _evidence_payload(evidence):
+    return {'id': evidence.id, 'name': evidence.name, 'type': evidence.type, 'crime_id': evidence.crime_id}
+
+
+_FEED = {Crime: ('crime', _crime_payload), Case: ('case', _case_payload), Evidence: ('evidence', _evidence_payload)}
+
+# Set by init_app
+_enabled = True
+_notify_addr = None
+_notify_socket = None
+
+
+@event.listens_for(db.session, 'after_flush')
+def _record_changes(session, flush_context):
+    # Written in the flushing transaction, so the feed holds exactly what commits
+    if not _enabled:
+        return
+    changes = [(obj, 'insert') for obj in session.new if type(obj) in _FEED]
+    changes += [(obj, 'update') for obj in session.dirty if type(obj) in _FEED and session.is_modified(obj)]
+    changes += [(obj, 'delete') for obj in session.deleted if type(obj) in _FEED]
+    if not changes:
+        return
+    connection = session.connection()
+    # Cases and evidence are placed at their crime, for bounding-box filters
+    coordinates = {obj.id: (obj.latitude, obj.longitude) for obj, _ in changes if type(obj) is Crime}
+    missing = {obj.crime_id for obj, _ in changes if type(obj) is not Crime} - coordinates.keys() - {None}
+    if missing:
+        coordinates.update((crime_id, (lat, lng)) for crime_id, lat, lng in connection.execute(
+            select(Crime.id, Crime.latitude, Crime.longitude).where(Crime.id.in_(missing))))
+    now = datetime.utcnow()
+    rows = []
+    for obj, action in changes:
+        kind, payload = _FEED[type(obj)]
+        latitude, longitude = coordinates.get(obj.id if kind == 'crime' else obj.crime_id, (None, None))
+        rows.append({'kind': kind, 'entity_id': obj.id, 'action': action, 'latitude': latitude,
+                     'longitude': longitude, 'created_at': now,
+                     'payload': {'id': obj.id} if action == 'delete' else payload(obj)})
+    connection.execute(insert(FeedEvent.__table__), rows)
+    session.info[_pending_key] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _wake_feed(session):
+    if session.info.pop(_pending_key, None):
+        notify()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop(_pending_key, None)
+
+
+def notify():
+    """Nudge the feed server to poll now instead of at its next interval."""
+    global _notify_socket
+    if _notify_addr is None:
+        return
+    try:
+        if _notify_socket is None:
+            _notify_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            _notify_socket.setblocking(False)
+        _notify_socket.sendto(b'!', _notify_addr)
+    except OSError:
+        pass
+
+
+def _serializer(app=None):
+    return URLSafeTimedSerializer((app or current_app).secret_key, salt='live-feed')
+
+
+def issue_token(user):
+    """Signed token letting the feed server, which has no session, accept ``user``."""
+    return _serializer().dumps({'user': user.id, 'role': user.role})
+
+
+def feed_url():
+    return current_app.config.get('FEED_PUBLIC_URL') or '/live/events'
+
+
+def prune(retention):
+    """Delete feed rows older than ``retention``; returns the count."""
+    result = db.session.execute(delete(FeedEvent).where(FeedEvent.created_at < datetime.utcnow() - retention))
+    db.session.commit()
+    return result.rowcount
+
+
+_table = FeedEvent.__table__
+_columns = (_table.c.id, _table.c.kind, _table.c.action, _table.c.entity_id,
+            _table.c.latitude, _table.c.longitude, _table.c.payload)
+
+
+def _frame(row):
+    # One SSE message, encoded once however many subscribers receive it
+    data = json.dumps({'action': row.action, 'id': row.entity_id, 'data': row.payload}, separators=(',', ':'))
+    return f'id: {row.id}\nevent: {row.kind}\ndata: {data}\n\n'.encode()
+
+
+class Subscriber:
+    """One open event stream: its filters and the frames waiting to be written."""
+
+    __slots__ = ('bbox', 'kinds', 'after', 'buffer', 'wake', 'overflowed', 'closed', 'cells')
+
+    def __init__(self, bbox, kinds, after=0):
+        self.bbox = bbox
+        self.kinds = kinds
+        self.after = after
+        self.buffer = []
+        self.wake = asyncio.Event()
+        self.overflowed = False
+        self.closed = False
+        self.cells = None
+
+    def wants(self, kind, latitude, longitude):
+        if kind not in self.kinds:
+            return False
+        if self.bbox is None:
+            return True
+        if latitude is None or longitude is None:
+            return False
+        west, south, east, north = self.bbox
+        if not south <= latitude <= north:
+            return False
+        # A box crossing the antimeridian has west > east
+        return west <= longitude <= east if west <= east else longitude >= west or longitude <= east
+
+    def push(self, frame, limit):
+        if len(self.buffer) >= limit:
+            # A client this far behind reconnects and resumes from its last id
+            self.overflowed = True
+        else:
+            self.buffer.append(frame)
+        self.wake.set()
+
+
+def _cell(latitude, longitude):
+    return math.floor(latitude / CELL_SIZE), math.floor(longitude / CELL_SIZE)
+
+
+def _cells(bbox):
+    # Grid cells a viewport overlaps, or None for one too large to be worth indexing
+    west, south, east, north = bbox
+    (bottom, left), (top, right) = _cell(south, west), _cell(north, east)
+    rows = range(bottom, top + 1)
+    if west <= east:
+        columns = list(range(left, right + 1))
+    else:
+        columns = list(range(left, _cell(0, 180)[1])) + list(range(_cell(0, -180)[1], right + 1))
+    if len(rows) * len(columns) > MAX_CELLS:
+        return None
+    return [(row, column) for row in rows for column in columns]
+
+
+class FeedHub:
+    """Tails feed_events once for the whole process and fans each new row
+    out to the buffers of the subscribers whose filters match.
+
+    Subscribers watching a map viewport are filed under the grid cells it
+    covers, so a row is only tested against the viewports near
+    it plus the subscribers watching everywhere.
+    """
+
+    def __init__(self, app, poll_interval=0.5, queue_size=1000):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self._everywhere = set()
+        self._grid = defaultdict(set)
+        self.cursor = None  # every id up to here has been published
+        self.high = 0  # highest id published
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self._ahead = set()
+        self._blocked_since = None
+        self._wake = None
+        self._task = None
+
+    def _query(self, statement):
+        with self.app.app_context():
+            with db.engine.connect() as connection:
+                return connection.execute(statement).all()
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        if self.cursor is None:
+            rows = await asyncio.get_running_loop().run_in_executor(None, self._query, select(func.max(_table.c.id)))
+            self.cursor = self.high = rows[0][0] or 0
+        self._task = asyncio.create_task(self._run())
+
+    def add(self, subscriber):
+        self.subscribers.add(subscriber)
+        subscriber.cells = _cells(subscriber.bbox) if subscriber.bbox else None
+        if subscriber.cells is None:
+            self._everywhere.add(subscriber)
+        for cell in subscriber.cells or ():
+            self._grid[cell].add(subscriber)
+
+    def remove(self, subscriber):
+        self.subscribers.discard(subscriber)
+        self._everywhere.discard(subscriber)
+        for cell in subscriber.cells or ():
+            members = self._grid.get(cell)
+            if members is not None:
+                members.discard(subscriber)
+                if not members:
+                    del self._grid[cell]
+
+    async def close(self):
+        """Stop polling and end every open stream."""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for subscriber in list(self.subscribers):
+            subscriber.closed = True
+            subscriber.wake.set()
+
+    def poke(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                rows = await loop.run_in_executor(None, self._fetch)
+            except Exception:
+                logger.exception('Live feed poll failed')
+                rows = []
+            if rows:
+                self.publish(rows)
+            if len(rows) < FETCH_LIMIT:
+                try:
+                    async with asyncio.timeout(self.poll_interval):
+                        await self._wake.wait()
+                except TimeoutError:
+                    pass
+                self._wake.clear()
+
+    def _fetch(self):
+        rows = self._query(select(*_columns).where(_table.c.id > self.cursor).order_by(_table.c.id).limit(FETCH_LIMIT))
+        fresh = [row for row in rows if row.id not in self._ahead]
+        self._ahead.update(row.id for row in fresh)
+        self._advance()
+        return fresh
+
+    def _advance(self):
+        while self.cursor + 1 in self._ahead:
+            self.cursor += 1
+            self._ahead.remove(self.cursor)
+        if not self._ahead:
+            self._blocked_since = None
+        elif self._blocked_since is None:
+            self._blocked_since = time.monotonic()
+        elif time.monotonic() - self._blocked_since > GAP_TIMEOUT:
+            self.cursor = min(self._ahead) - 1
+            self._blocked_since = None
+            self._advance()
+
+    def publish(self, rows):
+        everywhere, grid, limit = self._everywhere, self._grid, self.queue_size
+        for row in rows:
+            frame = _frame(row)
+            row_id, kind, latitude, longitude = row.id, row.kind, row.latitude, row.longitude
+            nearby = ()
+            if latitude is not None and longitude is not None:
+                nearby = grid.get(_cell(latitude, longitude), ())
+            for subscriber in itertools.chain(everywhere, nearby):
+                if row_id > subscriber.after and subscriber.wants(kind, latitude, longitude):
+                    subscriber.push(frame, limit)
+            self.high = max(self.high, row_id)
+        self.published += len(rows)
+
+    async def replay(self, cursor):
+        """Frames a client resuming after ``cursor`` missed, or None if it must reload."""
+        if cursor >= self.high:
+            return []
+        loop = asyncio.get_running_loop()
+        oldest = (await loop.run_in_executor(None, self._query, select(func.min(_table.c.id))))[0][0]
+        if oldest is None or oldest > cursor + 1:
+            return None
+        rows = await loop.run_in_executor(None, self._query, select(*_columns).where(
+            _table.c.id > cursor, _table.c.id <= self.high).order_by(_table.c.id).limit(REPLAY_LIMIT + 1))
+        if len(rows) > REPLAY_LIMIT:
+            return None
+        return [_frame(row) for row in rows]
+
+    def stats(self):
+        return {'subscribers': len(self.subscribers), 'cursor': self.cursor, 'published': self.published,
+                'delivered': self.delivered, 'dropped': self.dropped}
+
+
+_STREAM_HEADERS = (b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                   b'Connection: keep-alive\r\nX-Accel-Buffering: no\r\nAccess-Control-Allow-Origin: *\r\n\r\n'
+                   b'retry: 3000\n\n')
+
+
+class _BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class FeedServer:
+    """Plain asyncio HTTP server for the event streams.
+
+    GET .../events?token=&bbox=west,south,east,north&types=crime,case
+    streams Server-Sent Events; a reconnecting EventSource sends
+    Last-Event-ID (or pass ?cursor=) and gets the rows it missed first.
+    GET .../health reports the hub's counters.
+    """
+
+    def __init__(self, app, hub, token_max_age=43200):
+        self.hub = hub
+        self.token_max_age = token_max_age
+        self._serializer = _serializer(app)
+
+    def _subscribe(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        method, target = lines[0].split(' ')[:2]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if method != 'GET':
+            raise _BadRequest(405, 'Only GET is supported')
+        if url.path.endswith('/health'):
+            raise _BadRequest(200, json.dumps(self.hub.stats()))
+        if not url.path.endswith('/events'):
+            raise _BadRequest(404, 'Not found')
+        try:
+            self._serializer.loads(params.get('token', ''), max_age=self.token_max_age)
+        except BadSignature:
+            raise _BadRequest(401, 'A valid token from /api/live/token is required')
+        bbox = None
+        if params.get('bbox'):
+            bbox = parse_bbox(params['bbox'])
+            if bbox is None:
+                raise _BadRequest(400, 'bbox must be west,south,east,north')
+        kinds = frozenset(params.get('types', ','.join(KINDS)).split(','))
+        if not kinds <= set(KINDS):
+            raise _BadRequest(400, f'types must be drawn from {",".join(KINDS)}')
+        cursor = headers.get('last-event-id') or params.get('cursor')
+        try:
+            cursor = int(cursor) if cursor else None
+        except ValueError:
+            raise _BadRequest(400, 'cursor must be an event id')
+        return Subscriber(bbox, kinds, cursor or 0), cursor
+
+    async def handle(self, reader, writer):
+        subscriber = None
+        try:
+            async with asyncio.timeout(10):
+                head = await reader.readuntil(b'\r\n\r\n')
+            try:
+                subscriber, cursor = self._subscribe(head)
+            except _BadRequest as exc:
+                body = str(exc).encode()
+                kind = 'application/json' if exc.status == 200 else 'text/plain'
+                writer.write(f'HTTP/1.1 {exc.status} {HTTPStatus(exc.status).phrase}\r\n'
+                             f'Content-Type: {kind}\r\nContent-Length: {len(body)}\r\n'
+                             f'Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n'.encode() + body)
+                await writer.drain()
+                return
+            # Join before replaying, so nothing published meanwhile is missed
+            self.hub.add(subscriber)
+            writer.write(_STREAM_HEADERS)
+            if cursor is not None:
+                frames = await self.hub.replay(cursor)
+                writer.write(b'event: reset\ndata: {}\n\n' if frames is None else b''.join(frames))
+            await writer.drain()
+            while not (subscriber.overflowed or subscriber.closed):
+                try:
+                    async with asyncio.timeout(HEARTBEAT):
+                        await subscriber.wake.wait()
+                except TimeoutError:
+                    writer.write(b': ping\n\n')
+                    await writer.drain()
+                    continue
+                subscriber.wake.clear()
+                frames, subscriber.buffer = subscriber.buffer, []
+                if frames:
+                    writer.write(b''.join(frames))
+                    self.hub.delivered += len(frames)
+                    await writer.drain()
+            if subscriber.overflowed:
+                self.hub.dropped += 1
+        except (ConnectionError, TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError, IndexError):
+            pass
+        finally:
+            if subscriber is not None:
+                self.hub.remove(subscriber)
+            writer.close()
+
+
+class _WakeProtocol(asyncio.DatagramProtocol):
+    # Datagrams from notify() in the web workers' commit hooks
+    def __init__(self, hub):
+        self.hub = hub
+
+    def datagram_received(self, data, addr):
+        self.hub.poke()
+
+
+async def start_feed(app, host, port, poll_interval=None, queue_size=None):
+    """Start the hub, TCP server and wake-up listener; returns ``(hub, server)``."""
+    hub = FeedHub(app, poll_interval=poll_interval or app.config.get('FEED_POLL_INTERVAL', 0.5),
+                  queue_size=queue_size or app.config.get('FEED_QUEUE_SIZE', 1000))
+    await hub.start()
+    feed = FeedServer(app, hub, token_max_age=app.config.get('FEED_TOKEN_MAX_AGE', 43200))
+    server = await asyncio.start_server(feed.handle, host, port, backlog=4096)
+    port = server.sockets[0].getsockname()[1]
+    await asyncio.get_running_loop().create_datagram_endpoint(lambda: _WakeProtocol(hub), local_addr=(host, port))
+    return hub, server
+
+
+def init_app(app):
+    global _enabled, _notify_addr
+    _enabled = app.config.get('FEED_ENABLED', True)
+    if _enabled:
+        _notify_addr = (app.config.get('FEED_HOST', '127.0.0.1'), app.config.get('FEED_PORT', 8001))
+    app.cli.add_command(live_feed_cli)
+
+
+@click.group('live-feed')
+def live_feed_cli():
+    """Server-Sent Events feed of crime, case and evidence changes."""
+
+
+@live_feed_cli.command('serve')
+@click.option('--host', default=None, help='Defaults to FEED_HOST.')
+@click.option('--port', type=int, default=None, help='Defaults to FEED_PORT.')
+@with_appcontext
+def serve_command(host, port):
+    """Run the feed server (one per host, next to the web workers)."""
+    app = current_app._get_current_object()
+    host = host or app.config.get('FEED_HOST', '127.0.0.1')
+    port = port or app.config.get('FEED_PORT', 8001)
+
+    async def run():
+        hub, server = await start_feed(app, host, port)
+        click.echo(f'Live feed on http://{host}:{port}/events from event {hub.cursor}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await hub.close()
+
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(run())
+
+
+@live_feed_cli.command('prune')
+@click.option('--retention-hours', type=int, default=None, help='Defaults to FEED_RETENTION_HOURS.')
+@with_appcontext
+def prune_command(retention_hours):
+    """Delete feed rows older than the retention period."""
+    if retention_hours is None:
+        retention_hours = current_app.config.get('FEED_RETENTION_HOURS', 24)
+    click.echo(f'Deleted {prune(timedelta(hours=retention_hours))} feed events')
+
+
+async def _bench_client(host, port, token, bbox, latencies, ready):
+    reader, writer = await asyncio.open_connection(host, port, limit=1 << 20)
+    query = f'token={token}&types=crime' + (f'&bbox={",".join(map(str, bbox))}' if bbox else '')
+    writer.write(f'GET /events?{query} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+    await writer.drain()
+    await reader.readuntil(b'retry: 3000\n\n')
+    ready()
+    try:
+        while chunk := await reader.read(1 << 16):
+            # Time the newest complete message in each read rather than parsing them all
+            end = chunk.rfind(b'\n\n')
+            start = chunk.rfind(b'data: ', 0, end)
+            if start != -1:
+                latencies.append(time.time() - json.loads(chunk[start + 6:end])['data']['sent'])
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+@live_feed_cli.command('bench')
+@click.option('--subscribers', default=5000, show_default=True)
+@click.option('--events', default=2000, show_default=True, help='Crime changes to publish.')
+@click.option('--rate', default=200, show_default=True, help='Changes committed per second.')
+@click.option('--bbox-share', default=0.9, show_default=True,
+              help='Fraction of subscribers watching a map viewport rather than everything.')
+@with_appcontext
+def bench_command(subscribers, events, rate, bbox_share):
+    """Fan feed rows out to many local SSE subscribers and time delivery.
+
+    Clients run in the same process and event loop as the server, so the
+    CPU figures include the client side too; latency is sampled once per
+    socket read.
+    """
+    app = current_app._get_current_object()
+    token = _serializer(app).dumps({'user': 0, 'role': 'bench'})
+    # Viewports of about 0.1 x 0.1 degrees around a 1 x 1 degree city
+    region = (-74.5, 40.2, -73.5, 41.2)
+
+    def viewport():
+        west = random.uniform(region[0], region[2] - 0.1)
+        south = random.uniform(region[1], region[3] - 0.1)
+        return (round(west, 4), round(south, 4), round(west + 0.1, 4), round(south + 0.1, 4))
+
+    def write_batch(count):
+        rows = [{'kind': 'crime', 'entity_id': 0, 'action': 'insert', 'created_at': datetime.utcnow(),
+                 'latitude': random.uniform(region[1], region[3]), 'longitude': random.uniform(region[0], region[2]),
+                 'payload': {'sent': time.time()}} for _ in range(count)]
+        with app.app_context(), db.engine.begin() as connection:
+            connection.execute(insert(_table), rows)
+        notify()
+
+    def remove_rows(first_id):
+        with app.app_context(), db.engine.begin() as connection:
+            connection.execute(delete(_table).where(_table.c.id > first_id))
+
+    async def run():
+        global _notify_addr
+        hub, server = await start_feed(app, '127.0.0.1', 0, poll_interval=0.5)
+        port = server.sockets[0].getsockname()[1]
+        saved_addr, _notify_addr = _notify_addr, ('127.0.0.1', port)
+        first_id = hub.cursor
+        latencies, connected = [], []
+        started = time.perf_counter()
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        clients = []
+        for i in range(subscribers):
+            bbox = viewport() if random.random() < bbox_share else None
+            clients.append(asyncio.create_task(
+                _bench_client('127.0.0.1', port, token, bbox, latencies, lambda: connected.append(1))))
+            if i % 200 == 199:
+                await asyncio.sleep(0)
+        while len(connected) < subscribers:
+            await asyncio.sleep(0.05)
+        connect_time = time.perf_counter() - started
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory
+
+        loop = asyncio.get_running_loop()
+        cpu, started = time.process_time(), time.perf_counter()
+        batch = max(1, rate // 20)
+        for sent in range(0, events, batch):
+            await loop.run_in_executor(None, write_batch, min(batch, events - sent))
+            await asyncio.sleep(max(0.0, (sent + batch) / rate - (time.perf_counter() - started)))
+        while hub.published < events and time.perf_counter() - started < events / rate + 30:
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(1.0)
+        elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu
+        stats = hub.stats()
+        await hub.close()
+        await asyncio.gather(*clients, return_exceptions=True)
+        server.close()
+        await server.wait_closed()
+        _notify_addr = saved_addr
+        await loop.run_in_executor(None, remove_rows, first_id)
+        return connect_time, memory, elapsed, cpu, stats, sorted(latencies)
+
+    connect_time, memory, elapsed, cpu, stats, latencies = asyncio.run(run())
+    click.echo(f'{subscribers} subscribers connected in {connect_time:.1f}s, '
+               f'~{memory * 1024 / subscribers / 1024:.1f} KiB each (max RSS growth)')
+    click.echo(f'{stats["published"]} changes in {elapsed:.1f}s, {stats["delivered"]} deliveries '
+               f'({stats["delivered"] / elapsed:,.0f}/s), {stats["dropped"]} slow clients dropped')
+    if latencies:
+        click.echo('commit to client: p50 {:.0f} ms, p99 {:.0f} ms, max {:.0f} ms'.format(
+            *(latencies[int(q * (len(latencies) - 1))] * 1000 for q in (0.5, 0.99, 1.0))))
+    click.echo(f'CPU {cpu:.1f}s ({cpu / elapsed:.0%} of one core, clients included)')
@@ -1,5 +1,7 @@
-from app import app
+from app import create_app
 
 # This file is used by Gunicorn to start the application
+app = create_app()
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,169 @@
+import logging
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, select, text
+from sqlalchemy.schema import AddConstraint, CreateColumn
+
+from app import db
+from models import Case, CaseNote, Crime, Criminal, OAuth, SchemaMigration
+import counters
+import geo
+import name_search
+import rollups
+import search
+import stations
+
+logger = logging.getLogger(__name__)
+
+
+# Columns added since the first release, per table; tables that do not exist
+# yet are created whole by a later step
+ADDED_COLUMNS = {
+    Crime.__table__: ('external_id', 'geohash', 'station_id'),
+    Criminal.__table__: ('external_id',),
+    OAuth.__table__: ('expires_at',),
+}
+
+
+def _add_columns(connection):
+    db_inspector = inspect(connection)
+    for table, names in ADDED_COLUMNS.items():
+        if not db_inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in db_inspector.get_columns(table.name)}
+        for name in names:
+            if name in existing:
+                continue
+            column = table.c[name]
+            spec = CreateColumn(column).compile(dialect=connection.dialect)
+            if connection.dialect.name == 'sqlite':
+                # SQLite cannot add constraints to an existing table, but
+                # accepts a REFERENCES clause on the new column
+                spec = ' '.join([str(spec)] + [
+                    f'REFERENCES {key.column.table.name} ({key.column.name})' for key in column.foreign_keys])
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {spec}'))
+            if connection.dialect.name != 'sqlite':
+                for key in column.foreign_keys:
+                    connection.execute(AddConstraint(key.constraint))
+            if column.unique:
+                connection.execute(text(
+                    f'CREATE UNIQUE INDEX uq_{table.name}_{name} ON {table.name} ({name})'))
+
+
+def _create_tables(connection):
+    db.metadata.create_all(connection)
+
+
+def _index_names(connection, table):
+    if connection.dialect.name == 'sqlite':
+        # Reflection skips expression indexes on SQLite
+        return set(connection.scalars(
+            text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+            {'table': table.name}))
+    return {index['name'] for index in inspect(connection).get_indexes(table.name)}
+
+
+def _create_indexes(connection):
+    for table in (Crime.__table__, Criminal.__table__, Case.__table__, CaseNote.__table__, OAuth.__table__):
+        existing = _index_names(connection, table)
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+def _create_search_structures(connection):
+    if connection.dialect.name == 'postgresql':
+        for statement in [name_search.PG_TRGM_EXTENSION, *name_search.PG_TRGM_DDL, *search.PG_SEARCH_DDL]:
+            connection.execute(text(statement))
+    elif connection.dialect.name == 'sqlite':
+        for statement in search.SQLITE_FTS_DDL:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO crimes_fts(crimes_fts) VALUES ('rebuild')"))
+
+
+def _rebuild_derived_data(connection):
+    logger.info('Backfilled %d crime geohashes', geo.backfill_geohashes())
+    try:
+        logger.info('Assigned %d crimes to their nearest station', stations.backfill_crime_stations())
+    except stations.StationIndexError as exc:
+        logger.warning('%s; run `flask stations backfill` once it is installed', exc)
+    rollups.rebuild_rollups()
+    rollups.rebuild_map_cells()
+    counters.rebuild_counters()
+
+
+# Applied in order, each in its own transaction and recorded in
+# schema_migrations. Append new steps; never renumber or edit applied ones.
+MIGRATIONS = [
+    (1, 'add_columns', _add_columns),
+    (2, 'create_tables', _create_tables),
+    (3, 'create_indexes', _create_indexes),
+    (4, 'create_search_structures', _create_search_structures),
+    (5, 'rebuild_derived_data', _rebuild_derived_data),
+]
+
+
+def applied_versions():
+    """Versions recorded in ``schema_migrations``; empty if it does not exist."""
+    if not inspect(db.session.connection()).has_table(SchemaMigration.__tablename__):
+        return set()
+    return set(db.session.scalars(select(SchemaMigration.version)))
+
+
+def _record(version, name):
+    db.session.add(SchemaMigration(version=version, name=name))
+    db.session.commit()
+
+
+def upgrade():
+    """Bring the schema to the current version; returns the names applied.
+
+    An empty database gets the whole schema at once and every migration is
+    recorded as applied. A database created before migrations were tracked
+    runs all of them; each step skips what already exists.
+    """
+    connection = db.session.connection()
+    if not inspect(connection).has_table(Crime.__tablename__):
+        db.metadata.create_all(connection)
+        for version, name, _ in MIGRATIONS:
+            db.session.add(SchemaMigration(version=version, name=name))
+        db.session.commit()
+        return []
+    SchemaMigration.__table__.create(connection, checkfirst=True)
+    done = applied_versions()
+    applied = []
+    for version, name, migrate in MIGRATIONS:
+        if version in done:
+            continue
+        logger.info('Applying schema migration %d %s', version, name)
+        migrate(db.session.connection())
+        _record(version, name)
+        applied.append(name)
+    return applied
+
+
+@click.group('migrations')
+def migrations_cli():
+    """Versioned schema migrations."""
+
+
+@migrations_cli.command('upgrade')
+@with_appcontext
+def upgrade_command():
+    """Apply pending schema migrations."""
+    applied = upgrade()
+    click.echo(f'Applied {len(applied)} migrations' + (f': {", ".join(applied)}' if applied else ''))
+
+
+@migrations_cli.command('status')
+@with_appcontext
+def status_command():
+    """List migrations and whether each has been applied."""
+    done = applied_versions()
+    for version, name, _ in MIGRATIONS:
+        click.echo(f'{version:4d}  {name:28s} {"applied" if version in done else "pending"}')
+
+
+def init_app(app):
+    app.cli.add_command(migrations_cli)
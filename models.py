@@ -1,8 +1,11 @@
-from app import db
+from app import db, login_manager
 from datetime import datetime
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy import UniqueConstraint
+from user_cache import load_cached_user, watch_model
+from passwords import hash_password
 
 # User model with role-based access control
 class User(UserMixin, db.Model):
@@ -30,7 +33,7 @@ class User(UserMixin, db.Model):
     assigned_cases = db.relationship('Case', backref='assigned_officer', lazy='dynamic')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
         
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -47,6 +50,40 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
+# Role, activation and password changes must never be served from a stale cache
+watch_model(User)
+
+@login_manager.user_loader
+def load_user(user_id):
+    try:
+        return load_cached_user(db.session, User, int(user_id))
+    except (TypeError, ValueError):
+        return None
+
+# OAuth tokens for Replit authentication (see r_auth.py and oauth_tokens.py)
+# Same table and columns as flask_dance's OAuthConsumerMixin, declared here
+# so that importing the models does not import flask_dance
+class OAuth(db.Model):
+    __tablename__ = 'flask_dance_oauth'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    provider = db.Column(db.String(50), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    token = db.Column(MutableDict.as_mutable(db.JSON), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id))
+    browser_session_key = db.Column(db.String, nullable=False)
+    # When the row may be purged: the token's own expiry, or the retention
+    # window for tokens that can still be refreshed
+    expires_at = db.Column(db.DateTime, index=True)
+    user = db.relationship(User)
+
+    __table_args__ = (UniqueConstraint(
+        'user_id',
+        'browser_session_key',
+        'provider',
+        name='uq_user_browser_session_key_provider',
+    ),)
+
 # Police Station model
 class PoliceStation(db.Model):
     __tablename__ = 'police_stations'
@@ -91,6 +128,7 @@ class Criminal(db.Model):
     __tablename__ = 'criminals'
     
     id = db.Column(db.Integer, primary_key=True)
+    external_id = db.Column(db.String(64), unique=True)  # record ID in the source system, see ingest.py
     name = db.Column(db.String(100), nullable=False)
     alias = db.Column(db.String(100))
     gender = db.Column(db.String(10))
@@ -105,6 +143,11 @@ class Criminal(db.Model):
     # Relationships
     crimes = db.relationship('CriminalCrime', backref='criminal', lazy='dynamic')
     
+    # updated_at lets the in-process name index catch up on changed rows
+    __table_args__ = (
+        db.Index('ix_criminals_updated_at', 'updated_at'),
+    )
+    
     def __repr__(self):
         return f'<Criminal {self.name}>'
 
@@ -113,6 +156,7 @@ class Crime(db.Model):
     __tablename__ = 'crimes'
     
     id = db.Column(db.Integer, primary_key=True)
+    external_id = db.Column(db.String(64), unique=True)  # record ID in the source system, see ingest.py
     type = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     date = db.Column(db.Date, nullable=False)
@@ -120,7 +164,9 @@ class Crime(db.Model):
     location = db.Column(db.String(255))
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12))  # derived from latitude/longitude, see geo.py
     status = db.Column(db.String(20), default='reported')  # reported, investigating, solved, closed
+    station_id = db.Column(db.Integer, db.ForeignKey('police_stations.id'))  # nearest station, see stations.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -131,6 +177,22 @@ class Crime(db.Model):
     evidence = db.relationship('Evidence', backref='crime', lazy='dynamic')
     cases = db.relationship('Case', backref='crime', lazy='dynamic')
     
+    # Composite indexes ending in (date, id) serve both the list filters and
+    # keyset pagination; see search.py for the full-text indexes
+    __table_args__ = (
+        db.Index('ix_crimes_date_id', 'date', 'id'),
+        db.Index('ix_crimes_type_date_id', 'type', 'date', 'id'),
+        db.Index('ix_crimes_status_date_id', 'status', 'date', 'id'),
+        # Case-insensitive prefix search on location; search.py creates the
+        # PostgreSQL variant with text_pattern_ops
+        db.Index('ix_crimes_location_lower', db.func.lower(location))
+        .ddl_if(callable_=lambda ddl, target, bind, dialect, **kw: dialect.name != 'postgresql'),
+        db.Index('ix_crimes_geohash', 'geohash'),
+        db.Index('ix_crimes_lat_lng', 'latitude', 'longitude'),
+        db.Index('ix_crimes_updated_at', 'updated_at'),
+        db.Index('ix_crimes_station_id', 'station_id'),
+    )
+    
     def __repr__(self):
         return f'<Crime {self.id}: {self.type}>'
 
@@ -161,6 +223,10 @@ class Case(db.Model):
     # Relationships
     notes = db.relationship('CaseNote', backref='case', lazy='dynamic')
     
+    __table_args__ = (
+        db.Index('ix_cases_officer_id', 'officer_id'),
+    )
+    
     def __repr__(self):
         return f'<Case {self.id}: {self.title}>'
 
@@ -178,6 +244,10 @@ class CaseNote(db.Model):
     # Relationships
     user = db.relationship('User', backref='case_notes')
     
+    __table_args__ = (
+        db.Index('ix_case_notes_created_at', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<CaseNote {self.id}>'
 
@@ -233,4 +303,239 @@ class Evidence(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
-        return f'<Evidence {self.name}>'
\ No newline at end of file
+        return f'<Evidence {self.name}>'
+
+# Daily crime rollup, maintained incrementally by rollups.py
+class CrimeDailyStat(db.Model):
+    __tablename__ = 'crime_daily_stats'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    type = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    location_bucket = db.Column(db.String(100), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        UniqueConstraint('day', 'type', 'status', 'location_bucket', name='uq_crime_daily_stats_key'),
+    )
+    
+    def __repr__(self):
+        return f'<CrimeDailyStat {self.day} {self.type}: {self.count}>'
+
+# Crime counts per geohash cell behind the zoomed-out crime map, maintained
+# by rollups.py alongside the daily rollup
+class CrimeMapCell(db.Model):
+    __tablename__ = 'crime_map_cells'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    precision = db.Column(db.SmallInteger, nullable=False)
+    cell = db.Column(db.String(12), nullable=False)
+    type = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    latitude = db.Column(db.Float, nullable=False)  # centre of the cell
+    longitude = db.Column(db.Float, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    latitude_sum = db.Column(db.Float, nullable=False, default=0)
+    longitude_sum = db.Column(db.Float, nullable=False, default=0)
+    
+    __table_args__ = (
+        UniqueConstraint('precision', 'cell', 'type', 'status', name='uq_crime_map_cells_key'),
+        db.Index('ix_crime_map_cells_position', 'precision', 'latitude', 'longitude'),
+    )
+    
+    def __repr__(self):
+        return f'<CrimeMapCell {self.cell} {self.type}: {self.count}>'
+
+# Dashboard totals maintained from write events (see counters.py)
+class DashboardCounter(db.Model):
+    __tablename__ = 'dashboard_counters'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    key = db.Column(db.String(64), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        UniqueConstraint('name', 'key', name='uq_dashboard_counters_name_key'),
+    )
+    
+    def __repr__(self):
+        return f'<DashboardCounter {self.name}[{self.key}]: {self.count}>'
+
+# Progress of a resumable bulk import, committed together with each chunk
+class IngestCheckpoint(db.Model):
+    __tablename__ = 'ingest_checkpoints'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(512), nullable=False)
+    kind = db.Column(db.String(50), nullable=False)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    rows_rejected = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('source', 'kind', name='uq_ingest_checkpoint_source_kind'),
+    )
+    
+    def __repr__(self):
+        return f'<IngestCheckpoint {self.kind} {self.source}: {self.rows_done}>'
+
+# Server-side session data; the session cookie only holds the signed id
+class SessionRecord(db.Model):
+    __tablename__ = 'sessions'
+    
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<SessionRecord {self.id[:8]} until {self.expires_at}>'
+
+# Background export of crimes, cases or evidence to a file (see exports.py)
+class ExportJob(db.Model):
+    __tablename__ = 'export_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    format = db.Column(db.String(10), nullable=False)
+    filters = db.Column(db.JSON)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    requested_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    claimed_by = db.Column(db.String(100))
+    rows_total = db.Column(db.Integer)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    file_path = db.Column(db.String(512))
+    file_size = db.Column(db.BigInteger)
+    error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_export_jobs_status_id', 'status', 'id'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id, 'kind': self.kind, 'format': self.format, 'filters': self.filters or {},
+            'status': self.status, 'rows_done': self.rows_done, 'rows_total': self.rows_total,
+            'progress': round(self.rows_done / self.rows_total, 4) if self.rows_total else None,
+            'file_size': self.file_size, 'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+    
+    def __repr__(self):
+        return f'<ExportJob {self.id} {self.kind}.{self.format}: {self.status}>'
+
+# Append-only record of changes to audited models, written in batches by audit.py
+class AuditEvent(db.Model):
+    __tablename__ = 'audit_events'
+    
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    entity_type = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(10), nullable=False)  # insert, update, delete
+    changes = db.Column(db.JSON, nullable=False)  # {column: [old, new]}
+    user_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_audit_events_entity', 'entity_type', 'entity_id', 'id'),
+        # PostgreSQL: ranges of ids live in separate partitions (see audit.py)
+        {'info': {'partition_by': 'RANGE (id)'}},
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id, 'entity_type': self.entity_type, 'entity_id': self.entity_id,
+            'action': self.action, 'changes': self.changes, 'user_id': self.user_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+        }
+
+# Content-addressed file stored once on disk by evidence_store.py, however
+# many evidence items attach it
+class EvidenceBlob(db.Model):
+    __tablename__ = 'evidence_blobs'
+    
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    content_type = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_linked_at = db.Column(db.DateTime, default=datetime.utcnow)  # guards blobs being re-attached from gc
+    
+    def __repr__(self):
+        return f'<EvidenceBlob {self.sha256[:12]} {self.size}>'
+
+# A file attached to an evidence item
+class EvidenceFile(db.Model):
+    __tablename__ = 'evidence_files'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    evidence_id = db.Column(db.Integer, db.ForeignKey('evidence.id'), nullable=False, index=True)
+    sha256 = db.Column(db.String(64), db.ForeignKey('evidence_blobs.sha256'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(100))
+    size = db.Column(db.BigInteger, nullable=False)
+    uploaded_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'id': self.id, 'evidence_id': self.evidence_id, 'sha256': self.sha256,
+            'filename': self.filename, 'content_type': self.content_type, 'size': self.size,
+            'uploaded_by': self.uploaded_by,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+        }
+    
+    def __repr__(self):
+        return f'<EvidenceFile {self.filename}>'
+
+# Resumable upload in progress; the bytes received so far are in a part file
+class EvidenceUpload(db.Model):
+    __tablename__ = 'evidence_uploads'
+    
+    id = db.Column(db.String(32), primary_key=True)
+    evidence_id = db.Column(db.Integer, db.ForeignKey('evidence.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(100))
+    size = db.Column(db.BigInteger, nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<EvidenceUpload {self.id} {self.filename}>'
+
+# Change log of crimes, cases and evidence that live_feed.py streams to
+# browsers; rows older than FEED_RETENTION_HOURS are pruned
+class FeedEvent(db.Model):
+    __tablename__ = 'feed_events'
+    
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # crime, case, evidence
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(10), nullable=False)  # insert, update, delete
+    latitude = db.Column(db.Float)  # of the crime the row belongs to, for bounding-box filters
+    longitude = db.Column(db.Float)
+    payload = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_feed_events_created_at', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f'<FeedEvent {self.id} {self.kind} {self.entity_id} {self.action}>'
+
+# Schema migrations applied to this database (see migrations.py)
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SchemaMigration {self.version} {self.name}>'
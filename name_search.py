@@ -0,0 +1,340 @@
+import os
+import re
+import heapq
+import time
+import pickle
+import threading
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import DDL, event, text
+
+from app import db
+from models import Criminal
+from change_tracking import CATCH_UP_MARGIN, catch_up_since
+
+# Default minimum similarity for a candidate to be returned
+DEFAULT_THRESHOLD = 0.3
+
+# Trigrams shared by more rows than this (ratio of the index, but never less
+# than the minimum) are not used to generate candidates
+COMMON_TRIGRAM_RATIO = 0.01
+COMMON_TRIGRAM_MIN = 1000
+
+# PostgreSQL: trigram GIN indexes so `%` and similarity() avoid a full scan
+PG_TRGM_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+PG_TRGM_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_criminals_{_column}_trgm ON criminals USING gin ({_column} gin_trgm_ops)"
+    for _column in ('name', 'alias')
+]
+event.listen(Criminal.__table__, 'before_create', DDL(PG_TRGM_EXTENSION).execute_if(dialect='postgresql'))
+for _statement in PG_TRGM_DDL:
+    event.listen(Criminal.__table__, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+
+_WORD = re.compile(r'[^\W_]+')
+
+
+class NameIndexLoading(Exception):
+    pass
+
+
+def trigrams(value):
+    """Trigram set of ``value`` using the same padding rules as pg_trgm."""
+    grams = set()
+    for word in _WORD.findall((value or '').lower()):
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(left, right):
+    if not left or not right:
+        return 0.0
+    shared = len(left & right)
+    return shared / (len(left) + len(right) - shared)
+
+
+class NameIndex:
+    """In-process trigram inverted index over criminal names and aliases.
+
+    Used where pg_trgm is not available. Scores match pg_trgm's
+    ``similarity()``: shared trigrams over the size of their union, taking
+    the better of name and alias.
+    """
+
+    def __init__(self):
+        self._names = {}
+        self._postings = defaultdict(set)
+        self._lock = threading.Lock()
+        self.watermark = None
+        self.refreshed = self.reconciled = 0.0
+
+    def __len__(self):
+        return len(self._names)
+
+    def _remove(self, criminal_id):
+        entry = self._names.pop(criminal_id, None)
+        if entry is None:
+            return
+        for gram in entry[2] | entry[3]:
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(criminal_id)
+                if not ids:
+                    del self._postings[gram]
+
+    def _add(self, criminal_id, name, alias):
+        self._remove(criminal_id)
+        name_grams, alias_grams = trigrams(name), trigrams(alias)
+        self._names[criminal_id] = (name, alias, name_grams, alias_grams)
+        for gram in name_grams | alias_grams:
+            self._postings[gram].add(criminal_id)
+
+    def update(self, rows, removed=()):
+        """Apply ``(id, name, alias, updated_at)`` rows and removed ids."""
+        with self._lock:
+            for criminal_id in removed:
+                self._remove(criminal_id)
+            for criminal_id, name, alias, updated_at in rows:
+                self._add(criminal_id, name, alias)
+                if updated_at is not None and (self.watermark is None or updated_at > self.watermark):
+                    self.watermark = updated_at
+
+    def search(self, term, limit=10, threshold=DEFAULT_THRESHOLD):
+        """Return up to ``limit`` ``(id, name, alias, score)`` tuples, best first.
+
+        Candidates come from the query's rarer trigrams only; trigrams found
+        in more than ``COMMON_TRIGRAM_RATIO`` of all rows (" pe", "son") would
+        drag in most of the table while adding little to the ranking. Every
+        candidate is still scored on all of its trigrams.
+        """
+        query = trigrams(term)
+        if not query:
+            return []
+        with self._lock:
+            common = max(COMMON_TRIGRAM_MIN, int(len(self._names) * COMMON_TRIGRAM_RATIO))
+            postings = sorted((self._postings.get(gram, ()) for gram in query), key=len)
+            selective = [ids for ids in postings if len(ids) <= common] or postings[:1]
+            candidates = set().union(*selective)
+            results = []
+            for criminal_id in candidates:
+                name, alias, name_grams, alias_grams = self._names[criminal_id]
+                score = max(similarity(query, name_grams), similarity(query, alias_grams))
+                if score >= threshold:
+                    results.append((criminal_id, name, alias, score))
+        return heapq.nsmallest(limit, results, key=lambda row: (-row[3], row[0]))
+
+    def save(self, path):
+        with self._lock:
+            state = {'watermark': self.watermark,
+                     'names': {cid: entry[:2] for cid, entry in self._names.items()}}
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as handle:
+            pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as handle:
+            state = pickle.load(handle)
+        index = cls()
+        index.update((cid, name, alias, None) for cid, (name, alias) in state['names'].items())
+        index.watermark = state['watermark']
+        return index
+
+
+_index = None
+_index_lock = threading.Lock()
+_loader_lock = threading.Lock()
+_loader_pid = None
+_pending_key = 'criminal_name_changes'
+
+
+def _criminal_rows(query):
+    return query.with_entities(Criminal.id, Criminal.name, Criminal.alias, Criminal.updated_at).yield_per(10000)
+
+
+def build_index():
+    index = NameIndex()
+    index.update(_criminal_rows(Criminal.query))
+    index.refreshed = index.reconciled = time.monotonic()
+    return index
+
+
+def _catch_up(index, full=False, margin=CATCH_UP_MARGIN):
+    """Pull rows changed since the index watermark, e.g. by other workers or
+    bulk loads; ``full`` also drops criminals deleted since (by anyone)."""
+    query = Criminal.query
+    since = catch_up_since(index.watermark, margin)
+    if since is not None:
+        query = query.filter(Criminal.updated_at >= since)
+    rows = list(_criminal_rows(query))
+    removed = ()
+    if full:
+        live = {row[0] for row in db.session.query(Criminal.id)}
+        with index._lock:
+            removed = [cid for cid in index._names if cid not in live]
+        index.reconciled = time.monotonic()
+    index.update(rows, removed)
+    index.refreshed = time.monotonic()
+
+
+def _refresh_index(config):
+    """Load the index if there is none, else apply what changed since the
+    last refresh; every ``NAME_INDEX_RECONCILE`` seconds compare its ids
+    with the table so deletes made by other workers drop out."""
+    global _index
+    margin = config.get('CATCH_UP_MARGIN', CATCH_UP_MARGIN)
+    with _index_lock:
+        now = time.monotonic()
+        if _index is None:
+            path = config.get('NAME_INDEX_PATH')
+            if path and os.path.exists(path):
+                index = NameIndex.load(path)
+                _catch_up(index, full=True, margin=margin)
+            else:
+                index = build_index()
+            _index = index
+        elif now - _index.reconciled > config.get('NAME_INDEX_RECONCILE', 300):
+            _catch_up(_index, full=True, margin=margin)
+        elif now - _index.refreshed > config.get('NAME_INDEX_REFRESH', 30):
+            _catch_up(_index, margin=margin)
+
+
+def _load_forever(app):
+    while True:
+        try:
+            with app.app_context():
+                _refresh_index(app.config)
+        except Exception:
+            app.logger.exception('Refreshing the criminal name index failed')
+        time.sleep(app.config.get('NAME_INDEX_REFRESH', 30))
+
+
+def start_loader():
+    """Start the thread that loads and refreshes the index in this process;
+    started again after a fork. Not needed on PostgreSQL."""
+    global _loader_pid
+    if _loader_pid == os.getpid():
+        return
+    with _loader_lock:
+        if _loader_pid != os.getpid():
+            _loader_pid = os.getpid()
+            if db.engine.dialect.name != 'postgresql':
+                threading.Thread(target=_load_forever, args=(current_app._get_current_object(),),
+                                 name='name-index-loader', daemon=True).start()
+
+
+def get_index():
+    """The process-wide index.
+
+    With ``NAME_INDEX_PRELOAD`` it is loaded (from the snapshot, or built)
+    and kept current by the thread ``start_loader`` starts on the worker's
+    first request, and searches made before it is ready raise
+    ``NameIndexLoading``. Without it (CLI commands, tests) it is loaded and
+    refreshed here on use.
+    """
+    config = current_app.config
+    if config.get('NAME_INDEX_PRELOAD', True):
+        start_loader()
+        if _index is None:
+            raise NameIndexLoading('The criminal name index is still loading; try again shortly')
+        return _index
+    _refresh_index(config)
+    return _index
+
+
+def search_criminals(term, limit=10, threshold=DEFAULT_THRESHOLD):
+    """Rank criminals by fuzzy match of ``term`` against name and alias.
+
+    Returns a list of ``{'id', 'name', 'alias', 'score'}`` dicts, best first.
+    """
+    term = (term or '').strip()
+    if not term:
+        return []
+    if db.engine.dialect.name == 'postgresql':
+        # SET LOCAL (set_config with is_local) takes a bind parameter and ends
+        # with the transaction, unlike set_limit(), which sticks to the pooled
+        # connection for whoever checks it out next
+        db.session.execute(text("SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)"),
+                           {'threshold': str(float(threshold))})
+        rows = db.session.execute(text(
+            "SELECT id, name, alias, greatest(similarity(name, :term), "
+            "similarity(coalesce(alias, ''), :term)) AS score "
+            "FROM criminals WHERE name % :term OR alias % :term "
+            "ORDER BY score DESC, id LIMIT :limit"
+        ), {'term': term, 'limit': limit})
+    else:
+        rows = get_index().search(term, limit=limit, threshold=threshold)
+    return [{'id': cid, 'name': name, 'alias': alias, 'score': round(score, 3)}
+            for cid, name, alias, score in rows]
+
+
+@event.listens_for(db.session, 'after_flush')
+def _capture_criminal_changes(session, flush_context):
+    if _index is None:
+        return
+    pending = session.info.setdefault(_pending_key, {})
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Criminal):
+            pending[obj.id] = (obj.name, obj.alias, None)
+    for obj in session.deleted:
+        if isinstance(obj, Criminal):
+            pending[obj.id] = None
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_criminal_changes(session):
+    pending = session.info.pop(_pending_key, None)
+    if pending and _index is not None:
+        _index.update([(cid, *values) for cid, values in pending.items() if values is not None],
+                      [cid for cid, values in pending.items() if values is None])
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_criminal_changes(session, previous_transaction):
+    session.info.pop(_pending_key, None)
+
+
+@click.group('name-index')
+def name_index_cli():
+    """Fuzzy criminal name index (in-process backend)."""
+
+
+@name_index_cli.command('snapshot')
+@with_appcontext
+def snapshot_command():
+    """Build the index from the database and write it to NAME_INDEX_PATH."""
+    path = current_app.config.get('NAME_INDEX_PATH')
+    if not path:
+        raise click.ClickException('NAME_INDEX_PATH is not set')
+    started = time.perf_counter()
+    index = build_index()
+    index.save(path)
+    click.echo(f'Indexed {len(index)} criminals in {time.perf_counter() - started:.1f}s -> {path}')
+
+
+@name_index_cli.command('bench')
+@click.argument('terms', nargs=-1, required=True)
+@click.option('--limit', default=10, show_default=True)
+@click.option('--repeat', default=20, show_default=True)
+@with_appcontext
+def bench_command(terms, limit, repeat):
+    """Time fuzzy lookups of TERMS and print the best matches."""
+    current_app.config['NAME_INDEX_PRELOAD'] = False
+    search_criminals(terms[0], limit=limit)  # load or build the index outside the timing
+    for term in terms:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            results = search_criminals(term, limit=limit)
+        elapsed = (time.perf_counter() - started) / repeat
+        best = ', '.join(f"{row['name']} ({row['score']})" for row in results[:3])
+        click.echo(f'{term!r}: {elapsed * 1000:.2f} ms, {len(results)} matches: {best}')
+
+
+def init_app(app):
+    if app.config.get('NAME_INDEX_PRELOAD', True):
+        app.before_request(start_loader)
+    app.cli.add_command(name_index_cli)
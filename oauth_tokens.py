@@ -0,0 +1,257 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, select
+
+from app import db
+from models import OAuth, User
+from utils import TTLCache
+from change_tracking import upsert_for
+from instrumentation import count_queries
+
+# Tokens this close to expiry are always read from the database, so a
+# worker never refreshes with a refresh token another worker already used
+REFRESH_MARGIN = 60
+
+
+class TokenVersions:
+    """Write counters per token in a local SQLite file shared by every worker
+    on the host. Token values stay in each process; a refresh or delete in
+    one worker bumps the counter, so the others stop trusting their copy at
+    once."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute('CREATE TABLE IF NOT EXISTS token_versions ('
+                                'key TEXT PRIMARY KEY, version INTEGER NOT NULL, updated_at REAL NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute('SELECT version FROM token_versions WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, key):
+        conn = self._connect()
+        conn.execute('INSERT INTO token_versions VALUES (?, 1, ?) ON CONFLICT (key) DO UPDATE '
+                     'SET version = version + 1, updated_at = excluded.updated_at', (key, time.time()))
+        return self.get(key)
+
+    def prune(self, older_than):
+        # A cached copy read before the last bump has expired after the cache
+        # TTL, so the counter can start again from 0 without being trusted
+        return self._connect().execute('DELETE FROM token_versions WHERE updated_at < ?',
+                                       (time.time() - older_than,)).rowcount
+
+
+class TokenStore:
+    """Write-through cache of OAuth tokens keyed by user, browser session and provider.
+
+    Reads are served from a per-process LRU; writes go to the database as a
+    single upsert and then replace the cached entry. With ``versions`` shared
+    between the workers, an entry is only used while no worker has written
+    the token since it was read.
+    """
+
+    def __init__(self, cache_size=1024, ttl=300, retention=timedelta(days=31),
+                 sweep_interval=600, sweep_batch=1000, versions=None):
+        self.cache = TTLCache(max_size=cache_size, ttl=ttl)
+        self.versions = versions
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._sweeper = None
+        self._sweeper_pid = None
+        self._lock = threading.Lock()
+
+    def _expires_at(self, token):
+        # A refreshable token outlives its access token, but not the browser
+        # session its key belongs to
+        if token.get('refresh_token') or not token.get('expires_at'):
+            return datetime.utcnow() + self.retention
+        return datetime.utcfromtimestamp(token['expires_at'])
+
+    def _version(self, key):
+        return self.versions.get(repr(key)) if self.versions is not None else 0
+
+    def _written(self, key):
+        return self.versions.bump(repr(key)) if self.versions is not None else 0
+
+    def get(self, user_id, browser_session_key, provider):
+        self._ensure_sweeper()
+        key = (user_id, browser_session_key, provider)
+        # Read before the database, so a write committed meanwhile is seen
+        # as newer than the copy cached here
+        version = self._version(key)
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] == version:
+            token = entry[1]
+            if token.get('expires_at', float('inf')) - time.time() > REFRESH_MARGIN:
+                return dict(token)
+        token = db.session.execute(
+            select(OAuth.token).where(OAuth.user_id == user_id,
+                                      OAuth.browser_session_key == browser_session_key,
+                                      OAuth.provider == provider)
+        ).scalar()
+        if token is None:
+            self.cache.delete(key)
+            return None
+        token = dict(token)
+        self.cache.set(key, (version, token))
+        return dict(token)
+
+    def set(self, user_id, browser_session_key, provider, token):
+        key = dict(user_id=user_id, browser_session_key=browser_session_key, provider=provider)
+        values = dict(token=token, expires_at=self._expires_at(token), created_at=datetime.utcnow())
+        table = OAuth.__table__
+        connection = db.session.connection()
+        upsert = upsert_for(connection.dialect.name)
+        if upsert is not None:
+            connection.execute(upsert(table).values(**key, **values).on_conflict_do_update(
+                index_elements=['user_id', 'browser_session_key', 'provider'], set_=values))
+        else:
+            updated = connection.execute(
+                table.update().where(*(table.c[name] == value for name, value in key.items())).values(**values))
+            if updated.rowcount == 0:
+                connection.execute(table.insert().values(**key, **values))
+        db.session.commit()
+        key = (user_id, browser_session_key, provider)
+        self.cache.set(key, (self._written(key), dict(token)))
+
+    def delete(self, user_id, browser_session_key, provider):
+        db.session.execute(delete(OAuth).where(OAuth.user_id == user_id,
+                                               OAuth.browser_session_key == browser_session_key,
+                                               OAuth.provider == provider))
+        db.session.commit()
+        key = (user_id, browser_session_key, provider)
+        self._written(key)
+        self.cache.delete(key)
+
+    def sweep(self):
+        """Delete expired tokens ``sweep_batch`` rows per transaction."""
+        removed = 0
+        while True:
+            expired = (select(OAuth.id).where(OAuth.expires_at <= datetime.utcnow())
+                       .limit(self.sweep_batch).scalar_subquery())
+            count = db.session.execute(delete(OAuth).where(OAuth.id.in_(expired))).rowcount
+            db.session.commit()
+            removed += count
+            if count < self.sweep_batch:
+                if self.versions is not None:
+                    self.versions.prune(self.cache.ttl)
+                return removed
+
+    def _ensure_sweeper(self):
+        # Started on first use, and again after a fork
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid != os.getpid():
+                self._sweeper_pid = os.getpid()
+                self._sweeper = threading.Thread(target=self._sweep_forever,
+                                                 args=(current_app._get_current_object(),),
+                                                 name='oauth-token-sweeper', daemon=True)
+                self._sweeper.start()
+
+    def _sweep_forever(self, app):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                with app.app_context():
+                    self.sweep()
+            except Exception:
+                app.logger.exception('OAuth token sweep failed')
+
+
+# Replaced by init_app according to the application config
+tokens = TokenStore()
+
+
+@click.command('oauth-sweep')
+@with_appcontext
+def oauth_sweep_command():
+    """Delete expired OAuth tokens now."""
+    click.echo(f'Removed {tokens.sweep()} expired tokens')
+
+
+@click.command('oauth-bench')
+@click.option('--requests', 'request_count', default=1000, show_default=True)
+@click.option('--refresh-every', default=100, show_default=True, help='Requests per token refresh.')
+@with_appcontext
+def oauth_bench_command(request_count, refresh_every):
+    """Count database round trips per authenticated request, before and after the cache."""
+    user = User.query.first()
+    if user is None:
+        raise click.ClickException('Create a user first')
+    provider = 'oauth-bench'
+    token = {'access_token': 'a', 'refresh_token': 'r', 'token_type': 'Bearer',
+             'expires_at': time.time() + 3600}
+
+    def query_per_access(key):
+        return OAuth.query.filter_by(user_id=user.id, browser_session_key=key, provider=provider)
+
+    # The previous storage: a query per access, delete + insert per refresh
+    def legacy_get(key):
+        return query_per_access(key).one().token
+
+    def legacy_set(key):
+        query_per_access(key).delete()
+        db.session.add(OAuth(user_id=user.id, browser_session_key=key, provider=provider,
+                             token=token, expires_at=datetime.utcnow()))
+        db.session.commit()
+
+    def cached_get(key):
+        return tokens.get(user.id, key, provider)
+
+    def cached_set(key):
+        tokens.set(user.id, key, provider, token)
+
+    for label, get, put in (('uncached', legacy_get, legacy_set), ('cached', cached_get, cached_set)):
+        key = uuid.uuid4().hex
+        put(key)
+        started = time.perf_counter()
+        with count_queries() as counter:
+            for index in range(request_count):
+                if index and index % refresh_every == 0:
+                    put(key)
+                get(key)
+        elapsed = time.perf_counter() - started
+        query_per_access(key).delete()
+        db.session.commit()
+        click.echo(f'{label:<9} {counter[0] / request_count:6.3f} queries/request  '
+                   f'{elapsed / request_count * 1e6:8.1f} us/request')
+
+
+def init_app(app):
+    global tokens
+    versions = None
+    path = app.config.get('OAUTH_TOKEN_CACHE_PATH')
+    if path is None:
+        path = os.path.join(app.instance_path, 'oauth_tokens.sqlite')
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        versions = TokenVersions(path)
+    tokens = TokenStore(
+        cache_size=app.config.get('OAUTH_TOKEN_CACHE_SIZE', 1024),
+        ttl=app.config.get('OAUTH_TOKEN_CACHE_TTL', 300),
+        retention=app.permanent_session_lifetime,
+        sweep_interval=app.config.get('OAUTH_TOKEN_SWEEP_INTERVAL', 600),
+        versions=versions,
+    )
+    app.cli.add_command(oauth_sweep_command)
+    app.cli.add_command(oauth_bench_command)
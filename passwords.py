@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import click
+from flask.cli import with_appcontext
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+# Used when the app does not configure PASSWORD_HASH_METHOD
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+
+class HashingBusy(Exception):
+    """Raised instead of queueing more hashing work than the limits allow."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def canonical_method(method):
+    """The prefix werkzeug writes into hashes made with ``method``.
+
+    ``scrypt`` and ``pbkdf2`` may be configured without their parameters,
+    but hashes always record them in full (``scrypt:32768:8:1``).
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        if not args:
+            args = [2 ** 15, 8, 1]
+        elif len(args) != 3:
+            raise ValueError("'scrypt' takes 3 arguments")
+        return ':'.join(map(str, [name, *map(int, args)]))
+    if name == 'pbkdf2':
+        if len(args) > 2:
+            raise ValueError("'pbkdf2' takes 2 arguments")
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f'{name}:{hash_name}:{iterations}'
+    raise ValueError(f'Invalid hash method {method!r}')
+
+
+class PasswordHasher:
+    """Runs password hashing in a bounded process pool.
+
+    At most ``workers * queue_factor`` hash operations may be in flight per
+    process and at most ``per_ip`` of them for a single client address;
+    anything beyond that fails fast with ``HashingBusy`` rather than piling
+    up behind the pool. ``workers=0`` hashes inline on the calling thread.
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, workers=2, queue_factor=4, per_ip=2, wait=2.0):
+        self.method = canonical_method(method)
+        self.workers = workers
+        self.per_ip = per_ip
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(max(1, workers) * queue_factor)
+        self._per_ip = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self):
+        # Create the pool lazily, and again after a fork, so gunicorn
+        # workers never share one inherited from the master
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, func, *args, client=None):
+        if client is not None:
+            with self._lock:
+                if self._per_ip.get(client, 0) >= self.per_ip:
+                    raise HashingBusy('Too many concurrent sign-in attempts from this address', 429)
+                self._per_ip[client] = self._per_ip.get(client, 0) + 1
+        try:
+            if not self._slots.acquire(timeout=self.wait):
+                raise HashingBusy('Sign-in is busy, please retry shortly', 503)
+            try:
+                if not self.workers:
+                    return func(*args)
+                return self._executor().submit(func, *args).result()
+            finally:
+                self._slots.release()
+        finally:
+            if client is not None:
+                with self._lock:
+                    remaining = self._per_ip[client] - 1
+                    if remaining:
+                        self._per_ip[client] = remaining
+                    else:
+                        del self._per_ip[client]
+
+    def hash(self, password, client=None):
+        return self._run(generate_password_hash, password, self.method, client=client)
+
+    def verify(self, pwhash, password, client=None):
+        return self._run(check_password_hash, pwhash, password, client=client)
+
+    def needs_rehash(self, pwhash):
+        """True if ``pwhash`` was made with different parameters than ``method``."""
+        return pwhash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+# Replaced by init_app according to the application config
+hasher = PasswordHasher(workers=0)
+
+
+def hash_password(password):
+    return hasher.hash(password)
+
+
+def verify_user_password(user, password, client=None):
+    """Check ``password`` for ``user`` off the request thread.
+
+    On success the stored hash is transparently upgraded if the configured
+    method or cost has changed; the caller commits the session.
+    """
+    if not user.password_hash:
+        return False
+    if not hasher.verify(user.password_hash, password, client=client):
+        return False
+    if hasher.needs_rehash(user.password_hash):
+        user.password_hash = hasher.hash(password, client=client)
+    return True
+
+
+def init_app(app):
+    global hasher
+    hasher = PasswordHasher(
+        method=app.config.get('PASSWORD_HASH_METHOD', DEFAULT_METHOD),
+        workers=app.config.get('PASSWORD_HASH_WORKERS', 2),
+        queue_factor=app.config.get('PASSWORD_HASH_QUEUE_FACTOR', 4),
+        per_ip=app.config.get('PASSWORD_HASH_PER_IP', 2),
+    )
+    app.cli.add_command(password_bench_command)
+
+
+@click.command('password-bench')
+@click.option('--method', 'methods', multiple=True,
+              default=('pbkdf2:sha256:200000', 'pbkdf2:sha256:600000', 'scrypt:16384:8:1', 'scrypt:32768:8:1'),
+              show_default=True, help='Werkzeug hash methods to compare.')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True)
+@click.option('--logins', default=200, show_default=True, help='Verifications per method.')
+@with_appcontext
+def password_bench_command(methods, workers, logins):
+    """Measure login verification throughput for each hash cost."""
+    for method in methods:
+        bench = PasswordHasher(method=method, workers=workers, queue_factor=logins)
+        pwhash = bench.hash('correct horse battery staple')
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers * 2) as clients:
+            list(clients.map(lambda _: bench.verify(pwhash, 'correct horse battery staple'), range(logins)))
+        elapsed = time.perf_counter() - started
+        bench.shutdown()
+        click.echo(f'{method:<24} {logins / elapsed:8.1f} logins/sec  '
+                   f'{elapsed / logins * workers * 1000:7.1f} ms CPU per login')
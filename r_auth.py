@@ -11,55 +11,35 @@ from flask_dance.consumer import (
     oauth_error,
 )
 from flask_dance.consumer.storage import BaseStorage
-from flask_login import LoginManager, login_user, logout_user, current_user
+from flask_login import login_user, logout_user, current_user
 from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
-from sqlalchemy.exc import NoResultFound
 from werkzeug.local import LocalProxy
 
-from app import app, db
-from models import OAuth, User
-
-login_manager = LoginManager(app)
-
-
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(user_id)
+from app import db
+from models import User
+import oauth_tokens
 
 
 class UserSessionStorage(BaseStorage):
+    """Tokens per user and browser session, read through ``oauth_tokens.tokens``."""
+
+    def _key(self, blueprint):
+        return current_user.get_id(), g.browser_session_key, blueprint.name
 
     def get(self, blueprint):
-        try:
-            oauth = db.session.query(OAuth).filter_by(
-                user_id=current_user.get_id(),
-                browser_session_key=g.browser_session_key,
-                provider=blueprint.name,
-            ).one()
-            return oauth.token
-        except NoResultFound:
+        user_id, browser_session_key, provider = self._key(blueprint)
+        if user_id is None:
             return None
+        return oauth_tokens.tokens.get(int(user_id), browser_session_key, provider)
 
     def set(self, blueprint, token):
-        db.session.query(OAuth).filter_by(
-            user_id=current_user.get_id(),
-            browser_session_key=g.browser_session_key,
-            provider=blueprint.name,
-        ).delete()
-        new_model = OAuth()
-        new_model.user_id = current_user.get_id()
-        new_model.browser_session_key = g.browser_session_key
-        new_model.provider = blueprint.name
-        new_model.token = token
-        db.session.add(new_model)
-        db.session.commit()
+        user_id, browser_session_key, provider = self._key(blueprint)
+        oauth_tokens.tokens.set(int(user_id), browser_session_key, provider, token)
 
     def delete(self, blueprint):
-        db.session.query(OAuth).filter_by(
-            user_id=current_user.get_id(),
-            browser_session_key=g.browser_session_key,
-            provider=blueprint.name).delete()
-        db.session.commit()
+        user_id, browser_session_key, provider = self._key(blueprint)
+        if user_id is not None:
+            oauth_tokens.tokens.delete(int(user_id), browser_session_key, provider)
 
 
 def make_replit_blueprint():
@@ -97,9 +77,10 @@ def make_replit_blueprint():
 
     @replit_bp.before_app_request
     def set_applocal_session():
+        # Assigning the key already marks the session modified; forcing it on
+        # every request would rewrite the session on every response
         if '_browser_session_key' not in session:
             session['_browser_session_key'] = uuid.uuid4().hex
-        session.modified = True
         g.browser_session_key = session['_browser_session_key']
         g.flask_dance_replit = replit_bp.session
 
@@ -177,4 +158,9 @@ def get_next_navigation_url(request):
     return request.referrer or request.url
 
 
-replit = LocalProxy(lambda: g.flask_dance_replit)
\ No newline at end of file
+replit = LocalProxy(lambda: g.flask_dance_replit)
+
+
+def init_app(app):
+    """Register Replit sign-in; users are loaded by the app's own user_loader."""
+    app.register_blueprint(make_replit_blueprint(), url_prefix="/auth")
@@ -0,0 +1,442 @@
+import os
+import time
+import random
+import multiprocessing
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+# ``burst`` attempts at once, refilled at ``rate`` attempts per second
+Bucket = namedtuple('Bucket', 'burst rate')
+
+# Buckets used when the app does not configure them
+DEFAULT_BUCKETS = {
+    'ip': Bucket(burst=20, rate=20 / 60),
+    'user': Bucket(burst=10, rate=10 / 300),
+    'pair': Bucket(burst=10, rate=10 / 300),
+    'register': Bucket(burst=10, rate=10 / 3600),
+}
+
+COUNTERS = ('allowed', 'limited', 'locked', 'failures', 'lockouts')
+
+# Kinds that failures can lock. A username alone is never locked, or anyone
+# could lock a real account out by failing to sign in as it.
+LOCKOUT_KINDS = ('ip', 'pair')
+
+# Cookie marking a browser that has signed in as a username before
+KNOWN_CLIENT_COOKIE = 'known_login'
+
+
+class LocalRateLimiter:
+    """Token buckets and failure lockouts per key, kept in this process.
+
+    Keys are ``(kind, value)`` pairs such as ``('ip', '10.0.0.1')``; each
+    kind has its own ``Bucket``. An attempt takes a token from every key
+    it names and is refused, without taking any, if one of them is empty
+    or locked. ``lockout_after`` consecutive failures lock a key for
+    ``lockout_base`` seconds, doubling with each further failure up to
+    ``lockout_max``. Counters are per process.
+    """
+
+    def __init__(self, buckets=None, lockout_after=5, lockout_base=30, lockout_max=3600, max_keys=100000):
+        self.buckets = dict(buckets or DEFAULT_BUCKETS)
+        self.lockout_after = lockout_after
+        self.lockout_base = lockout_base
+        self.lockout_max = lockout_max
+        self.max_keys = max_keys
+        # Failure streaks end once a key has been left alone this long
+        self.forget = max([lockout_max] + [bucket.burst / bucket.rate for bucket in self.buckets.values()])
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield self._states.get, self._put
+
+    def _put(self, key, state):
+        self._states[key] = state
+        self._states.move_to_end(key)
+        while len(self._states) > self.max_keys:
+            self._states.popitem(last=False)
+
+    def _state(self, get, key, now):
+        # [tokens, updated, failures, locked_until], refilled up to now
+        bucket = self.buckets[key[0]]
+        state = get(key)
+        if state is None or now - state[1] > self.forget:
+            return [float(bucket.burst), now, 0, 0.0]
+        tokens, updated, failures, locked_until = state
+        return [min(bucket.burst, tokens + (now - updated) * bucket.rate), now, failures, locked_until]
+
+    def _count(self, name):
+        self.counts[name] += 1
+
+    def attempt(self, **keys):
+        """Take a token for each ``kind=value``; returns 0 if the attempt may
+        go ahead, else the number of seconds to wait."""
+        keys = [(kind, value) for kind, value in keys.items() if value]
+        now = time.time()
+        with self._transaction() as (get, put):
+            states = [(key, self._state(get, key, now)) for key in keys]
+            locked = max([state[3] - now for _, state in states] + [0])
+            empty = max([(1 - state[0]) / self.buckets[key[0]].rate for key, state in states if state[0] < 1] + [0])
+            if not locked and not empty:
+                for key, state in states:
+                    state[0] -= 1
+                    put(key, state)
+        self._count('locked' if locked else 'limited' if empty else 'allowed')
+        return max(locked, empty)
+
+    def failed(self, **keys):
+        """Record a failed attempt; a long enough streak locks the keys."""
+        now = time.time()
+        with self._transaction() as (get, put):
+            for kind, value in keys.items():
+                if not value:
+                    continue
+                state = self._state(get, (kind, value), now)
+                state[2] += 1
+                if state[2] >= self.lockout_after:
+                    state[3] = now + min(self.lockout_base * 2 ** (state[2] - self.lockout_after), self.lockout_max)
+                    self._count('lockouts')
+                put((kind, value), state)
+        self._count('failures')
+
+    def succeeded(self, **keys):
+        """End the failure streaks of the keys."""
+        now = time.time()
+        with self._transaction() as (get, put):
+            for kind, value in keys.items():
+                if value and get((kind, value)) is not None:
+                    state = self._state(get, (kind, value), now)
+                    state[2], state[3] = 0, 0.0
+                    put((kind, value), state)
+
+    def reset(self, **keys):
+        """Forget the keys' buckets and lockouts."""
+        with self._lock:
+            for kind, value in keys.items():
+                self._states.pop((kind, value), None)
+
+    def reset_user(self, username):
+        """Forget the lockouts of ``username`` from every address."""
+        with self._lock:
+            for key in [key for key in self._states if key[0] == 'pair' and key[1].endswith(f'|{username}')]:
+                del self._states[key]
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+    def __len__(self):
+        return len(self._states)
+
+    def stats(self):
+        return dict(self.counts, backend='local', keys=len(self))
+
+
+class SharedRateLimiter(LocalRateLimiter):
+    """Rate limits in a local SQLite file shared by every worker on the host.
+
+    Each attempt is one short write transaction, so a client cannot get a
+    fresh bucket by landing on another gunicorn worker.
+    """
+
+    def __init__(self, path, **options):
+        super().__init__(**options)
+        self.path = path
+        self._local = threading.local()
+        self._attempts = 0
+        self._connect().execute('CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, '
+                                'tokens REAL NOT NULL, updated REAL NOT NULL, failures INTEGER NOT NULL, '
+                                'locked_until REAL NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            def get(key):
+                row = conn.execute('SELECT tokens, updated, failures, locked_until FROM rate_limits WHERE key = ?',
+                                   (':'.join(key),)).fetchone()
+                return list(row) if row else None
+
+            def put(key, state):
+                conn.execute('INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?)', [':'.join(key)] + state)
+
+            yield get, put
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def attempt(self, **keys):
+        self._attempts += 1
+        # Keep the table bounded: keys idle past ``forget`` hold nothing
+        if self._attempts % 1024 == 0:
+            now = time.time()
+            self._connect().execute('DELETE FROM rate_limits WHERE updated < ? AND locked_until < ?',
+                                    (now - self.forget, now))
+        return super().attempt(**keys)
+
+    def reset(self, **keys):
+        self._connect().executemany('DELETE FROM rate_limits WHERE key = ?',
+                                    [(f'{kind}:{value}',) for kind, value in keys.items()])
+
+    def reset_user(self, username):
+        pattern = 'pair:%|' + username.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        self._connect().execute("DELETE FROM rate_limits WHERE key LIKE ? ESCAPE '\\'", (pattern,))
+
+    def clear(self):
+        self._connect().execute('DELETE FROM rate_limits')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM rate_limits').fetchone()[0]
+
+    def stats(self):
+        stats = super().stats()
+        stats['backend'] = 'shared'
+        return stats
+
+
+# Replaced by init_app according to the application config; None disables limiting
+limiter = LocalRateLimiter()
+
+
+def login_keys(client, username, known=False):
+    """Limiter keys of a sign-in attempt.
+
+    ``pair`` is the address and username together, so a failure streak
+    locks the attacker's address out of that account without touching the
+    account elsewhere. Browsers that have signed in as the user before
+    (``known``) skip the per-username bucket, which an attack spread over
+    many addresses can drain.
+    """
+    username = (username or '').strip().lower()
+    keys = {'ip': client, 'pair': f'{client}|{username}' if client and username else None}
+    if not known:
+        keys['user'] = username
+    return keys
+
+
+def _lockout_keys(client, username):
+    return {kind: value for kind, value in login_keys(client, username).items() if kind in LOCKOUT_KINDS}
+
+
+def check_login(client, username, known=False):
+    """Seconds until ``client`` may try ``username`` again, or 0."""
+    return limiter.attempt(**login_keys(client, username, known)) if limiter is not None else 0
+
+
+def login_failed(client, username):
+    if limiter is not None:
+        limiter.failed(**_lockout_keys(client, username))
+
+
+def login_succeeded(client, username):
+    if limiter is not None:
+        limiter.succeeded(**_lockout_keys(client, username))
+
+
+def _known_client_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='rate-limits-known-client')
+
+
+def known_client_token(username):
+    """Value of the ``KNOWN_CLIENT_COOKIE`` set after signing in as ``username``."""
+    return _known_client_serializer().dumps((username or '').strip().lower())
+
+
+def is_known_client(token, username):
+    """Whether ``token`` is a known-client cookie for ``username`` that has not expired."""
+    if not token or limiter is None:
+        return False
+    max_age = current_app.config.get('LOGIN_KNOWN_CLIENT_DAYS', 30) * 86400
+    try:
+        return _known_client_serializer().loads(token, max_age=max_age) == (username or '').strip().lower()
+    except BadSignature:
+        return False
+
+
+def check_register(client):
+    return limiter.attempt(register=client) if limiter is not None else 0
+
+
+def limiter_stats():
+    return limiter.stats() if limiter is not None else {'backend': None}
+
+
+def limiter_gauges():
+    """Counters for /metrics."""
+    stats = limiter_stats()
+    return [(f'login_attempts_{name}', stats[name]) for name in COUNTERS if name in stats]
+
+
+def init_app(app):
+    global limiter
+    if not app.config.get('LOGIN_RATE_LIMIT', True):
+        limiter = None
+    else:
+        options = dict(
+            buckets={kind: Bucket(app.config.get(f'LOGIN_{kind.upper()}_BURST', bucket.burst),
+                                  app.config.get(f'LOGIN_{kind.upper()}_PER_MINUTE', bucket.rate * 60) / 60)
+                     for kind, bucket in DEFAULT_BUCKETS.items()},
+            lockout_after=app.config.get('LOGIN_LOCKOUT_AFTER', 5),
+            lockout_base=app.config.get('LOGIN_LOCKOUT_SECONDS', 30),
+            lockout_max=app.config.get('LOGIN_LOCKOUT_MAX', 3600),
+        )
+        path = app.config.get('RATE_LIMIT_PATH')
+        if path is None:
+            path = os.path.join(app.instance_path, 'rate_limits.sqlite')
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            limiter = SharedRateLimiter(path, **options)
+        else:
+            limiter = LocalRateLimiter(**options)
+    app.cli.add_command(rate_limit_cli)
+
+
+def _percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+
+@click.group('rate-limit')
+def rate_limit_cli():
+    """Sign-in rate limits."""
+
+
+@rate_limit_cli.command('reset')
+@click.option('--ip', help='Client address to unblock.')
+@click.option('--user', help='Username to unlock.')
+@with_appcontext
+def reset_command(ip, user):
+    """Clear the buckets and lockouts of an address or username.
+
+    A username alone is unlocked from every address.
+    """
+    if limiter is None:
+        raise click.ClickException('Rate limiting is disabled')
+    keys = {kind: value for kind, value in login_keys(ip, user).items() if value}
+    if ip:
+        keys['register'] = ip
+    limiter.reset(**keys)
+    if user and not ip:
+        limiter.reset_user(keys['user'])
+    click.echo(f'Reset {", ".join(f"{kind} {value}" for kind, value in keys.items()) or "nothing"}')
+
+
+@rate_limit_cli.command('bench')
+@click.option('--logins', default=50, show_default=True, help='Legitimate sign-ins timed per phase.')
+@click.option('--attackers', default=4, show_default=True, help='Processes sending bad passwords.')
+@click.option('--rate', default=10000, show_default=True, help='Target attack rate, requests/sec.')
+@click.option('--addresses', default=64, show_default=True, help='Client addresses the attack rotates through.')
+@with_appcontext
+def bench_command(logins, attackers, rate, addresses):
+    """Legitimate sign-in latency alone, under attack, and under attack unlimited.
+
+    The attack guesses passwords for the admin account from ``addresses``
+    client addresses, through the app's own test client in forked
+    processes. The timed user's own buckets are reset before each sign-in
+    so it is never limited itself.
+    """
+    global limiter
+    import passwords
+    from app import db
+    from models import User
+    if User.query.filter_by(username='bench-user').first() is None:
+        user = User(username='bench-user', email='bench-user@example.com', role='analyst')
+        user.set_password('bench-pass')
+        db.session.add(user)
+        db.session.commit()
+    app = current_app._get_current_object()
+    app.config['WTF_CSRF_ENABLED'] = False
+    configured = limiter
+    context = multiprocessing.get_context('fork')
+
+    def login(client, username, password):
+        started = time.perf_counter()
+        status = client.post('/login', data={'username': username, 'password': password}).status_code
+        return status, time.perf_counter() - started
+
+    def legitimate():
+        client = app.test_client()
+        client.environ_base['REMOTE_ADDR'] = '192.0.2.1'
+        samples = []
+        for _ in range(logins):
+            if limiter is not None:
+                limiter.reset(**login_keys('192.0.2.1', 'bench-user'))
+            status, elapsed = login(client, 'bench-user', 'bench-pass')
+            if status != 302:
+                raise click.ClickException(f'Legitimate sign-in got HTTP {status}')
+            samples.append(elapsed)
+            client.get('/logout')
+        return samples
+
+    def attack(stop, sent):
+        # Never reuse the parent's database connections or hash pool
+        db.engine.dispose(close=False)
+        passwords.hasher = passwords.PasswordHasher(method=passwords.hasher.method, workers=0)
+        client = app.test_client()
+        interval = attackers / rate
+        while not stop.is_set():
+            client.environ_base['REMOTE_ADDR'] = f'198.51.100.{random.randrange(addresses)}'
+            started = time.perf_counter()
+            login(client, 'admin', f'guess-{random.random()}')
+            with sent.get_lock():
+                sent.value += 1
+            time.sleep(max(0.0, interval - (time.perf_counter() - started)))
+        # Skip exit handlers inherited from the parent (its hash pool, audit writer)
+        os._exit(0)
+
+    phases = (('alone', configured, 0), ('attack, limited', configured, attackers),
+              ('attack, unlimited', None, attackers))
+    try:
+        for name, phase_limiter, processes in phases:
+            limiter = phase_limiter
+            if configured is not None:
+                configured.clear()
+            stop, sent = context.Event(), context.Value('q', 0)
+            workers = [context.Process(target=attack, args=(stop, sent)) for _ in range(processes)]
+            for worker in workers:
+                worker.start()
+            started = time.perf_counter()
+            try:
+                samples = legitimate()
+            finally:
+                stop.set()
+                for worker in workers:
+                    worker.join()
+            elapsed = time.perf_counter() - started
+            click.echo(f'{name:<18} p50 {_percentile(samples, 0.5):7.1f} ms  p95 {_percentile(samples, 0.95):7.1f} ms'
+                       f'  attack {sent.value / elapsed:8.0f} req/s')
+    finally:
+        limiter = configured
+
+    if configured is not None:
+        configured.clear()
+        checks = 20000
+        started = time.perf_counter()
+        for index in range(checks):
+            configured.attempt(**login_keys(f'198.51.100.{index % addresses}', 'admin'))
+        elapsed = time.perf_counter() - started
+        click.echo(f'{type(configured).__name__}: {checks / elapsed:,.0f} checks/sec, '
+                   f'{elapsed / checks * 1e6:.1f} us per check')
+        configured.clear()
@@ -0,0 +1,285 @@
+from collections import Counter, defaultdict
+from datetime import date
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, inspect
+
+from app import db
+from models import Crime, CrimeDailyStat, CrimeMapCell, PoliceStation
+from geo import GEOHASH_PRECISION, geohash_center, geohash_encode
+from change_tracking import add_deltas, previous_value, track_previous
+
+# Crimes are bucketed by the geohash cell of their coordinates at this
+# precision (about 5 x 5 km), so a city has tens of buckets however many
+# distinct addresses it has
+LOCATION_BUCKET_PRECISION = 5
+
+# Bucket for crimes without coordinates
+UNKNOWN_LOCATION = 'Unknown'
+
+# Crime columns that decide a crime's rollup row
+_KEY_ATTRS = ('date', 'type', 'status', 'latitude', 'longitude')
+
+# How many locations the statistics page charts individually
+TOP_LOCATIONS = 10
+
+# Geohash precisions the zoomed-out crime map clusters at (geo.cluster_precision)
+MAP_CELL_PRECISIONS = range(1, GEOHASH_PRECISION - 1)
+
+_MAP_SUMS = ('count', 'latitude_sum', 'longitude_sum')
+
+
+def location_bucket(latitude, longitude):
+    """The coarse geohash cell a crime is counted under."""
+    if latitude is None or longitude is None:
+        return UNKNOWN_LOCATION
+    return geohash_encode(latitude, longitude, LOCATION_BUCKET_PRECISION)
+
+
+def rollup_key(day, crime_type, status, latitude, longitude):
+    return (day, crime_type, status or 'reported', location_bucket(latitude, longitude))
+
+
+# The flush decrements the rollup rows of the values a crime had before
+track_previous(*(getattr(Crime, attr) for attr in _KEY_ATTRS))
+
+
+def _collect_deltas(session):
+    deltas = Counter()
+    for obj in session.new:
+        if isinstance(obj, Crime):
+            deltas[rollup_key(*(getattr(obj, attr) for attr in _KEY_ATTRS))] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Crime):
+            state = inspect(obj)
+            deltas[rollup_key(*(previous_value(state, attr) for attr in _KEY_ATTRS))] -= 1
+    for obj in session.dirty:
+        if isinstance(obj, Crime) and session.is_modified(obj):
+            state = inspect(obj)
+            old = rollup_key(*(previous_value(state, attr) for attr in _KEY_ATTRS))
+            new = rollup_key(*(getattr(obj, attr) for attr in _KEY_ATTRS))
+            if old != new:
+                deltas[old] -= 1
+                deltas[new] += 1
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def _collect_map_changes(session):
+    # (sign, type, status, latitude, longitude) for each side of every change
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, Crime):
+            changes.append((1, obj.type, obj.status, obj.latitude, obj.longitude))
+    for obj in session.deleted:
+        if isinstance(obj, Crime):
+            state = inspect(obj)
+            changes.append((-1, *(previous_value(state, attr) for attr in _KEY_ATTRS[1:])))
+    for obj in session.dirty:
+        if isinstance(obj, Crime) and session.is_modified(obj):
+            state = inspect(obj)
+            old = tuple(previous_value(state, attr) for attr in _KEY_ATTRS[1:])
+            new = (obj.type, obj.status, obj.latitude, obj.longitude)
+            if old != new:
+                changes.extend(((-1, *old), (1, *new)))
+    return changes
+
+
+def map_cell_deltas(changes):
+    """Sum ``(sign, type, status, latitude, longitude)`` changes into
+    ``{(precision, cell, type, status): [count, latitude_sum, longitude_sum]}``."""
+    deltas = defaultdict(lambda: [0, 0.0, 0.0])
+    for sign, crime_type, status, latitude, longitude in changes:
+        if latitude is None or longitude is None:
+            continue
+        geohash = geohash_encode(latitude, longitude, MAP_CELL_PRECISIONS[-1])
+        for precision in MAP_CELL_PRECISIONS:
+            delta = deltas[(precision, geohash[:precision], crime_type, status or 'reported')]
+            delta[0] += sign
+            delta[1] += sign * latitude
+            delta[2] += sign * longitude
+    return {key: delta for key, delta in deltas.items() if any(delta)}
+
+
+def apply_map_deltas(connection, deltas):
+    """Add ``map_cell_deltas`` output to the map cell table."""
+    if not deltas:
+        return
+    table = CrimeMapCell.__table__
+    rows = []
+    for (precision, cell, crime_type, status), sums in deltas.items():
+        latitude, longitude = geohash_center(cell)
+        rows.append(dict(precision=precision, cell=cell, type=crime_type, status=status,
+                         latitude=latitude, longitude=longitude, **dict(zip(_MAP_SUMS, sums))))
+    add_deltas(connection, table, ('precision', 'cell', 'type', 'status'), _MAP_SUMS, rows)
+
+
+def apply_deltas(connection, deltas):
+    """Add ``{(day, type, status, bucket): delta}`` to the rollup table."""
+    add_deltas(connection, CrimeDailyStat.__table__, ('day', 'type', 'status', 'location_bucket'), ('count',),
+               [dict(day=day, type=crime_type, status=status, location_bucket=bucket, count=delta)
+                for (day, crime_type, status, bucket), delta in deltas.items()])
+
+
+@event.listens_for(db.session, 'before_flush')
+def _capture_crime_changes(session, flush_context, instances):
+    deltas = _collect_deltas(session)
+    if deltas:
+        pending = session.info.setdefault('crime_rollup_deltas', Counter())
+        pending.update(deltas)
+    changes = _collect_map_changes(session)
+    if changes:
+        session.info.setdefault('crime_map_changes', []).extend(changes)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _write_crime_rollups(session, flush_context):
+    deltas = session.info.pop('crime_rollup_deltas', None)
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+    changes = session.info.pop('crime_map_changes', None)
+    if changes:
+        apply_map_deltas(session.connection(), map_cell_deltas(changes))
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_crime_rollups(session, previous_transaction):
+    session.info.pop('crime_rollup_deltas', None)
+    session.info.pop('crime_map_changes', None)
+
+
+def rebuild_rollups():
+    """Recompute the whole rollup table from ``crimes``; returns the row count."""
+    db.session.query(CrimeDailyStat).delete()
+    # The stored geohash starts with the bucket; rows written without one
+    # (ingest predating geohashes) are bucketed from their coordinates
+    cell = func.substr(Crime.geohash, 1, LOCATION_BUCKET_PRECISION)
+    columns = (Crime.date, Crime.type, Crime.status)
+    rows = (db.session.query(*columns, cell, func.count(Crime.id))
+            .filter(Crime.geohash.isnot(None)).group_by(*columns, cell))
+    deltas = Counter()
+    for day, crime_type, status, bucket, count in rows:
+        deltas[(day, crime_type, status or 'reported', bucket)] += count
+    rows = (db.session.query(*columns, Crime.latitude, Crime.longitude, func.count(Crime.id))
+            .filter(Crime.geohash.is_(None)).group_by(*columns, Crime.latitude, Crime.longitude))
+    for day, crime_type, status, latitude, longitude, count in rows:
+        deltas[rollup_key(day, crime_type, status, latitude, longitude)] += count
+    connection = db.session.connection()
+    table = CrimeDailyStat.__table__
+    batch = [dict(day=k[0], type=k[1], status=k[2], location_bucket=k[3], count=v)
+             for k, v in deltas.items()]
+    for start in range(0, len(batch), 5000):
+        connection.execute(table.insert(), batch[start:start + 5000])
+    db.session.commit()
+    return len(batch)
+
+
+def _bucket_labels(buckets):
+    # Name each cell after the station nearest its centre, falling back to
+    # the coordinates when no station index is available
+    cells = [bucket for bucket in buckets if bucket != UNKNOWN_LOCATION]
+    labels = {UNKNOWN_LOCATION: UNKNOWN_LOCATION}
+    centers = [geohash_center(cell) for cell in cells]
+    for cell, (latitude, longitude) in zip(cells, centers):
+        labels[cell] = f'{latitude:.2f}, {longitude:.2f}'
+    if cells:
+        from stations import StationIndexError, get_index
+        try:
+            index = get_index()
+            if len(index):
+                found = [index.nearest(latitude, longitude)[0][0] for latitude, longitude in centers]
+                names = dict(db.session.query(PoliceStation.id, PoliceStation.name)
+                             .filter(PoliceStation.id.in_(set(found))))
+                labels.update((cell, f'Near {names[station_id]}')
+                              for cell, station_id in zip(cells, found) if station_id in names)
+        except StationIndexError:
+            pass
+    return labels
+
+
+def _location_breakdown(buckets, counts):
+    # Cells sharing a nearest station are charted together
+    labels = _bucket_labels(buckets)
+    totals = Counter()
+    for bucket, count in zip(buckets, counts):
+        totals[labels[bucket]] += count
+    top = totals.most_common(TOP_LOCATIONS)
+    return [label for label, _ in top], [count for _, count in top]
+
+
+def rebuild_map_cells():
+    """Recompute the crime map cells from ``crimes``; returns the row count."""
+    db.session.query(CrimeMapCell).delete()
+    connection = db.session.connection()
+    table = CrimeMapCell.__table__
+    status = func.coalesce(Crime.status, 'reported')
+    total = 0
+    for precision in MAP_CELL_PRECISIONS:
+        cell = func.substr(Crime.geohash, 1, precision)
+        rows = (db.session.query(cell, Crime.type, status, func.count(Crime.id),
+                                 func.sum(Crime.latitude), func.sum(Crime.longitude))
+                .filter(Crime.geohash.isnot(None)).group_by(cell, Crime.type, status))
+        batch = []
+        for cell_value, crime_type, crime_status, *sums in rows:
+            latitude, longitude = geohash_center(cell_value)
+            batch.append(dict(precision=precision, cell=cell_value, type=crime_type, status=crime_status,
+                              latitude=latitude, longitude=longitude, **dict(zip(_MAP_SUMS, sums))))
+        for start in range(0, len(batch), 5000):
+            connection.execute(table.insert(), batch[start:start + 5000])
+        total += len(batch)
+    # Geocoded rows whose geohash has not been backfilled yet
+    rows = (db.session.query(Crime.type, Crime.status, Crime.latitude, Crime.longitude)
+            .filter(Crime.geohash.is_(None), Crime.latitude.isnot(None), Crime.longitude.isnot(None)))
+    apply_map_deltas(connection, map_cell_deltas((1, *row) for row in rows))
+    db.session.commit()
+    return total
+
+
+def crime_statistics(start_date, end_date):
+    """Chart data for the statistics page, summed from the daily rollup."""
+    in_range = (CrimeDailyStat.day >= start_date, CrimeDailyStat.day <= end_date)
+    total = func.sum(CrimeDailyStat.count)
+
+    monthly = defaultdict(int)
+    for day, count in (db.session.query(CrimeDailyStat.day, total)
+                       .filter(*in_range).group_by(CrimeDailyStat.day)):
+        monthly[(day.year, day.month)] += count
+    months, counts = [], []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        months.append(date(year, month, 1).strftime('%b %Y'))
+        counts.append(monthly.get((year, month), 0))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def breakdown(column, limit=None):
+        query = (db.session.query(column, total).filter(*in_range)
+                 .group_by(column).order_by(total.desc()))
+        if limit:
+            query = query.limit(limit)
+        rows = query.all()
+        return [row[0] for row in rows], [int(row[1]) for row in rows]
+
+    type_labels, type_data = breakdown(CrimeDailyStat.type)
+    location_labels, location_data = _location_breakdown(*breakdown(CrimeDailyStat.location_bucket))
+    status_labels, status_counts = breakdown(CrimeDailyStat.status)
+
+    return dict(
+        total_crimes=sum(counts),
+        months=months, counts=counts,
+        type_labels=type_labels, type_data=type_data,
+        location_labels=location_labels, location_data=location_data,
+        status_labels=status_labels, status_counts=status_counts,
+    )
+
+
+@click.command('rollup-rebuild')
+@with_appcontext
+def rollup_rebuild_command():
+    """Rebuild the daily crime statistics rollup and crime map cells from scratch."""
+    rows = rebuild_rollups()
+    cells = rebuild_map_cells()
+    click.echo(f'Rebuilt crime rollup: {rows} rows, {cells} map cells')
+
+
+def init_app(app):
+    app.cli.add_command(rollup_rebuild_command)
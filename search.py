@@ -0,0 +1,232 @@
+import time
+import random
+import string
+from datetime import date, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import DDL, event, func, text, tuple_
+
+from app import db
+from models import Crime
+
+# Number of crimes shown per page in the crime list
+PER_PAGE = 20
+
+# Expression covered by the PostgreSQL full-text GIN index. Queries must use
+# the exact same expression for the planner to pick the index up.
+PG_TSVECTOR = (
+    "to_tsvector('english', coalesce(type, '') || ' ' || "
+    "coalesce(description, '') || ' ' || coalesce(location, ''))"
+)
+
+# PostgreSQL: GIN index over the tsvector expression, and the location
+# prefix index with text_pattern_ops so LIKE 'x%' can use it
+PG_SEARCH_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_crimes_fts ON crimes USING gin ({PG_TSVECTOR})",
+    "CREATE INDEX IF NOT EXISTS ix_crimes_location_lower ON crimes (lower(location) text_pattern_ops)",
+]
+for _statement in PG_SEARCH_DDL:
+    event.listen(Crime.__table__, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+
+# SQLite: external-content FTS5 table kept in sync with triggers
+SQLITE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS crimes_fts USING fts5("
+    "type, description, location, content='crimes', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS crimes_fts_ai AFTER INSERT ON crimes BEGIN "
+    "INSERT INTO crimes_fts(rowid, type, description, location) "
+    "VALUES (new.id, new.type, new.description, new.location); END",
+    "CREATE TRIGGER IF NOT EXISTS crimes_fts_ad AFTER DELETE ON crimes BEGIN "
+    "INSERT INTO crimes_fts(crimes_fts, rowid, type, description, location) "
+    "VALUES ('delete', old.id, old.type, old.description, old.location); END",
+    "CREATE TRIGGER IF NOT EXISTS crimes_fts_au AFTER UPDATE ON crimes BEGIN "
+    "INSERT INTO crimes_fts(crimes_fts, rowid, type, description, location) "
+    "VALUES ('delete', old.id, old.type, old.description, old.location); "
+    "INSERT INTO crimes_fts(rowid, type, description, location) "
+    "VALUES (new.id, new.type, new.description, new.location); END",
+]
+for _statement in SQLITE_FTS_DDL:
+    event.listen(Crime.__table__, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+
+
+class CrimePage:
+    """One keyset page of crimes, newest first.
+
+    Pages are addressed by a cursor (``"<date>:<id>"``) instead of an OFFSET,
+    so fetching a deep page costs the same as fetching the first one.
+    """
+
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1]) if self.items and self.has_next else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0]) if self.items and self.has_prev else None
+
+
+def encode_cursor(crime):
+    return f'{crime.date.isoformat()}:{crime.id}'
+
+
+def decode_cursor(cursor):
+    """Parse a page cursor, returning ``None`` for anything malformed."""
+    try:
+        day, crime_id = cursor.split(':', 1)
+        return date.fromisoformat(day), int(crime_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _fts5_query(term):
+    # Quote every token so user input can't inject FTS5 query syntax
+    tokens = term.split()
+    return ' '.join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
+
+
+def _full_text_filter(term):
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return text(f"{PG_TSVECTOR} @@ plainto_tsquery('english', :fts_term)").bindparams(fts_term=term)
+    if dialect == 'sqlite':
+        return Crime.id.in_(
+            text("SELECT rowid FROM crimes_fts WHERE crimes_fts MATCH :fts_term")
+            .bindparams(fts_term=_fts5_query(term))
+            .columns(rowid=db.Integer)
+        )
+    like = f'%{term}%'
+    return Crime.type.ilike(like) | Crime.description.ilike(like) | Crime.location.ilike(like)
+
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def _location_prefix_filter(prefix):
+    # Written against the lower(location) index. PostgreSQL uses it for LIKE
+    # through text_pattern_ops; SQLite only optimises LIKE on plain NOCASE
+    # columns, so it gets an explicit range over the expression as well.
+    column = func.lower(Crime.location)
+    sqlite = db.engine.dialect.name == 'sqlite'
+    # SQLite's lower() folds ASCII only
+    prefix = prefix.translate(_ASCII_LOWER) if sqlite else prefix.lower()
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    condition = column.like(f'{escaped}%', escape='\\')
+    if sqlite:
+        condition &= (column >= prefix) & (column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    return condition
+
+
+def build_crime_query(search_term=None, crime_type=None, status=None,
+                      date_from=None, date_to=None, location=None):
+    """Return a filtered ``Crime`` query without ordering or paging applied."""
+    query = Crime.query
+    if crime_type:
+        query = query.filter(Crime.type == crime_type)
+    if status:
+        query = query.filter(Crime.status == status)
+    if date_from:
+        query = query.filter(Crime.date >= date_from)
+    if date_to:
+        query = query.filter(Crime.date <= date_to)
+    if location:
+        query = query.filter(_location_prefix_filter(location))
+    if search_term and search_term.strip():
+        query = query.filter(_full_text_filter(search_term.strip()))
+    return query
+
+
+def search_crimes(after=None, before=None, per_page=PER_PAGE, **filters):
+    """Seek-paginate crimes ordered by ``(date, id)`` descending.
+
+    ``after`` returns the page following that cursor, ``before`` the page
+    preceding it. Remaining keyword arguments are passed to
+    ``build_crime_query``.
+    """
+    query = build_crime_query(**filters)
+    key = tuple_(Crime.date, Crime.id)
+    after_key = decode_cursor(after) if after else None
+    before_key = decode_cursor(before) if before else None
+
+    if before_key:
+        rows = (query.filter(key > before_key)
+                .order_by(Crime.date.asc(), Crime.id.asc())
+                .limit(per_page + 1).all())
+        has_prev = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        return CrimePage(items, has_next=True, has_prev=has_prev)
+
+    if after_key:
+        query = query.filter(key < after_key)
+    rows = query.order_by(Crime.date.desc(), Crime.id.desc()).limit(per_page + 1).all()
+    return CrimePage(rows[:per_page], has_next=len(rows) > per_page, has_prev=after_key is not None)
+
+
+def crime_types():
+    """Distinct crime types for the search dropdown (served by the type index)."""
+    return [row[0] for row in db.session.query(Crime.type).distinct().order_by(Crime.type)]
+
+
+def rebuild_fts():
+    """Repopulate the SQLite FTS5 table from ``crimes``."""
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(text("INSERT INTO crimes_fts(crimes_fts) VALUES ('rebuild')"))
+        db.session.commit()
+
+
+@click.command('search-bench')
+@click.option('--rows', type=int, default=None,
+              help='Crimes to seed; defaults to enough for the deepest page (0 to reuse existing rows).')
+@click.option('--depth', 'depths', multiple=True, type=int, default=(1, 10, 100, 1000, 10000),
+              show_default=True, help='Page numbers to time.')
+@click.option('--repeat', default=5, show_default=True)
+@with_appcontext
+def search_bench_command(rows, depths, repeat):
+    """Seed crimes and time keyset page fetches at increasing depth."""
+    if rows is None:
+        rows = max(depths) * PER_PAGE
+    if rows:
+        types = ['Theft', 'Burglary', 'Assault', 'Fraud', 'Vandalism', 'Robbery']
+        statuses = ['reported', 'investigating', 'solved', 'closed']
+        start = date(1990, 1, 1)
+        batch = []
+        for i in range(rows):
+            batch.append({
+                'type': random.choice(types),
+                'description': f'Incident {i} reported near block {random.randint(1, 500)}',
+                'date': start + timedelta(days=random.randint(0, 12000)),
+                'location': f'District {random.randint(1, 40)}',
+                'status': random.choice(statuses),
+            })
+            if len(batch) == 10000:
+                db.session.execute(Crime.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(Crime.__table__.insert(), batch)
+        db.session.commit()
+        click.echo(f'Seeded {rows} crimes')
+
+    for depth in depths:
+        # Locate the cursor for the requested page; not part of the timing
+        offset = (depth - 1) * PER_PAGE
+        anchor = (Crime.query.order_by(Crime.date.desc(), Crime.id.desc())
+                  .offset(offset - 1).first() if offset else None)
+        if offset and anchor is None:
+            click.echo(f'page {depth:>6}: beyond end of table')
+            continue
+        cursor = encode_cursor(anchor) if anchor else None
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            search_crimes(after=cursor)
+            timings.append(time.perf_counter() - started)
+            db.session.expunge_all()
+        click.echo(f'page {depth:>6}: best {min(timings) * 1000:.2f} ms')
+
+
+def init_app(app):
+    app.cli.add_command(search_bench_command)
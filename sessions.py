@@ -0,0 +1,253 @@
+import time
+import secrets
+import threading
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, session
+from flask.cli import with_appcontext
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import delete, select, update
+from werkzeug.datastructures import CallbackDict
+
+from app import db
+from models import SessionRecord
+
+_serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data kept on the server; the cookie only carries a signed id.
+
+    Sessions are always permanent and expire ``PERMANENT_SESSION_LIFETIME``
+    after the last refresh.
+    """
+
+    def __init__(self, initial=None, sid=None, payload=None, expires_at=None):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = sid is None
+        self.payload = payload
+        self.expires_at = expires_at
+        self.modified = False
+        self.rotate = False
+
+    @property
+    def permanent(self):
+        return True
+
+    @permanent.setter
+    def permanent(self, value):
+        pass
+
+    def regenerate(self):
+        """Move the data to a fresh id on save, e.g. after login."""
+        self.rotate = True
+        self.modified = True
+
+
+class MemorySessionStore:
+    """Sessions in a dict; for single-process deployments only."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+        if entry is None or entry[0] <= datetime.utcnow():
+            return None
+        return entry
+
+    def save(self, sid, payload, expires_at):
+        with self._lock:
+            self._sessions[sid] = (expires_at, payload)
+
+    def touch(self, sid, expires_at):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is not None:
+                self._sessions[sid] = (expires_at, entry[1])
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def sweep(self, batch_size):
+        now = datetime.utcnow()
+        with self._lock:
+            expired = [sid for sid, (expires_at, _) in self._sessions.items() if expires_at <= now]
+            for sid in expired:
+                del self._sessions[sid]
+        return len(expired)
+
+
+class SqlSessionStore:
+    """Sessions in the ``sessions`` table.
+
+    Statements run on their own short transactions so that saving the
+    session never commits, or is rolled back with, the request's work.
+    """
+
+    table = SessionRecord.__table__
+
+    def load(self, sid):
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                select(self.table.c.expires_at, self.table.c.data)
+                .where(self.table.c.id == sid, self.table.c.expires_at > datetime.utcnow())
+            ).first()
+        return (row.expires_at, row.data) if row else None
+
+    def save(self, sid, payload, expires_at):
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                update(self.table).where(self.table.c.id == sid)
+                .values(data=payload, expires_at=expires_at)
+            ).rowcount
+            if not updated:
+                connection.execute(self.table.insert().values(
+                    id=sid, data=payload, expires_at=expires_at))
+
+    def touch(self, sid, expires_at):
+        with db.engine.begin() as connection:
+            connection.execute(update(self.table).where(self.table.c.id == sid).values(expires_at=expires_at))
+
+    def delete(self, sid):
+        with db.engine.begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.id == sid))
+
+    def sweep(self, batch_size):
+        """Delete expired sessions ``batch_size`` rows per transaction."""
+        removed = 0
+        while True:
+            with db.engine.begin() as connection:
+                expired = (select(self.table.c.id).where(self.table.c.expires_at <= datetime.utcnow())
+                           .limit(batch_size).scalar_subquery())
+                count = connection.execute(delete(self.table).where(self.table.c.id.in_(expired))).rowcount
+            removed += count
+            if count < batch_size:
+                return removed
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Loads and saves ``ServerSideSession`` objects through a store.
+
+    A response only sets the cookie when the session was written: when its
+    data actually changed, or when the sliding expiry is due a refresh,
+    which happens at most once per ``refresh_interval``.
+    """
+
+    session_class = ServerSideSession
+
+    def __init__(self, store, refresh_interval=300, sweep_interval=300, sweep_batch=1000):
+        self.store = store
+        self.refresh_interval = timedelta(seconds=refresh_interval)
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._last_sweep = time.monotonic()
+        self._sweep_lock = threading.Lock()
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-side-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            entry = self.store.load(sid) if sid else None
+            if entry is not None:
+                expires_at, payload = entry
+                return self.session_class(_serializer.loads(payload), sid=sid, payload=payload,
+                                          expires_at=expires_at)
+        return self.session_class()
+
+    def _set_cookie(self, app, response, session, expires_at):
+        response.set_cookie(
+            self.get_cookie_name(app),
+            self._signer(app).sign(session.sid).decode(),
+            expires=expires_at,
+            httponly=self.get_cookie_httponly(app),
+            domain=self.get_cookie_domain(app),
+            path=self.get_cookie_path(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def save_session(self, app, session, response):
+        self._maybe_sweep()
+        if session.accessed:
+            response.vary.add('Cookie')
+        lifetime = app.permanent_session_lifetime
+        now = datetime.utcnow()
+
+        if not session:
+            if session.sid is not None and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(self.get_cookie_name(app), domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app))
+            return
+
+        payload = _serializer.dumps(dict(session))
+        if session.rotate or session.sid is None:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+            session.payload = None
+        if payload != session.payload:
+            # Writing the same values back (as Flask-Login does) marks the
+            # session modified without changing it; only real changes are saved
+            self.store.save(session.sid, payload, now + lifetime)
+            self._set_cookie(app, response, session, now + lifetime)
+        elif session.expires_at - now < lifetime - self.refresh_interval:
+            self.store.touch(session.sid, now + lifetime)
+            self._set_cookie(app, response, session, now + lifetime)
+
+    def _maybe_sweep(self):
+        if time.monotonic() - self._last_sweep < self.sweep_interval:
+            return
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep = time.monotonic()
+            self.store.sweep(self.sweep_batch)
+        finally:
+            self._sweep_lock.release()
+
+
+def regenerate_session():
+    """Give the current session a new id, keeping its data (call after login)."""
+    if isinstance(session, ServerSideSession):
+        session.regenerate()
+
+
+@click.command('session-sweep')
+@with_appcontext
+def session_sweep_command():
+    """Delete expired server-side sessions now."""
+    interface = current_app.session_interface
+    if not isinstance(interface, ServerSideSessionInterface):
+        raise click.ClickException('SESSION_BACKEND is not a server-side store')
+    click.echo(f'Removed {interface.store.sweep(interface.sweep_batch)} expired sessions')
+
+
+def init_app(app):
+    backend = app.config.get('SESSION_BACKEND', 'sql')
+    if backend != 'cookie':
+        store = MemorySessionStore() if backend == 'memory' else SqlSessionStore()
+        app.session_interface = ServerSideSessionInterface(
+            store,
+            refresh_interval=app.config.get('SESSION_REFRESH_INTERVAL', 300),
+            sweep_interval=app.config.get('SESSION_SWEEP_INTERVAL', 300),
+            sweep_batch=app.config.get('SESSION_SWEEP_BATCH', 1000),
+        )
+    app.cli.add_command(session_sweep_command)
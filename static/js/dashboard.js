@@ -0,0 +1,103 @@
+// Keeps the dashboard summary cards current. While the live feed is
+// connected, crime and case changes trigger a refresh; otherwise it polls the
+// summary API, which answers unchanged polls with 304 Not Modified.
+
+const DASHBOARD_POLL_MS = 30000;
+const DASHBOARD_LIVE_DELAY_MS = 2000;
+
+function capitalize(text) {
+    return text.charAt(0).toUpperCase() + text.slice(1);
+}
+
+function renderCounts(list, counts) {
+    list.replaceChildren(...Object.keys(counts).sort().map(function(key) {
+        const item = document.createElement('li');
+        item.textContent = capitalize(key) + ': ' + counts[key];
+        return item;
+    }));
+}
+
+function renderNotes(list, notes) {
+    if (!notes.length) {
+        const empty = document.createElement('li');
+        empty.className = 'text-muted';
+        empty.textContent = 'No notes yet';
+        list.replaceChildren(empty);
+        return;
+    }
+    list.replaceChildren(...notes.map(function(note) {
+        const item = document.createElement('li');
+        item.className = 'mb-2';
+        const title = document.createElement('strong');
+        title.textContent = note.case_title;
+        const content = document.createElement('small');
+        content.textContent = note.content;
+        item.append(title, document.createElement('br'), content);
+        return item;
+    }));
+}
+
+function initDashboardSummary() {
+    const container = document.getElementById('dashboard-summary');
+    if (!container) return;
+    let lastEtag = null;
+
+    function refresh() {
+        // The browser revalidates with If-None-Match and hands back the cached body on 304
+        fetch(container.dataset.url, { credentials: 'same-origin' })
+            .then(function(response) {
+                if (!response.ok) throw new Error('HTTP ' + response.status);
+                const etag = response.headers.get('ETag');
+                if (etag && etag === lastEtag) return null;
+                lastEtag = etag;
+                return response.json();
+            })
+            .then(function(summary) {
+                if (!summary) return;
+                container.querySelectorAll('[data-summary]').forEach(function(element) {
+                    element.textContent = summary[element.dataset.summary];
+                });
+                container.querySelectorAll('[data-summary-list]').forEach(function(list) {
+                    renderCounts(list, summary[list.dataset.summaryList]);
+                });
+                container.querySelectorAll('[data-summary-notes]').forEach(function(list) {
+                    renderNotes(list, summary.recent_notes);
+                });
+            })
+            .catch(function(error) {
+                console.error('Error refreshing dashboard summary:', error);
+            });
+    }
+
+    // Changes arriving together cause a single refresh
+    let live = null;
+    let pending = null;
+    fetch('/api/live/token', { credentials: 'same-origin' })
+        .then(function(response) {
+            if (!response.ok) throw new Error('HTTP ' + response.status);
+            return response.json();
+        })
+        .then(function(feed) {
+            const params = new URLSearchParams({ token: feed.token, types: 'crime,case' });
+            live = new EventSource(feed.url + '?' + params);
+            ['crime', 'case', 'reset'].forEach(function(kind) {
+                live.addEventListener(kind, function() {
+                    if (!pending) {
+                        pending = setTimeout(function() {
+                            pending = null;
+                            refresh();
+                        }, DASHBOARD_LIVE_DELAY_MS);
+                    }
+                });
+            });
+        })
+        .catch(function(error) {
+            console.error('Live feed unavailable, polling instead:', error);
+        });
+
+    setInterval(function() {
+        if (!document.hidden && !(live && live.readyState === EventSource.OPEN)) refresh();
+    }, DASHBOARD_POLL_MS);
+}
+
+document.addEventListener('DOMContentLoaded', initDashboardSummary);
@@ -18,6 +18,8 @@ function initCrimeMap() {
     // Create layer groups for crimes and stations
     const crimeLayer = L.layerGroup().addTo(map);
     const stationLayer = L.layerGroup().addTo(map);
+    const heatLayer = L.layerGroup().addTo(map);
+    const hotspotLayer = L.layerGroup();
     
     // Define marker icons
     const crimeIcon = L.divIcon({
@@ -34,53 +36,200 @@ function initCrimeMap() {
         iconAnchor: [12, 12]
     });
     
-    // Function to load crime data
+    // Abort the previous viewport request when the map moves again
+    let pendingRequest = null;
+    
+    // Leaflet longitudes run past ±180 when zoomed out or after panning
+    // across the antimeridian; the server takes west,south,east,north within
+    // range, with west > east for a box crossing the antimeridian
+    const wrapLng = lng => ((lng + 180) % 360 + 360) % 360 - 180;
+    function bboxParam(bounds) {
+        let west = bounds.getWest(), east = bounds.getEast();
+        if (east - west >= 360) {
+            west = -180;
+            east = 180;
+        } else {
+            west = wrapLng(west);
+            east = wrapLng(east);
+        }
+        return [west, Math.max(-90, bounds.getSouth()), east, Math.min(90, bounds.getNorth())]
+            .map(value => value.toFixed(5)).join(',');
+    }
+    
+    // Type and date filters above the map, sent with every layer's request
+    const filterForm = document.getElementById('mapFilters');
+    function filterParams(names) {
+        const params = new URLSearchParams();
+        if (!filterForm) return params;
+        names.forEach(name => {
+            const value = filterForm.elements[name] && filterForm.elements[name].value;
+            if (value) params.set(name, value);
+        });
+        return params;
+    }
+    
+    // Function to load crime data for the visible area. The server returns
+    // GeoJSON: grid clusters at low zoom, individual crimes when zoomed in.
+    // The browser revalidates with the ETag, so unchanged views cost a 304.
     function loadCrimeData() {
-        fetch('/api/crime_data')
-            .then(response => response.json())
-            .then(crimes => {
+        if (pendingRequest) pendingRequest.abort();
+        pendingRequest = new AbortController();
+        
+        const params = filterParams(['type']);
+        params.set('bbox', bboxParam(map.getBounds()));
+        params.set('zoom', map.getZoom());
+        
+        fetch(`/api/crime_data?${params}`, { signal: pendingRequest.signal })
+            .then(response => {
+                if (!response.ok) throw new Error('HTTP ' + response.status);
+                return response.json();
+            })
+            .then(collection => {
                 // Clear existing markers
                 crimeLayer.clearLayers();
+                crimeMarkers.clear();
+                showingClusters = false;
                 
-                // Array to store all crime coordinates for auto-zoom
-                const crimeCoords = [];
-                
-                // Add crime markers
-                crimes.forEach(crime => {
-                    const marker = L.marker([crime.lat, crime.lng], {
-                        icon: crimeIcon
-                    }).addTo(crimeLayer);
+                collection.features.forEach(feature => {
+                    const [lng, lat] = feature.geometry.coordinates;
+                    const crime = feature.properties;
                     
-                    // Create popup content
-                    const popupContent = `
-                        <div class="crime-popup">
-                            <h6>${crime.type}</h6>
-                            <p><strong>Date:</strong> ${crime.date}</p>
-                            <p><strong>Time:</strong> ${crime.time || 'Not specified'}</p>
-                            <p><strong>Location:</strong> ${crime.location}</p>
-                            <p><strong>Status:</strong> <span class="badge bg-${getStatusColor(crime.status)}">${crime.status}</span></p>
-                            <a href="/crimes/${crime.id}" class="btn btn-sm btn-primary">View Details</a>
-                        </div>
-                    `;
+                    if (crime.cluster) {
+                        const marker = L.marker([lat, lng], { icon: clusterIcon(crime.count) }).addTo(crimeLayer);
+                        marker.on('click', () => map.setView([lat, lng], map.getZoom() + 2));
+                        showingClusters = true;
+                        return;
+                    }
                     
-                    marker.bindPopup(popupContent);
-                    crimeCoords.push([crime.lat, crime.lng]);
+                    addCrimeMarker(lat, lng, crime);
                 });
-                
-                // Load police station data after crimes are loaded
-                loadStationData(crimeCoords);
             })
-            .catch(error => console.error('Error loading crime data:', error));
+            .catch(error => {
+                if (error.name !== 'AbortError') console.error('Error loading crime data:', error);
+            });
+    }
+    
+    // Individual crime markers by id, so live updates can replace them
+    const crimeMarkers = new Map();
+    let showingClusters = false;
+    
+    function addCrimeMarker(lat, lng, crime) {
+        const marker = L.marker([lat, lng], {
+            icon: crimeIcon
+        }).addTo(crimeLayer);
+        
+        // Create popup content
+        const popupContent = `
+            <div class="crime-popup">
+                <h6>${crime.type}</h6>
+                <p><strong>Date:</strong> ${crime.date}</p>
+                <p><strong>Time:</strong> ${crime.time || 'Not specified'}</p>
+                <p><strong>Location:</strong> ${crime.location}</p>
+                <p><strong>Status:</strong> <span class="badge bg-${getStatusColor(crime.status)}">${crime.status}</span></p>
+                <a href="/crimes/${crime.id}" class="btn btn-sm btn-primary">View Details</a>
+            </div>
+        `;
+        
+        marker.bindPopup(popupContent);
+        crimeMarkers.set(crime.id, marker);
+    }
+    
+    // Live updates: new and changed crimes arrive as Server-Sent Events for
+    // a box around the viewport, so the map no longer re-fetches the whole
+    // view to see them. Markers are patched in place; a clustered view is
+    // reloaded at most every LIVE_CLUSTER_RELOAD_MS. After a reconnect the
+    // server replays what was missed since the last event id.
+    const LIVE_CLUSTER_RELOAD_MS = 30000;
+    let liveSource = null;
+    let liveBounds = null;
+    let lastEventId = null;
+    let clusterReload = null;
+    
+    function subscribeLive() {
+        const view = map.getBounds();
+        if (liveSource && liveBounds.contains(view)) return;
+        const padded = view.pad(0.5);
+        fetch('/api/live/token')
+            .then(response => {
+                if (!response.ok) throw new Error('HTTP ' + response.status);
+                return response.json();
+            })
+            .then(live => {
+                if (liveSource) liveSource.close();
+                liveBounds = padded;
+                const params = new URLSearchParams({
+                    token: live.token,
+                    types: 'crime',
+                    bbox: bboxParam(padded)
+                });
+                if (lastEventId) params.set('cursor', lastEventId);
+                liveSource = new EventSource(`${live.url}?${params}`);
+                liveSource.addEventListener('crime', applyCrimeEvent);
+                liveSource.addEventListener('reset', loadCrimeData);
+                liveSource.onerror = () => {
+                    // EventSource retries by itself unless the server refused the stream
+                    if (liveSource.readyState === EventSource.CLOSED) {
+                        liveSource = null;
+                        setTimeout(subscribeLive, LIVE_CLUSTER_RELOAD_MS);
+                    }
+                };
+            })
+            .catch(error => console.error('Live feed unavailable:', error));
+    }
+    
+    // The feed is not filtered by type; events are checked against the
+    // filter form as they arrive, and the form reloads the markers on change
+    function matchesFilters(crime) {
+        const type = filterParams(['type']).get('type');
+        return !type || (crime != null && crime.type === type);
+    }
+    
+    function applyCrimeEvent(event) {
+        lastEventId = event.lastEventId;
+        const change = JSON.parse(event.data);
+        const crime = change.data;
+        const matches = matchesFilters(crime);
+        if (showingClusters) {
+            // An update or delete may take a crime out of the filtered counts
+            if (!matches && change.action === 'insert') return;
+            if (!clusterReload) {
+                clusterReload = setTimeout(() => {
+                    clusterReload = null;
+                    loadCrimeData();
+                }, LIVE_CLUSTER_RELOAD_MS);
+            }
+            return;
+        }
+        const existing = crimeMarkers.get(change.id);
+        if (existing) {
+            crimeLayer.removeLayer(existing);
+            crimeMarkers.delete(change.id);
+        }
+        if (change.action === 'delete' || !matches || crime.lat == null || crime.lng == null) return;
+        if (map.getBounds().contains([crime.lat, crime.lng])) addCrimeMarker(crime.lat, crime.lng, crime);
+    }
+    
+    // Cluster marker sized by the number of crimes it stands for
+    function clusterIcon(count) {
+        const size = Math.min(60, 24 + Math.round(Math.log10(count + 1) * 10));
+        return L.divIcon({
+            html: `<div class="crime-cluster-icon">${count}</div>`,
+            className: 'crime-cluster-marker',
+            iconSize: [size, size],
+            iconAnchor: [size / 2, size / 2]
+        });
     }
     
     // Function to load police station data
-    function loadStationData(crimeCoords) {
+    function loadStationData() {
         fetch('/api/station_data')
             .then(response => response.json())
             .then(stations => {
                 // Clear existing markers
                 stationLayer.clearLayers();
                 
+                const stationCoords = [];
+                
                 // Add station markers
                 stations.forEach(station => {
                     const marker = L.marker([station.lat, station.lng], {
@@ -97,18 +246,89 @@ function initCrimeMap() {
                     `;
                     
                     marker.bindPopup(popupContent);
-                    crimeCoords.push([station.lat, station.lng]);
+                    stationCoords.push([station.lat, station.lng]);
                 });
                 
-                // Auto-zoom if we have coordinates
-                if (crimeCoords.length > 0) {
-                    const bounds = L.latLngBounds(crimeCoords);
-                    map.fitBounds(bounds, { padding: [50, 50] });
+                // Auto-zoom to the stations; the moveend handler then loads crimes
+                if (stationCoords.length > 0) {
+                    map.fitBounds(L.latLngBounds(stationCoords), { padding: [50, 50] });
+                } else {
+                    loadCrimeData();
                 }
             })
             .catch(error => console.error('Error loading station data:', error));
     }
     
+    // Kernel density and Gi* hotspots of the crimes in view that match the
+    // filters. The density grid (one byte per cell, south row first) is
+    // painted onto a canvas and shown as an image overlay. The analysis is
+    // redone for the viewport shortly after the map stops moving; while the
+    // server is still loading crimes it answers 503 and is asked again.
+    const HOTSPOT_DELAY_MS = 500;
+    let hotspotTimer = null;
+    let hotspotRequest = null;
+    
+    function scheduleHotspots(delay = HOTSPOT_DELAY_MS) {
+        clearTimeout(hotspotTimer);
+        hotspotTimer = setTimeout(loadHotspots, delay);
+    }
+    
+    function loadHotspots() {
+        if (hotspotRequest) hotspotRequest.abort();
+        hotspotRequest = new AbortController();
+        const params = filterParams(['type', 'date_from', 'date_to']);
+        const bbox = bboxParam(map.getBounds());
+        const [west, , east] = bbox.split(',').map(Number);
+        // A view across the antimeridian is analysed without a box
+        if (west < east) params.set('bbox', bbox);
+        
+        fetch(`/api/hotspots?${params}`, { signal: hotspotRequest.signal })
+            .then(response => {
+                if (response.status === 503) {
+                    scheduleHotspots(1000 * (Number(response.headers.get('Retry-After')) || 5));
+                    throw new Error('hotspot data still loading');
+                }
+                if (!response.ok) throw new Error('HTTP ' + response.status);
+                return response.json();
+            })
+            .then(analysis => {
+                heatLayer.clearLayers();
+                hotspotLayer.clearLayers();
+                if (!analysis.points) return;
+                
+                const [west, south, east, north] = analysis.bounds;
+                const canvas = document.createElement('canvas');
+                canvas.width = analysis.cols;
+                canvas.height = analysis.rows;
+                const context = canvas.getContext('2d');
+                const image = context.createImageData(analysis.cols, analysis.rows);
+                analysis.density.forEach((value, index) => {
+                    const row = analysis.rows - 1 - Math.floor(index / analysis.cols);
+                    const offset = (row * analysis.cols + index % analysis.cols) * 4;
+                    // Yellow through red, transparent where there is nothing
+                    image.data[offset] = 255;
+                    image.data[offset + 1] = 255 - value;
+                    image.data[offset + 2] = 0;
+                    image.data[offset + 3] = value ? 60 + value * 0.7 : 0;
+                });
+                context.putImageData(image, 0, 0);
+                L.imageOverlay(canvas.toDataURL(), [[south, west], [north, east]], { opacity: 0.7 }).addTo(heatLayer);
+                
+                const cellLat = (north - south) / analysis.rows;
+                const cellLng = (east - west) / analysis.cols;
+                analysis.hotspots.forEach(cell => {
+                    const cellSouth = south + cell.row * cellLat;
+                    const cellWest = west + cell.col * cellLng;
+                    L.rectangle([[cellSouth, cellWest], [cellSouth + cellLat, cellWest + cellLng]], {
+                        color: '#dc3545', weight: 1, fillOpacity: 0.25
+                    }).bindPopup(`<strong>Hotspot</strong><br>${cell.count} crimes, z = ${cell.z}`).addTo(hotspotLayer);
+                });
+            })
+            .catch(error => {
+                if (error.name !== 'AbortError') console.error('Error loading hotspots:', error);
+            });
+    }
+    
     // Helper function to get status color for badge
     function getStatusColor(status) {
         switch (status) {
@@ -123,13 +343,26 @@ function initCrimeMap() {
     // Add layer controls
     const overlays = {
         "Crimes": crimeLayer,
-        "Police Stations": stationLayer
+        "Police Stations": stationLayer,
+        "Crime Density": heatLayer,
+        "Hotspots (Gi*)": hotspotLayer
     };
     
     L.control.layers(null, overlays).addTo(map);
     
-    // Load the data
-    loadCrimeData();
+    // Load the data, then refresh crimes (and the live subscription) whenever the viewport changes
+    map.on('moveend', loadCrimeData);
+    map.on('moveend', subscribeLive);
+    map.on('moveend', () => scheduleHotspots());
+    if (filterForm) {
+        filterForm.addEventListener('change', () => {
+            loadCrimeData();
+            scheduleHotspots(0);
+        });
+        filterForm.addEventListener('submit', event => event.preventDefault());
+    }
+    loadStationData();
+    scheduleHotspots();
     
     // Add a legend
     const legend = L.control({ position: 'bottomright' });
@@ -144,10 +377,14 @@ function initCrimeMap() {
                         <i class="fas fa-exclamation-triangle text-danger me-2"></i>
                         <span>Crime Location</span>
                     </div>
-                    <div class="d-flex align-items-center">
+                    <div class="d-flex align-items-center mb-2">
                         <i class="fas fa-building text-primary me-2"></i>
                         <span>Police Station</span>
                     </div>
+                    <div class="d-flex align-items-center">
+                        <i class="fas fa-square text-danger me-2"></i>
+                        <span>Hotspot (Gi* z &ge; 1.96)</span>
+                    </div>
                 </div>
             </div>
         `;
@@ -0,0 +1,395 @@
+import math
+import time
+import threading
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, inspect, select
+
+from app import db
+from models import Crime, PoliceStation
+
+# Mean Earth radius, for turning chord lengths into great-circle distances
+EARTH_RADIUS_KM = 6371.0088
+
+# Stations per KD-tree leaf
+LEAF_SIZE = 16
+
+# Query points handled per vectorized step
+QUERY_CHUNK = 65536
+
+# Crimes read, matched and written per backfill transaction
+BACKFILL_BATCH = 200000
+
+
+class StationIndexError(Exception):
+    pass
+
+
+def _numpy():
+    # Imported on first use; numpy is not needed to start the app
+    try:
+        import numpy
+    except ImportError:
+        raise StationIndexError('Nearest-station lookups require the numpy package')
+    return numpy
+
+
+def unit_vectors(lat, lng):
+    """Points on the unit sphere; straight-line (chord) distance between them
+    orders pairs exactly as great-circle distance does, without trigonometry
+    per comparison."""
+    np = _numpy()
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)], axis=-1)
+
+
+def chord_km(squared):
+    """Great-circle kilometres for squared chord lengths on the unit sphere."""
+    np = _numpy()
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.sqrt(squared) / 2, 1.0))
+
+
+class StationIndex:
+    """KD-tree over station coordinates, queried in vectorized batches.
+
+    Stations are split at the median of their widest axis (as 3-d unit
+    vectors) into leaves of at most ``leaf_size``. A batch query first takes
+    the k nearest in each point's own leaf as a bound, then walks the tree
+    one level at a time for all points together, descending only into
+    nodes whose bounding box is closer than the point's current bound.
+    """
+
+    def __init__(self, ids, lat, lng, leaf_size=LEAF_SIZE):
+        np = _numpy()
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.leaf_size = leaf_size
+        self.built = self.checked = 0.0
+        self.signature = None
+        points = unit_vectors(lat, lng).reshape(-1, 3)
+        # Per node: split axis (-1 for leaves) and value, children, leaf
+        # number and bounding box
+        axis, split, left, right, leaf_of, low, high = [], [], [], [], [], [], []
+        leaves = []
+
+        def build(members):
+            node = len(axis)
+            coords = points[members]
+            axis.append(-1)
+            split.append(0.0)
+            left.append(-1)
+            right.append(-1)
+            leaf_of.append(-1)
+            low.append(coords.min(axis=0) if len(members) else np.full(3, np.inf))
+            high.append(coords.max(axis=0) if len(members) else np.full(3, -np.inf))
+            if len(members) <= leaf_size:
+                leaf_of[node] = len(leaves)
+                leaves.append(members)
+                return node
+            widest = int(np.argmax(high[node] - low[node]))
+            half = len(members) // 2
+            members = members[np.argpartition(coords[:, widest], half)]
+            axis[node], split[node] = widest, float(points[members[half], widest])
+            left[node] = build(members[:half])
+            right[node] = build(members[half:])
+            return node
+
+        build(np.arange(len(self.ids)))
+        self._axis = np.array(axis, dtype=np.int64)
+        self._split = np.array(split)
+        self._left = np.array(left, dtype=np.int64)
+        self._right = np.array(right, dtype=np.int64)
+        self._leaf_of = np.array(leaf_of, dtype=np.int64)
+        self._low = np.array(low).reshape(-1, 3)
+        self._high = np.array(high).reshape(-1, 3)
+        # Leaves padded to leaf_size; padding sits far off the sphere
+        self._leaf_points = np.full((len(leaves), leaf_size, 3), 10.0)
+        self._leaf_ids = np.full((len(leaves), leaf_size), -1, dtype=np.int64)
+        for index, members in enumerate(leaves):
+            self._leaf_points[index, :len(members)] = points[members]
+            self._leaf_ids[index, :len(members)] = self.ids[members]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _own_leaves(self, points):
+        np = _numpy()
+        node = np.zeros(len(points), dtype=np.int64)
+        while True:
+            inner = self._axis[node] >= 0
+            if not inner.any():
+                return self._leaf_of[node]
+            at = node[inner]
+            go_left = points[inner, self._axis[at]] < self._split[at]
+            node[inner] = np.where(go_left, self._left[at], self._right[at])
+
+    def _merge(self, best, best_ids, points, rows, leaves, k):
+        """Fold the stations of ``leaves[i]`` into the sorted k best of
+        ``rows[i]``; a row listed several times is merged in rounds."""
+        np = _numpy()
+        while len(rows):
+            _, first = np.unique(rows, return_index=True)
+            row, leaf = rows[first], leaves[first]
+            distances = np.concatenate(
+                [best[row], ((self._leaf_points[leaf] - points[row, None, :]) ** 2).sum(axis=2)], axis=1)
+            stations = np.concatenate([best_ids[row], self._leaf_ids[leaf]], axis=1)
+            keep = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            distances, stations = np.take_along_axis(distances, keep, axis=1), np.take_along_axis(stations, keep, axis=1)
+            order = np.argsort(distances, axis=1)
+            best[row] = np.take_along_axis(distances, order, axis=1)
+            best_ids[row] = np.take_along_axis(stations, order, axis=1)
+            rest = np.ones(len(rows), dtype=bool)
+            rest[first] = False
+            rows, leaves = rows[rest], leaves[rest]
+
+    def _query_chunk(self, points, k):
+        np = _numpy()
+        own = self._own_leaves(points)
+        best = np.full((len(points), k), np.inf)
+        best_ids = np.full((len(points), k), -1, dtype=np.int64)
+        everyone = np.arange(len(points))
+        self._merge(best, best_ids, points, everyone, own, k)
+        rows, nodes = everyone, np.zeros(len(points), dtype=np.int64)
+        while len(rows):
+            # Squared distance from each point to its node's bounding box
+            at = points[rows]
+            gap = np.maximum(self._low[nodes] - at, 0) + np.maximum(at - self._high[nodes], 0)
+            near = (gap ** 2).sum(axis=1) < best[rows, k - 1]
+            rows, nodes = rows[near], nodes[near]
+            leaf = self._axis[nodes] < 0
+            visit = leaf & (self._leaf_of[nodes] != own[rows])
+            if visit.any():
+                self._merge(best, best_ids, points, rows[visit], self._leaf_of[nodes[visit]], k)
+            rows, nodes = rows[~leaf], nodes[~leaf]
+            rows, nodes = np.concatenate([rows, rows]), np.concatenate([self._left[nodes], self._right[nodes]])
+        return best_ids, best
+
+    def query(self, lat, lng, k=1):
+        """The ``k`` nearest stations to each point, as ``(ids, km)`` arrays
+        of shape ``(points, k)``, nearest first."""
+        np = _numpy()
+        k = max(1, min(k, len(self)))
+        points = unit_vectors(lat, lng).reshape(-1, 3)
+        ids = np.empty((len(points), k), dtype=np.int64)
+        squared = np.empty((len(points), k))
+        if not len(self):
+            return ids[:, :0], squared[:, :0]
+        for start in range(0, len(points), QUERY_CHUNK):
+            ids[start:start + QUERY_CHUNK], squared[start:start + QUERY_CHUNK] = self._query_chunk(
+                points[start:start + QUERY_CHUNK], k)
+        return ids, chord_km(squared)
+
+    def nearest(self, lat, lng, k=1):
+        """``[(station id, km), ...]`` for one point, nearest first."""
+        ids, km = self.query([lat], [lng], k)
+        return [(int(station_id), float(distance)) for station_id, distance in zip(ids[0], km[0])]
+
+
+_index = None
+_index_lock = threading.Lock()
+_stale_key = 'station_index_stale'
+
+
+def _signature(connection):
+    # Changes whenever a station is added, removed, moved or edited
+    return tuple(connection.execute(select(
+        func.count(PoliceStation.id), func.max(PoliceStation.id), func.max(PoliceStation.updated_at))).one())
+
+
+def build_index(connection=None):
+    connection = connection or db.session
+    rows = connection.execute(select(PoliceStation.id, PoliceStation.latitude, PoliceStation.longitude).where(
+        PoliceStation.latitude.isnot(None), PoliceStation.longitude.isnot(None))).all()
+    index = StationIndex([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+    index.signature = _signature(connection)
+    index.built = index.checked = time.monotonic()
+    return index
+
+
+def get_index(connection=None):
+    """The process-wide station index.
+
+    Rebuilt after a local commit touches a station, or when another process
+    has changed them (checked every ``STATION_INDEX_REFRESH`` seconds).
+    """
+    global _index
+    with _index_lock:
+        now = time.monotonic()
+        if _index is None:
+            _index = build_index(connection)
+        elif now - _index.checked > current_app.config.get('STATION_INDEX_REFRESH', 60):
+            if _signature(connection or db.session) != _index.signature:
+                _index = build_index(connection)
+            _index.checked = now
+        return _index
+
+
+def nearest_stations(lat, lng, k=1):
+    """The ``k`` nearest stations as dicts with ``distance_km``, nearest first."""
+    found = get_index().nearest(lat, lng, k)
+    stations = {station.id: station for station in
+                PoliceStation.query.filter(PoliceStation.id.in_([station_id for station_id, _ in found]))}
+    return [{'id': station_id, 'name': stations[station_id].name, 'address': stations[station_id].address,
+             'contact': stations[station_id].contact, 'lat': stations[station_id].latitude,
+             'lng': stations[station_id].longitude, 'distance_km': round(km, 3)}
+            for station_id, km in found if station_id in stations]
+
+
+def nearest_station_ids(points, k=1):
+    """``[[{'id', 'distance_km'}, ...], ...]`` for a list of ``(lat, lng)`` points."""
+    np = _numpy()
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    ids, km = get_index().query(points[:, 0], points[:, 1], k)
+    return [[{'id': int(station_id), 'distance_km': round(float(distance), 3)}
+             for station_id, distance in zip(row_ids, row_km)] for row_ids, row_km in zip(ids, km)]
+
+
+@event.listens_for(Crime, 'before_insert')
+@event.listens_for(Crime, 'before_update')
+def _set_crime_station(mapper, connection, crime):
+    # A station set explicitly is kept; otherwise follow the coordinates
+    state = inspect(crime)
+    if crime.latitude is None or crime.longitude is None or state.attrs.station_id.history.has_changes():
+        return
+    moved = state.attrs.latitude.history.has_changes() or state.attrs.longitude.history.has_changes()
+    if crime.station_id is not None and not moved:
+        return
+    try:
+        index = get_index(connection)
+    except StationIndexError:
+        return
+    if len(index):
+        crime.station_id = index.nearest(crime.latitude, crime.longitude)[0][0]
+
+
+@event.listens_for(db.session, 'after_flush')
+def _capture_station_changes(session, flush_context):
+    if any(isinstance(obj, PoliceStation) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info[_stale_key] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_stale_index(session):
+    global _index
+    if session.info.pop(_stale_key, False):
+        _index = None
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_station_changes(session, previous_transaction):
+    session.info.pop(_stale_key, None)
+
+
+def backfill_crime_stations(reassign=False, batch_size=BACKFILL_BATCH):
+    """Set ``Crime.station_id`` to the nearest station for geocoded crimes.
+
+    Only crimes without a station are matched unless ``reassign`` is set
+    (e.g. after stations moved). Returns the number of crimes changed.
+    """
+    np = _numpy()
+    index = get_index()
+    if not len(index):
+        return 0
+    table = Crime.__table__
+    query = select(table.c.id, table.c.latitude, table.c.longitude, table.c.station_id).where(
+        table.c.latitude.isnot(None), table.c.longitude.isnot(None))
+    if not reassign:
+        query = query.where(table.c.station_id.is_(None))
+    changed, after_id = 0, 0
+    while True:
+        rows = db.session.execute(query.where(table.c.id > after_id).order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            return changed
+        after_id = rows[-1][0]
+        ids, lat, lng, current = (np.array(column) for column in zip(*rows))
+        nearest = index.query(lat.astype(np.float64), lng.astype(np.float64), 1)[0][:, 0]
+        moved = np.flatnonzero(current != nearest) if reassign else np.arange(len(ids))
+        if len(moved):
+            db.session.execute(
+                table.update().where(table.c.id == db.bindparam('crime_id')).values(station_id=db.bindparam('station')),
+                [{'crime_id': int(ids[row]), 'station': int(nearest[row])} for row in moved],
+            )
+        db.session.commit()
+        changed += len(moved)
+
+
+@click.group('stations')
+def stations_cli():
+    """Nearest-station index over police stations."""
+
+
+@stations_cli.command('backfill')
+@click.option('--reassign', is_flag=True, help='Recheck crimes that already have a station.')
+@click.option('--batch-size', default=BACKFILL_BATCH, show_default=True)
+@with_appcontext
+def backfill_command(reassign, batch_size):
+    """Assign geocoded crimes to their nearest station."""
+    started = time.perf_counter()
+    try:
+        changed = backfill_crime_stations(reassign=reassign, batch_size=batch_size)
+    except StationIndexError as exc:
+        raise click.ClickException(str(exc))
+    click.echo(f'Assigned {changed} crimes in {time.perf_counter() - started:.1f}s')
+
+
+@stations_cli.command('bench')
+@click.option('--stations', default=2000, show_default=True)
+@click.option('--points', default=1000000, show_default=True, help='Crimes matched in one batch.')
+@click.option('--k', default=3, show_default=True)
+@click.option('--seed', 'seed_value', default=0, show_default=True)
+def bench_command(stations, points, k, seed_value):
+    """Time the index against brute force on synthetic data (no database needed)."""
+    try:
+        np = _numpy()
+    except StationIndexError as exc:
+        raise click.ClickException(str(exc))
+    rng = np.random.default_rng(seed_value)
+    # A metropolitan area about 60 km across
+    station_lat, station_lng = 40.4 + rng.random(stations) * 0.6, -74.3 + rng.random(stations) * 0.8
+    lat, lng = 40.4 + rng.random(points) * 0.6, -74.3 + rng.random(points) * 0.8
+
+    started = time.perf_counter()
+    index = StationIndex(np.arange(1, stations + 1), station_lat, station_lng)
+    click.echo(f'build              {(time.perf_counter() - started) * 1000:9.1f} ms   {stations} stations')
+
+    started = time.perf_counter()
+    for row in range(1000):
+        index.nearest(lat[row], lng[row], k)
+    click.echo(f'single nearest-{k}   {(time.perf_counter() - started):9.3f} ms per query')
+
+    started = time.perf_counter()
+    ids, km = index.query(lat, lng, k)
+    elapsed = time.perf_counter() - started
+    click.echo(f'batch nearest-{k}    {elapsed:9.2f} s    {points / elapsed:,.0f} points/s')
+
+    # Exact answers for a sample, by full scans
+    sample = min(points, 20000)
+    started = time.perf_counter()
+    squared = ((unit_vectors(lat[:sample], lng[:sample])[:, None, :]
+                - unit_vectors(station_lat, station_lng)[None, :, :]) ** 2).sum(axis=2)
+    exact = np.argsort(squared, axis=1)[:, :k] + 1
+    elapsed = time.perf_counter() - started
+    click.echo(f'numpy full scan    {elapsed / sample * points:9.2f} s    (extrapolated from {sample})')
+    mismatches = int((exact != ids[:sample]).any(axis=1).sum())
+
+    def haversine(lat1, lng1, lat2, lng2):
+        phi1, phi2 = math.radians(lat1), math.radians(lat2)
+        a = (math.sin((phi2 - phi1) / 2) ** 2
+             + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+    scan = 200
+    pairs = list(zip(station_lat.tolist(), station_lng.tolist()))
+    started = time.perf_counter()
+    for row in range(scan):
+        min(range(stations), key=lambda s: haversine(lat[row], lng[row], *pairs[s]))
+    elapsed = time.perf_counter() - started
+    click.echo(f'python haversine   {elapsed / scan * points:9.0f} s    (extrapolated from {scan})')
+    click.echo(f'{mismatches} of {sample} sampled points differ from the full scan')
+
+
+def init_app(app):
+    app.cli.add_command(stations_cli)
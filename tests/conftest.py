@@ -0,0 +1,33 @@
+import pytest
+
+from app import create_app, db
+import bootstrap
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'WTF_CSRF_ENABLED': False,
+        'AUDIT_MODE': 'sync',
+        'FEED_ENABLED': False,
+        'USER_CACHE_PATH': '',
+        'FRAGMENT_CACHE_PATH': '',
+        'RATE_LIMIT_PATH': '',
+        'OAUTH_TOKEN_CACHE_PATH': '',
+        'HOTSPOT_PRELOAD': False,
+        'NAME_INDEX_PRELOAD': False,
+    })
+    app.instance_path = str(tmp_path_factory.mktemp('instance'))
+    return app
+
+
+@pytest.fixture
+def database(app):
+    """A fresh schema for each test, inside an app context."""
+    with app.app_context():
+        bootstrap.create_schema()
+        yield db
+        db.session.remove()
+        db.drop_all()
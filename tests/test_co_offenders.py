@@ -0,0 +1,43 @@
+from co_offenders import CoOffenderGraph
+
+
+def test_groups_stay_cached_until_the_links_change():
+    graph = CoOffenderGraph({(1, 10), (2, 10), (3, 11), (4, 11)})
+    groups = graph.components()
+    assert groups == [[1, 2], [3, 4]]
+    graph.update(added=[(1, 10), (2, 10)], removed=[(5, 12)])
+    assert graph.components() is groups
+    graph.update(added=[(2, 11)])
+    assert graph.components() == [[1, 2, 3, 4]]
+    assert graph.component_of(4) == [1, 2, 3, 4]
+    assert graph.component_of(9) == [9]
+
+
+def test_swapping_an_overlay_link_regroups():
+    graph = CoOffenderGraph({(1, 10), (2, 10)})
+    graph.update(added=[(3, 10)])
+    assert graph.component_of(3) == [1, 2, 3]
+    graph.update(added=[(4, 10)], removed=[(3, 10)])
+    assert len(graph) == 3
+    assert graph.component_of(3) == [3]
+    assert graph.component_of(4) == [1, 2, 4]
+
+
+def test_repointed_links_move_in_the_graph(database, monkeypatch):
+    import co_offenders
+    from benchmark import seed
+    from models import Crime, CriminalCrime
+    seed(0.05, 0)
+    monkeypatch.setattr(co_offenders, '_graph', co_offenders.build_graph())
+    link = CriminalCrime.query.order_by(CriminalCrime.id).first()
+    old = (link.criminal_id, link.crime_id)
+    linked = {crime for crime, in database.session.query(CriminalCrime.crime_id).filter_by(criminal_id=old[0])}
+    new_crime = next(crime for crime, in database.session.query(Crime.id) if crime not in linked)
+    database.session.commit()
+    # Expired by the commit, so the old value has to be loaded on assignment
+    link.crime_id = new_crime
+    database.session.commit()
+    graph = co_offenders._graph
+    assert new_crime in graph.crimes_of(old[0])
+    assert (old[1] in graph.crimes_of(old[0])) == (CriminalCrime.query.filter_by(
+        criminal_id=old[0], crime_id=old[1]).count() > 0)
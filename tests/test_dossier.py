@@ -0,0 +1,94 @@
+from datetime import date
+
+import pytest
+
+from models import User, Crime, Criminal, CriminalCrime, Victim, Witness, Evidence, Case, CaseNote
+from dossier import (CRIME_DOSSIER_QUERIES, CASE_DOSSIER_QUERIES, load_crime_dossier, load_crime_dossiers,
+                     load_case_dossier)
+from instrumentation import count_queries
+
+
+@pytest.fixture
+def records(database):
+    officer = User(username='officer', email='officer@example.com', role='officer')
+    officer.set_password('password')
+    database.session.add(officer)
+    crimes = []
+    for i in range(5):
+        crime = Crime(type='Theft', date=date(2024, 1, i + 1), location=f'District {i}')
+        database.session.add(crime)
+        database.session.flush()
+        for j in range(3):
+            criminal = Criminal(name=f'Suspect {i}-{j}')
+            database.session.add(criminal)
+            database.session.flush()
+            database.session.add_all([
+                CriminalCrime(criminal_id=criminal.id, crime_id=crime.id, role='suspect'),
+                Victim(name=f'Victim {i}-{j}', crime_id=crime.id),
+                Witness(name=f'Witness {i}-{j}', crime_id=crime.id),
+                Evidence(name=f'Item {i}-{j}', crime_id=crime.id),
+            ])
+        case = Case(title=f'Case {i}', crime_id=crime.id, officer_id=str(officer.id))
+        database.session.add(case)
+        database.session.flush()
+        database.session.add_all(CaseNote(case_id=case.id, user_id=str(officer.id), content=f'Note {k}')
+                                 for k in range(3))
+        crimes.append(crime)
+    database.session.commit()
+    crime_ids = [crime.id for crime in crimes]
+    case_ids = [row.id for row in Case.query.order_by(Case.id)]
+    database.session.expunge_all()
+    return crime_ids, case_ids
+
+
+def _read_crime_dossier(dossier):
+    # Everything the crime page shows
+    return ([criminal.name for criminal in dossier.criminals],
+            [link.role for link in dossier.criminal_links],
+            [victim.name for victim in dossier.victims],
+            [witness.name for witness in dossier.witnesses],
+            [item.name for item in dossier.evidence],
+            [(case.title, case.assigned_officer.username) for case in dossier.cases])
+
+
+def test_crime_dossier_fits_budget(database, records):
+    crime_ids, _ = records
+    with count_queries() as counter:
+        dossier = load_crime_dossier(crime_ids[0])
+        criminals, roles, victims, witnesses, evidence, cases = _read_crime_dossier(dossier)
+    assert counter[0] <= CRIME_DOSSIER_QUERIES
+    assert len(criminals) == len(victims) == len(witnesses) == len(evidence) == 3
+    assert cases == [('Case 0', 'officer')]
+
+
+def test_crime_dossier_budget_does_not_grow_with_crimes(database, records):
+    crime_ids, _ = records
+    with count_queries() as counter:
+        dossiers = load_crime_dossiers(crime_ids)
+        for dossier in dossiers.values():
+            _read_crime_dossier(dossier)
+    assert counter[0] <= CRIME_DOSSIER_QUERIES
+    assert sorted(dossiers) == sorted(crime_ids)
+
+
+def test_case_dossier_fits_budget(database, records):
+    _, case_ids = records
+    with count_queries() as counter:
+        dossier = load_case_dossier(case_ids[0])
+        notes = [(note.content, note.user.username) for note in dossier.notes]
+        officer = dossier.officer.username
+        crime = dossier.crime.type
+        _read_crime_dossier(dossier.crime_dossier)
+    assert counter[0] <= CASE_DOSSIER_QUERIES
+    assert len(notes) == 3 and officer == 'officer' and crime == 'Theft'
+
+
+def test_missing_records_load_as_none(database, records):
+    assert load_crime_dossier(10 ** 6) is None
+    assert load_case_dossier(10 ** 6) is None
+    assert load_crime_dossiers([]) == {}
+
+
+@pytest.mark.parametrize('template', ['crime/view.html', 'case/view.html'])
+def test_dossier_templates_compile(app, template):
+    app.jinja_env.get_template(template)
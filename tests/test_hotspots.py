@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+import hotspots
+from models import Crime
+
+
+def test_store_matches_the_crimes(database):
+    from benchmark import seed
+    seed(0.05, 0)
+    store = hotspots.build_store()
+    crimes = Crime.query.filter(Crime.latitude.isnot(None), Crime.longitude.isnot(None)).order_by(Crime.id).all()
+    assert store.ids.tolist() == [crime.id for crime in crimes]
+    assert store.day.tolist() == [crime.date.toordinal() for crime in crimes]
+    assert store.lat.tolist() == pytest.approx([crime.latitude for crime in crimes], abs=1e-5)
+    assert [list(store.types)[code] for code in store.type.tolist()] == [crime.type for crime in crimes]
+
+    # A crime losing its coordinates stays in place, out of every selection
+    first = crimes[0]
+    first.latitude = None
+    database.session.commit()
+    for rows in hotspots._crime_rows(store.watermark).partitions():
+        store.merge(rows)
+    assert store.day[0] == -1
+    assert len(store) == len(crimes) - 1
+
+
+def test_idle_refresh_keeps_the_version(database, monkeypatch):
+    from benchmark import seed
+    seed(0.02, 0)
+    monkeypatch.setattr(hotspots, '_store', None)
+    config = {'HOTSPOT_REFRESH': 0, 'HOTSPOT_REBUILD': 3600}
+    hotspots._refresh_store(config)
+    version = hotspots._store.version
+    hotspots._refresh_store(config)
+    hotspots._refresh_store(config)
+    assert hotspots._store.version == version
+
+    crime = Crime.query.filter(Crime.latitude.isnot(None)).order_by(Crime.id.desc()).first()
+    crime.latitude += 0.01
+    database.session.commit()
+    hotspots._refresh_store(config)
+    assert hotspots._store.version == version + 1
@@ -0,0 +1,18 @@
+import pytest
+from flask import g
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import instrumentation
+
+
+def test_failed_statements_leave_nothing_on_the_connection(app, database):
+    with app.test_request_context('/'):
+        instrumentation._start_request()
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                database.session.execute(text('SELECT * FROM no_such_table'))
+            database.session.rollback()
+        database.session.execute(text('SELECT 1'))
+        assert 'query_started' not in database.session.connection().info
+        assert g._request_stats.queries == 1
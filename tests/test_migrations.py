@@ -0,0 +1,67 @@
+import pytest
+from sqlalchemy import inspect, text
+
+import migrations
+from app import db
+from models import Crime, CrimeDailyStat, DashboardCounter
+
+# crimes and criminals as the first release created them
+BASELINE_DDL = [
+    "CREATE TABLE crimes (id INTEGER PRIMARY KEY, type VARCHAR(100) NOT NULL, description TEXT, "
+    "date DATE NOT NULL, time TIME, location VARCHAR(255), latitude FLOAT, longitude FLOAT, "
+    "status VARCHAR(20), created_at DATETIME, updated_at DATETIME)",
+    "CREATE TABLE criminals (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, alias VARCHAR(100), "
+    "gender VARCHAR(10), date_of_birth DATE, address VARCHAR(255), nationality VARCHAR(50), "
+    "identification_marks VARCHAR(255), photo_url VARCHAR(255), created_at DATETIME, updated_at DATETIME)",
+    "INSERT INTO crimes (type, description, date, location, latitude, longitude, status) VALUES "
+    "('Burglary', 'Rear window forced', '2024-03-01', 'Elm Street', 40.71, -74.0, 'reported'), "
+    "('Theft', 'Bicycle taken', '2024-03-02', 'Oak Avenue', 40.72, -74.01, 'solved')",
+]
+
+
+@pytest.fixture
+def baseline(app):
+    with app.app_context():
+        for statement in BASELINE_DDL:
+            db.session.execute(text(statement))
+        db.session.commit()
+        yield db
+        db.session.remove()
+        db.drop_all()
+
+
+def test_fresh_database_is_stamped(database):
+    assert migrations.applied_versions() == {version for version, _, _ in migrations.MIGRATIONS}
+    assert migrations.upgrade() == []
+
+
+def test_upgrade_from_baseline_schema(baseline):
+    applied = migrations.upgrade()
+    assert applied == [name for _, name, _ in migrations.MIGRATIONS]
+
+    db_inspector = inspect(db.session.connection())
+    columns = {column['name'] for column in db_inspector.get_columns('crimes')}
+    assert {'external_id', 'geohash', 'station_id'} <= columns
+    assert 'external_id' in {column['name'] for column in db_inspector.get_columns('criminals')}
+    indexes = {name: sql for name, sql in db.session.execute(
+        text("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'crimes'"))}
+    assert {'ix_crimes_date_id', 'ix_crimes_geohash', 'ix_crimes_station_id', 'ix_crimes_location_lower'} <= set(indexes)
+    assert indexes['uq_crimes_external_id'].startswith('CREATE UNIQUE INDEX')
+    assert db_inspector.has_table('dashboard_counters')
+
+    # Derived data is rebuilt from the rows that were already there
+    assert Crime.query.filter(Crime.geohash.is_(None)).count() == 0
+    assert db.session.query(db.func.sum(CrimeDailyStat.count)).scalar() == 2
+    assert DashboardCounter.query.count() > 0
+    matches = db.session.execute(text("SELECT rowid FROM crimes_fts WHERE crimes_fts MATCH 'bicycle'")).all()
+    assert [row[0] for row in matches] == [2]
+
+    assert migrations.upgrade() == []
+
+
+def test_upgrade_database_created_before_migrations(database):
+    # Created by create_all before schema_migrations existed: every step
+    # finds its work done
+    database.session.execute(text('DROP TABLE schema_migrations'))
+    database.session.commit()
+    assert migrations.upgrade() == [name for _, name, _ in migrations.MIGRATIONS]
@@ -0,0 +1,52 @@
+import os
+from datetime import timedelta
+
+import pytest
+
+import name_search
+from models import Criminal
+
+
+def _add(database, name, alias=None):
+    criminal = Criminal(name=name, alias=alias)
+    database.session.add(criminal)
+    database.session.commit()
+    return criminal.id
+
+
+def test_deletes_by_other_workers_are_reconciled(app, database, monkeypatch):
+    monkeypatch.setattr(name_search, '_index', None)
+    keep = _add(database, 'Johnathan Smith')
+    gone = _add(database, 'Jonathan Smyth')
+    assert {row['id'] for row in name_search.search_criminals('jonathan smith')} == {keep, gone}
+
+    # Another worker deletes a row: no session event reaches this index
+    database.session.execute(Criminal.__table__.delete().where(Criminal.id == gone))
+    database.session.commit()
+    monkeypatch.setitem(app.config, 'NAME_INDEX_RECONCILE', 0)
+    assert {row['id'] for row in name_search.search_criminals('jonathan smith')} == {keep}
+
+
+def test_preloaded_index_is_never_built_in_the_request(app, database, monkeypatch):
+    monkeypatch.setattr(name_search, '_index', None)
+    monkeypatch.setattr(name_search, '_loader_pid', None)
+    monkeypatch.setattr(name_search, '_load_forever', lambda app: None)
+    monkeypatch.setitem(app.config, 'NAME_INDEX_PRELOAD', True)
+    with pytest.raises(name_search.NameIndexLoading):
+        name_search.search_criminals('smith')
+    assert name_search._loader_pid == os.getpid()
+    assert name_search._index is None
+
+
+def test_late_commit_with_an_older_stamp_is_caught_up(app, database, monkeypatch):
+    monkeypatch.setattr(name_search, '_index', None)
+    _add(database, 'Margaret Holloway')
+    index = name_search.build_index()
+
+    # Stamped before the newest row the index has seen, committed after it
+    # was built (by another worker, so no session event reaches this index)
+    database.session.execute(Criminal.__table__.insert().values(
+        name='Marguerite Holloway', updated_at=index.watermark - timedelta(seconds=5)))
+    database.session.commit()
+    name_search._catch_up(index)
+    assert {name for _, name, _, _ in index.search('marguerite holloway')} >= {'Marguerite Holloway'}
@@ -0,0 +1,22 @@
+import os
+import time
+
+import bootstrap
+from oauth_tokens import TokenStore, TokenVersions
+
+
+def test_write_in_one_worker_reaches_the_other(database, tmp_path):
+    user_id = bootstrap.ensure_admin().id
+    versions = str(tmp_path / 'oauth_tokens.sqlite')
+    first, second = TokenStore(versions=TokenVersions(versions)), TokenStore(versions=TokenVersions(versions))
+    first._sweeper_pid = second._sweeper_pid = os.getpid()  # no sweeper threads
+    token = {'access_token': 'a1', 'refresh_token': 'r1', 'expires_at': time.time() + 3600}
+
+    first.set(user_id, 'browser', 'replit', token)
+    assert second.get(user_id, 'browser', 'replit')['access_token'] == 'a1'
+
+    first.set(user_id, 'browser', 'replit', dict(token, access_token='a2', refresh_token='r2'))
+    assert second.get(user_id, 'browser', 'replit')['refresh_token'] == 'r2'
+
+    first.delete(user_id, 'browser', 'replit')
+    assert second.get(user_id, 'browser', 'replit') is None
@@ -0,0 +1,31 @@
+import pytest
+
+from models import User, Crime, Case
+from benchmark import seed
+
+
+@pytest.fixture
+def client(app, database):
+    seed(0.05, 0)
+    admin = User.query.filter_by(role='admin').order_by(User.id.desc()).first()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin.id)
+        session['_fresh'] = True
+    return client
+
+
+def test_logged_in_pages_render(client):
+    # base.html links to pages this app does not have; they must not break rendering
+    crime_id = Crime.query.with_entities(Crime.id).first()[0]
+    case_id = Case.query.with_entities(Case.id).first()[0]
+    for url in ('/', '/dashboard', '/crimes', '/crimes?search_term=incident', f'/crimes/{crime_id}',
+                f'/cases/{case_id}', '/reports/statistics', '/reports/map'):
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert b'href="#"' in response.data or url == '/', url
+
+
+def test_missing_records_are_not_found(client):
+    assert client.get('/crimes/999999').status_code in (302, 404)
+    assert client.get('/cases/999999').status_code in (302, 404)
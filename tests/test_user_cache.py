@@ -0,0 +1,25 @@
+import json
+import sqlite3
+from datetime import datetime
+
+import bootstrap
+import user_cache
+from models import User
+
+
+def test_shared_cache_stores_json_without_password_hash(database, tmp_path, monkeypatch):
+    path = str(tmp_path / 'user_cache.sqlite')
+    monkeypatch.setattr(user_cache, 'user_cache', user_cache.SharedUserCache(path))
+    user_id = bootstrap.ensure_admin().id
+    database.session.remove()
+
+    user_cache.load_cached_user(database.session, User, user_id)
+    payload = json.loads(sqlite3.connect(path).execute('SELECT payload FROM user_cache').fetchone()[0])
+    assert payload['username'] == 'admin'
+    assert 'password_hash' not in payload
+    database.session.remove()
+
+    user = user_cache.load_cached_user(database.session, User, user_id)
+    assert user_cache.user_cache.hits == 1
+    assert isinstance(user.created_at, datetime)
+    assert user.check_password('password')
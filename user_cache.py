@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
+
+from sqlalchemy import DateTime, event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import make_transient_to_detached
+
+from utils import TTLCache
+
+
+class LocalUserCache(TTLCache):
+    """Per-process LRU of user column values with a time-to-live."""
+
+    def stats(self):
+        return dict(super().stats(), backend='local')
+
+
+class SharedUserCache(LocalUserCache):
+    """User cache in a local SQLite file shared by every worker on the host.
+
+    Invalidations made by one gunicorn worker are seen by the others
+    immediately instead of after the TTL. Hit and miss counters are per
+    process.
+    """
+
+    def __init__(self, path, max_size=1024, ttl=30):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS user_cache ('
+                         'user_id TEXT PRIMARY KEY, expires_at REAL NOT NULL, payload TEXT NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id):
+        row = self._connect().execute(
+            'SELECT expires_at, payload FROM user_cache WHERE user_id = ?', (str(user_id),)).fetchone()
+        if row is None or row[0] < time.time():
+            self.misses += 1
+            return None
+        try:
+            values = json.loads(row[1])
+        except ValueError:
+            # Written in another format by an older release
+            self.misses += 1
+            return None
+        self.hits += 1
+        return values
+
+    def set(self, user_id, values):
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO user_cache VALUES (?, ?, ?)',
+                     (str(user_id), time.time() + self.ttl, json.dumps(values, separators=(',', ':'))))
+        # Keep the table bounded: drop expired rows, then the oldest extras
+        if self.hits + self.misses and (self.hits + self.misses) % 256 == 0:
+            conn.execute('DELETE FROM user_cache WHERE expires_at < ?', (time.time(),))
+            conn.execute('DELETE FROM user_cache WHERE user_id IN (SELECT user_id FROM user_cache '
+                         'ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def delete(self, user_id):
+        self._connect().execute('DELETE FROM user_cache WHERE user_id = ?', (str(user_id),))
+
+    def clear(self):
+        self._connect().execute('DELETE FROM user_cache')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM user_cache').fetchone()[0]
+
+    def stats(self):
+        stats = super().stats()
+        stats['backend'] = 'shared'
+        return stats
+
+
+# Replaced by init_app according to the application config
+user_cache = LocalUserCache()
+
+
+def cache_stats():
+    return user_cache.stats()
+
+
+# Never cached: login loads the row itself, and the hash must not end up in
+# a second store on disk. A cached user loads it from the database on access.
+UNCACHED_COLUMNS = {'password_hash'}
+
+
+def _column_values(user):
+    """JSON-serialisable column values of ``user``; datetimes as ISO strings."""
+    values = {}
+    for prop in inspect(user).mapper.column_attrs:
+        if prop.key not in UNCACHED_COLUMNS:
+            value = getattr(user, prop.key)
+            values[prop.key] = value.isoformat() if isinstance(value, datetime) else value
+    return values
+
+
+def _from_values(model, values):
+    values = dict(values)
+    for prop in inspect(model).column_attrs:
+        if values.get(prop.key) is not None and isinstance(prop.columns[0].type, DateTime):
+            values[prop.key] = datetime.fromisoformat(values[prop.key])
+    return model(**values)
+
+
+def load_cached_user(session, model, user_id):
+    """Return ``model`` with primary key ``user_id``, skipping the DB on a cache hit.
+
+    Cached rows are re-attached to ``session`` without a SELECT so lazy
+    relationships still work for the rest of the request.
+    """
+    user = session.identity_map.get(inspect(model).identity_key_from_primary_key((user_id,)))
+    if user is not None:
+        return user
+
+    values = user_cache.get(user_id)
+    if values is not None:
+        user = _from_values(model, values)
+        make_transient_to_detached(user)
+        return session.merge(user, load=False)
+
+    user = session.get(model, user_id)
+    if user is not None:
+        user_cache.set(user_id, _column_values(user))
+    return user
+
+
+def watch_model(model):
+    """Drop cache entries whenever a ``model`` row is updated or deleted."""
+
+    def invalidate(mapper, connection, target):
+        user_cache.delete(target.id)
+        # Evict again after commit in case a concurrent request re-cached
+        # the old row between the flush and the commit
+        pending = connection.info.setdefault('user_cache_invalidations', set())
+        pending.add(target.id)
+
+    event.listen(model, 'after_update', invalidate)
+    event.listen(model, 'after_delete', invalidate)
+
+
+def _flush_invalidations(connection):
+    for user_id in connection.info.pop('user_cache_invalidations', ()):
+        user_cache.delete(user_id)
+
+
+def _discard_invalidations(connection):
+    connection.info.pop('user_cache_invalidations', None)
+
+
+def init_app(app):
+    global user_cache
+    size = app.config.get('USER_CACHE_SIZE', 1024)
+    ttl = app.config.get('USER_CACHE_TTL', 30)
+    path = app.config.get('USER_CACHE_PATH')
+    if path is None:
+        path = os.path.join(app.instance_path, 'user_cache.sqlite')
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        user_cache = SharedUserCache(path, max_size=size, ttl=ttl)
+    else:
+        user_cache = LocalUserCache(max_size=size, ttl=ttl)
+    if not event.contains(Engine, 'commit', _flush_invalidations):
+        event.listen(Engine, 'commit', _flush_invalidations)
+        event.listen(Engine, 'rollback', _discard_invalidations)